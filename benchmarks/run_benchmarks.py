@@ -0,0 +1,316 @@
+"""Time the main steps of the localization on synthetic data.
+
+The surfaces are deformed geodesic icospheres (with the number of vertices of
+a pial surface) and the montages contain grids, strips and depth electrodes
+with realistic labels, so no patient data is necessary. The results are
+written as json, together with the commit and the machine, so that they can
+be compared across commits.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output bench.json
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from json import dump
+from pathlib import Path
+from platform import node, python_version
+from subprocess import CalledProcessError, check_output
+from sys import path
+from tempfile import mkdtemp
+from time import perf_counter
+
+ROOT = Path(__file__).resolve().parents[1]
+path.insert(0, str(ROOT))
+
+from numpy import (arange, around, array, c_, cross, meshgrid, median, pi,
+                   r_, sin, sqrt, unique, zeros)
+from numpy.linalg import norm
+from numpy.random import default_rng
+from phypno.attr import Channels
+
+from eloc import fix_chan_name as fix_chan_name_module
+from eloc.fix_chan_name import check_chan_name, fix_chan_name
+from eloc.optimization_snap import snap_chan_to_surf
+from eloc.snap_grid_to_pial import get_pial_classifier
+from eloc.surf_index import SurfaceIndex
+
+SUBJ = 'MG17'  # it has renaming rules for the strips
+RADIUS = 70  # mm
+N_VERT = (50000, 150000, 300000)
+N_CONTACTS = (16, 64, 128, 256, 512)
+N_REPEAT = 5
+N_DATASETS = 100  # rows in the xltek file
+
+GRID_SPACING = 10  # mm
+STRIP_LENGTH = 8
+DEPTH_LENGTH = 8
+LETTERS = 'ABCDEFHIJKLMNOPQRTUVWXYZ'
+
+
+def icosphere(n_vert, radius=RADIUS, seed=0):
+    """Deformed geodesic icosphere, similar to a pial surface.
+
+    Parameters
+    ----------
+    n_vert : int
+        approximate number of vertices (it's 10 * freq ** 2 + 2)
+    radius : float
+        radius of the sphere, in mm
+    seed : int
+        seed for the deformation
+
+    Returns
+    -------
+    numpy.ndarray
+        n_vert X 3 matrix with the vertices
+    numpy.ndarray
+        n_tri X 3 matrix with the triangles
+    """
+    freq = max(1, int(round(sqrt((n_vert - 2) / 10))))
+
+    t = (1 + sqrt(5)) / 2
+    ico_vert = array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                      [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                      [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]])
+    ico_tri = array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10],
+                     [0, 10, 11], [1, 5, 9], [5, 11, 4], [11, 10, 2],
+                     [10, 7, 6], [7, 1, 8], [3, 9, 4], [3, 4, 2], [3, 2, 6],
+                     [3, 6, 8], [3, 8, 9], [4, 9, 5], [2, 4, 11], [6, 2, 10],
+                     [8, 6, 7], [9, 8, 1]])
+
+    # barycentric grid on each face
+    i, j = meshgrid(arange(freq + 1), arange(freq + 1), indexing='ij')
+    inside = (i + j) <= freq
+    i, j = i[inside], j[inside]
+    point_idx = zeros((freq + 1, freq + 1), dtype=int)
+    point_idx[i, j] = arange(len(i))
+
+    up = (i + j) < freq
+    down = (i + j) < freq - 1
+    local_tri = r_[c_[point_idx[i[up], j[up]], point_idx[i[up] + 1, j[up]],
+                      point_idx[i[up], j[up] + 1]],
+                   c_[point_idx[i[down] + 1, j[down]],
+                      point_idx[i[down] + 1, j[down] + 1],
+                      point_idx[i[down], j[down] + 1]]]
+
+    all_vert = []
+    all_tri = []
+    for n_face, (a, b, c) in enumerate(ico_vert[ico_tri]):
+        k = freq - i - j
+        all_vert.append((a * k[:, None] + b * i[:, None] + c * j[:, None]) /
+                        freq)
+        all_tri.append(local_tri + n_face * len(i))
+
+    # merge the vertices shared by neighboring faces
+    vert, inverse = unique(around(r_[tuple(all_vert)], 9), axis=0,
+                           return_inverse=True)
+    tri = inverse.ravel()[r_[tuple(all_tri)]]
+
+    vert /= norm(vert, axis=1, keepdims=True)
+    rng = default_rng(seed)
+    phase = rng.uniform(0, 2 * pi, 3)
+    folds = (sin(12 * vert[:, 0] + phase[0]) *
+             sin(12 * vert[:, 1] + phase[1]) *
+             sin(12 * vert[:, 2] + phase[2]))
+    vert *= radius * (1 + 0.04 * folds[:, None])
+
+    return vert, tri
+
+
+def synthetic_montage(n_contacts, radius=RADIUS, seed=0):
+    """Grids, strips and depth electrodes with realistic labels.
+
+    Parameters
+    ----------
+    n_contacts : int
+        number of contacts
+    radius : float
+        radius of the surface, in mm
+    seed : int
+        seed for the positions
+
+    Returns
+    -------
+    list of str
+        labels of the contacts
+    numpy.ndarray
+        n_contacts X 3 matrix with the positions
+
+    Notes
+    -----
+    About half of the contacts are in 8 X 8 grids, one quarter in strips (on
+    the pial surface) and the rest in depth electrodes.
+    """
+    rng = default_rng(seed)
+    labels = []
+    xyz = []
+
+    n_grid = n_contacts // 2 // 64
+    n_strip = (n_contacts - n_grid * 64) // 2 // STRIP_LENGTH
+    n_depth = -(-(n_contacts - n_grid * 64 - n_strip * STRIP_LENGTH) //
+                DEPTH_LENGTH)
+
+    step = arange(8) - 3.5
+    for i_grid in range(n_grid):
+        center, u, v = _tangent_plane(rng)
+        row, col = meshgrid(step, step, indexing='ij')
+        pos = ((radius + 2) * center + GRID_SPACING * row.ravel()[:, None] * u
+               + GRID_SPACING * col.ravel()[:, None] * v)
+        prefix = ('' if i_grid == 0 else LETTERS[i_grid]) + 'GR'
+        labels.extend(prefix + str(x + 1) for x in range(64))
+        xyz.append(pos)
+
+    strip_prefix = (['FPS', 'SFS', 'STS'] +
+                    [x + y + 'S' for x in LETTERS for y in LETTERS])
+    depth_prefix = ['L' + x + y + 'D' for x in LETTERS for y in LETTERS]
+    for i_strip in range(n_strip):
+        center, u, _ = _tangent_plane(rng)
+        pos = ((radius + 2) * center + GRID_SPACING *
+               (arange(STRIP_LENGTH) - STRIP_LENGTH / 2)[:, None] * u)
+        labels.extend(strip_prefix[i_strip] + str(x + 1)
+                      for x in range(STRIP_LENGTH))
+        xyz.append(pos)
+
+    for i_depth in range(n_depth):
+        center, u, _ = _tangent_plane(rng)
+        depth = radius * (0.3 + 0.5 * arange(DEPTH_LENGTH) / DEPTH_LENGTH)
+        pos = depth[:, None] * center + 5 * u
+        labels.extend(depth_prefix[i_depth] + str(x + 1)
+                      for x in range(DEPTH_LENGTH))
+        xyz.append(pos)
+
+    xyz = r_[tuple(xyz)] + rng.normal(0, 1, (len(labels), 3))
+    return labels[:n_contacts], xyz[:n_contacts, :]
+
+
+def _tangent_plane(rng):
+    center = rng.normal(size=3)
+    center /= norm(center)
+    u = cross(center, [0, 0, 1] if abs(center[2]) < 0.9 else [1, 0, 0])
+    u /= norm(u)
+    v = cross(center, u)
+    return center, u, v
+
+
+def timeit(func, n_repeat=N_REPEAT, setup=None):
+    """Time a function, calling setup before each repetition.
+
+    Returns
+    -------
+    dict
+        min and median duration (in s) and all the durations
+    """
+    times = []
+    for _ in range(n_repeat):
+        if setup is not None:
+            setup()
+        t0 = perf_counter()
+        func()
+        times.append(perf_counter() - t0)
+    return {'min': min(times), 'median': float(median(times)),
+            'times': times}
+
+
+def bench_chan(n_contacts, tmp_dir, n_repeat):
+    """Classification, renaming and checking of the channel names."""
+    labels, xyz = synthetic_montage(n_contacts)
+    chan = Channels(labels, xyz)
+
+    elec_file = str(tmp_dir / 'bench_elec_pos-adjusted_sessA.csv')
+    names_file = str(tmp_dir / 'bench_elec_pos-names_sessA.csv')
+    chan.export(elec_file)
+
+    xltek_file = tmp_dir / 'xltek_elec_names.csv'
+    rng = default_rng(1)
+    recorded = [x.upper() for x in labels] + ['FP1', 'EKG', 'TRIG', 'REF1']
+    with xltek_file.open('w') as f:
+        for i in range(N_DATASETS):
+            names = list(recorded)
+            names[rng.integers(len(names))] = 'XX'  # random typos
+            f.write(SUBJ + '_sessA_' + str(i) + ',' + ','.join(names) + '\n')
+
+    results = {}
+    results['classify_pial'] = timeit(
+        lambda: get_pial_classifier(SUBJ).classify(chan), n_repeat,
+        setup=get_pial_classifier.cache_clear)
+    results['fix_chan_name'] = timeit(
+        lambda: fix_chan_name(SUBJ, elec_file, names_file), n_repeat)
+    results['check_chan_name'] = timeit(
+        lambda: check_chan_name(chan, str(xltek_file), 'A'), n_repeat,
+        setup=fix_chan_name_module._consensus.clear)
+    return results
+
+
+def bench_surf(n_vert, n_points, n_repeat):
+    """Build the surface index and compute distances."""
+    vert, tri = icosphere(n_vert)
+    labels, xyz = synthetic_montage(n_points)
+
+    results = {'n_vert': len(vert)}
+    results['surface_index'] = timeit(lambda: SurfaceIndex(vert, tri),
+                                      n_repeat)
+    surf_index = SurfaceIndex(vert, tri)
+    results['distance_vertex'] = timeit(
+        lambda: surf_index.distance(xyz, exact=False), n_repeat)
+    results['distance_exact'] = timeit(lambda: surf_index.distance(xyz),
+                                       n_repeat)
+
+    pial = get_pial_classifier(SUBJ).classify(Channels(labels, xyz))
+    pial_labels = [x for x, on_pial in zip(labels, pial) if on_pial]
+
+    def _snap():
+        snap_chan_to_surf(Channels(pial_labels, xyz[pial, :]), surf_index)
+
+    results['n_snapped'] = len(pial_labels)
+    results['snap'] = timeit(_snap, n_repeat)
+    return results
+
+
+def git_commit():
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'], cwd=str(ROOT),
+                            universal_newlines=True).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the localization steps '
+                            'on synthetic data')
+    parser.add_argument('--output', default='eloc_benchmark.json',
+                        help='json file with the results')
+    parser.add_argument('--n_vert', type=int, nargs='+', default=N_VERT,
+                        help='number of vertices of the surfaces')
+    parser.add_argument('--n_contacts', type=int, nargs='+',
+                        default=N_CONTACTS, help='number of contacts')
+    parser.add_argument('--n_repeat', type=int, default=N_REPEAT,
+                        help='number of repetitions of each measure')
+    args = parser.parse_args()
+
+    tmp_dir = Path(mkdtemp())
+    results = {'commit': git_commit(),
+               'machine': node(),
+               'python': python_version(),
+               'date': datetime.now().isoformat(),
+               'n_repeat': args.n_repeat,
+               'chan': {},
+               'surf': {},
+               }
+
+    for n_contacts in args.n_contacts:
+        print('channels: {} contacts'.format(n_contacts))
+        results['chan'][n_contacts] = bench_chan(n_contacts, tmp_dir,
+                                                 args.n_repeat)
+
+    for n_vert in args.n_vert:
+        print('surface: {} vertices'.format(n_vert))
+        results['surf'][n_vert] = bench_surf(n_vert, max(args.n_contacts),
+                                             args.n_repeat)
+
+    with open(args.output, 'w') as f:
+        dump(results, f, indent=2)
+    print('results in ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
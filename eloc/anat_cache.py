@@ -0,0 +1,172 @@
+"""Load the anatomy of each subject only once, as memory-mapped arrays.
+
+Surfaces and volumes are converted once to .npy files in the cache and then
+memory-mapped (read-only). All the stages, sessions and worker processes of
+the same subject share the same buffers, through the page cache.
+"""
+from functools import lru_cache
+from logging import getLogger
+from pathlib import Path
+
+from nibabel import load as nib_load
+from numpy import asarray, int32, load
+
+from .surf_cache import SurfaceCache
+from .surf_io import _save_npy, load_surf_mmap
+
+lg = getLogger(__name__)
+
+
+class Surface:
+    """Vertices and triangles of one surface (like phypno.attr.anat.Surf).
+
+    Attributes
+    ----------
+    surf_file : pathlib.Path
+        path to the original surface file
+    vert : numpy.memmap
+        n_vert X 3 matrix with the vertices
+    tri : numpy.memmap
+        n_tri X 3 matrix with the triangles
+    """
+    def __init__(self, surf_file, vert, tri):
+        self.surf_file = surf_file
+        self.vert = vert
+        self.tri = tri
+
+
+class Brain:
+    """Surfaces of the two hemispheres (like phypno.attr.anat.Brain)."""
+    def __init__(self, lh, rh):
+        self.lh = lh
+        self.rh = rh
+
+
+class SharedAnatomy:
+    """Surfaces and volumes of one subject, loaded only once.
+
+    Parameters
+    ----------
+    freesurfer_dir : path to dir
+        freesurfer directory of the subject
+    cache : instance of SurfaceCache, optional
+        where to store the .npy files
+
+    Notes
+    -----
+    It can be used instead of phypno.attr.anat.Freesurfer in the stages of
+    the pipeline (it has 'dir' and 'read_brain').
+    """
+    def __init__(self, freesurfer_dir, cache=None):
+        self.dir = Path(freesurfer_dir)
+        if not self.dir.exists():
+            raise FileNotFoundError('No freesurfer directory ' + str(self.dir))
+
+        self.cache = SurfaceCache() if cache is None else cache
+        self._surfaces = {}
+        self._volumes = {}
+
+    def read_surf(self, hemi, surf_type='pial'):
+        """Read one surface.
+
+        Parameters
+        ----------
+        hemi : str
+            'lh' or 'rh'
+        surf_type : str
+            'pial', 'white', 'smoothwm', 'inflated', etc
+
+        Returns
+        -------
+        instance of Surface
+            the surface, with memory-mapped vertices and triangles
+        """
+        key = (hemi, surf_type)
+        if key not in self._surfaces:
+            surf_file = self.dir.joinpath('surf', hemi + '.' + surf_type)
+            vert, tri = load_surf_mmap(surf_file, self.cache)
+            self._surfaces[key] = Surface(surf_file, vert, tri)
+        return self._surfaces[key]
+
+    def read_brain(self, surf_type='smoothwm'):
+        """Read the surface of both hemispheres (same default as phypno).
+
+        Parameters
+        ----------
+        surf_type : str
+            'pial', 'white', 'smoothwm', 'inflated', etc
+
+        Returns
+        -------
+        instance of Brain
+            with the surfaces as attributes 'lh' and 'rh'
+        """
+        return Brain(self.read_surf('lh', surf_type),
+                     self.read_surf('rh', surf_type))
+
+    def read_volume(self, name):
+        """Read one volume in the mri directory.
+
+        Parameters
+        ----------
+        name : str
+            name of the volume, f.e. 'aparc+aseg.mgz'
+
+        Returns
+        -------
+        numpy.memmap
+            the data of the volume (read-only)
+        numpy.ndarray
+            4 X 4 affine matrix from voxel to surface RAS (tkr) coordinates
+        """
+        if name not in self._volumes:
+            self._volumes[name] = load_volume_mmap(
+                self.dir.joinpath('mri', name), self.cache)
+        return self._volumes[name]
+
+
+@lru_cache(maxsize=8)
+def get_anatomy(freesurfer_dir):
+    """Return the anatomy of one subject (only created once per process).
+
+    Parameters
+    ----------
+    freesurfer_dir : str
+        freesurfer directory of the subject
+
+    Returns
+    -------
+    instance of SharedAnatomy
+        anatomy of the subject
+    """
+    return SharedAnatomy(freesurfer_dir)
+
+
+def load_volume_mmap(volume_file, cache=None):
+    """Read a volume as memory-mapped array, using a .npy copy in the cache.
+
+    Parameters
+    ----------
+    volume_file : path to file
+        volume that nibabel can read (f.e. aparc+aseg.mgz)
+    cache : instance of SurfaceCache, optional
+        where to store the .npy copy
+
+    Returns
+    -------
+    numpy.memmap
+        the data of the volume (read-only)
+    numpy.ndarray
+        4 X 4 affine matrix from voxel to surface RAS (tkr) coordinates
+    """
+    if cache is None:
+        cache = SurfaceCache()
+
+    img = nib_load(str(volume_file))
+
+    def _create(tmp_dir):
+        return _save_npy(asarray(img.dataobj).astype(int32), tmp_dir)
+
+    key = cache.key(volume_file, kind='volume', dtype='int32')
+    entry = cache.get_or_create(key, _create)
+    return load(str(entry), mmap_mode='r'), img.header.get_vox2ras_tkr()
@@ -0,0 +1,444 @@
+"""Run the localization pipeline on many subjects and sessions in parallel.
+
+Each subject is one job, which runs its sessions in order (a session reuses
+the snapping of the earlier sessions). Jobs run in a pool of processes, so
+that a subject that fails or that is very slow does not block the others. The
+steps that need a lot of memory (snapping and plotting) are limited by a
+semaphore shared across the processes.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from json import dump
+from logging import getLogger
+from multiprocessing import BoundedSemaphore, cpu_count
+from os.path import exists, join, splitext
+from time import time
+from traceback import format_exc
+
+from .anat_cache import get_anatomy
+from .build import Pipeline, Stage, code_version
+from .chan_table import ChanTable
+from .elec_store import ElecStore
+from .elec_info import (assign_regions, create_morph_maps,
+                        plot_rotating_brains, make_table_of_regions)
+from .fix_chan_name import rename_chan, check_chan_name, RENAME_RULES
+from .optimization_snap import previous_snap
+from .snap_grid_to_pial import adjust_grid_strip_chan
+from .trace import pop_events, set_context, write_trace
+
+lg = getLogger(__name__)
+
+SESSIONS = {'MG43': ('A', 'B'),
+            'MG64': ('A', 'B'),
+            'MG70': ('A', 'B'),
+            'MG82': ('A', 'B'),
+            }
+DEFAULT_SESSIONS = ('A', )
+N_HEAVY = 2  # max number of memory-heavy steps at the same time
+MORPH_MAPS_JOB = 'morph_maps'  # instead of the session, in the summary
+
+# a stage reruns when the code of one of its modules changes
+STAGE_MODULES = {'snap': ('snap_grid_to_pial', 'optimization_snap',
+                          'neighbors', 'surf_index', 'outer_surface',
+                          'surf_io'),
+                 'gif': ('elec_info', 'render', 'snap_grid_to_pial'),
+                 'regions': ('elec_info', 'regions', 'snap_grid_to_pial'),
+                 'names': ('fix_chan_name', ),
+                 'store': ('elec_store', 'regions'),
+                 'report': ('fix_chan_name', ),
+                 }
+
+_heavy_lock = None
+
+
+class SkipSession(Exception):
+    """The files for this session are not available."""
+    pass
+
+
+def get_sessions(subj):
+    """Sessions with electrode locations for one subject."""
+    return SESSIONS.get(subj, DEFAULT_SESSIONS)
+
+
+def run_batch(jobs, n_workers=None, n_heavy=N_HEAVY, summary_file=None,
+              force=False, trace_file=None, store_dir=None):
+    """Run the pipeline for each subject and session.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        each tuple contains subject code, session and the dict of directories
+        (as returned by rcmg.interfaces.make_struct)
+    n_workers : int, optional
+        number of processes (default: number of CPUs)
+    n_heavy : int
+        max number of memory-heavy steps running at the same time
+    summary_file : path to file, optional
+        json file where to write the outcome and timing of each job
+    force : bool
+        run all the steps, even if they are up to date
+    trace_file : path to file, optional
+        file where to write the time and resources of each step (see
+        eloc.trace.write_trace)
+    store_dir : path to dir, optional
+        columnar store where to write the positions of all the subjects (see
+        eloc.elec_store.ElecStore)
+
+    Returns
+    -------
+    list of dict
+        outcome of each job, with keys 'subj', 'sess', 'status' ('ok',
+        'skipped' or 'failed'), 'message', 'duration', 'steps'. The morph
+        maps are one job per subject, with 'sess' equal to 'morph_maps'.
+    """
+    if n_workers is None:
+        n_workers = cpu_count()
+
+    summary = []
+    events = []
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=_init_worker,
+                             initargs=(BoundedSemaphore(n_heavy), )) as pool:
+        futures = {}
+
+        # morph maps only depend on the subject, not on the session
+        subjects = {subj: dir_names for subj, _, dir_names in jobs}
+        for subj, dir_names in subjects.items():
+            future = pool.submit(run_morph_maps, subj, dir_names, force)
+            futures[future] = (subj, MORPH_MAPS_JOB, dir_names)
+
+        # the sessions of one subject run one after the other
+        sessions = {}
+        for subj, sess, _ in jobs:
+            sessions.setdefault(subj, []).append(sess)
+        for subj, subj_sessions in sessions.items():
+            future = pool.submit(run_subject, subj, sorted(subj_sessions),
+                                 subjects[subj], force, store_dir)
+            futures[future] = (subj, subj_sessions, subjects[subj])
+
+        for future in as_completed(futures):
+            subj, sess, _ = futures[future]
+            try:
+                results = future.result()
+            except Exception as err:  # the worker itself died
+                if isinstance(sess, str):
+                    sess = [sess]
+                results = [{'subj': subj, 'sess': one_sess,
+                            'status': 'failed', 'message': repr(err),
+                            'duration': None, 'steps': {}}
+                           for one_sess in sess]
+            if isinstance(results, dict):
+                results = [results]
+            for result in results:
+                events.extend(result.pop('trace', []))
+                lg.info('{subj} sess{sess}: {status} {message}'.format(
+                    **result))
+                summary.append(result)
+
+    summary = sorted(summary, key=lambda x: (x['subj'], x['sess']))
+    if summary_file is not None:
+        with open(summary_file, 'w') as f:
+            dump(summary, f, indent=2)
+    if trace_file is not None:
+        write_trace(events, trace_file)
+    if store_dir is not None:
+        ElecStore(store_dir).compact()
+
+    return summary
+
+
+def _init_worker(heavy_lock):
+    global _heavy_lock
+    _heavy_lock = heavy_lock
+
+
+@contextmanager
+def _heavy():
+    """Limit the number of memory-heavy steps across processes."""
+    if _heavy_lock is None:
+        yield
+    else:
+        with _heavy_lock:
+            yield
+
+
+def run_subject(subj, sessions, dir_names, force=False, store_dir=None):
+    """Run the sessions of one subject in order, so that each session can
+    reuse the snapping of the earlier ones (see read_previous_snap)."""
+    return [run_job(subj, sess, dir_names, force, store_dir)
+            for sess in sessions]
+
+
+def run_job(subj, sess, dir_names, force=False, store_dir=None):
+    """Run one job and catch all the errors, so that it does not stop the
+    other jobs."""
+    result = {'subj': subj,
+              'sess': sess,
+              'status': 'ok',
+              'message': '',
+              'steps': {},
+              }
+
+    set_context(subj=subj, sess=sess)
+    t0 = time()
+    try:
+        process_session(subj, sess, dir_names, result['steps'], force,
+                        store_dir)
+    except SkipSession as err:
+        result['status'] = 'skipped'
+        result['message'] = str(err)
+    except Exception:
+        result['status'] = 'failed'
+        result['message'] = format_exc()
+    result['duration'] = time() - t0
+    result['trace'] = pop_events()
+
+    return result
+
+
+def run_morph_maps(subj, dir_names, force=False):
+    """Create the morph maps for one subject, as a separate job."""
+    result = {'subj': subj,
+              'sess': MORPH_MAPS_JOB,
+              'status': 'ok',
+              'message': '',
+              'steps': {},
+              }
+
+    set_context(subj=subj, sess=MORPH_MAPS_JOB)
+    t0 = time()
+    try:
+        if not create_morph_maps(dir_names['mri_proc'], force=force):
+            result['message'] = 'up to date'
+    except Exception:
+        result['status'] = 'failed'
+        result['message'] = format_exc()
+    result['duration'] = time() - t0
+    result['trace'] = pop_events()
+
+    return result
+
+
+def process_session(subj, sess, dir_names, steps=None, force=False,
+                    store_dir=None):
+    """Run all the steps for one subject and one session.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    sess : str
+        session: 'A', 'B', 'C', ...
+    dir_names : dict
+        directories of the subject (as returned by rcmg's make_struct)
+    steps : dict, optional
+        dict where to store the duration of each step (None if the step was
+        up to date)
+    force : bool
+        run all the steps, even if they are up to date
+    store_dir : path to dir, optional
+        columnar store where to write the positions (original, adjusted with
+        the regions and with the new names)
+
+    Raises
+    ------
+    SkipSession
+        when the necessary files are missing
+    """
+    if steps is None:
+        steps = {}
+
+    elec_file = join(dir_names['doc_elec'], subj + '_elec_pos-orig_sess' +
+                     sess + '.csv')
+    adj_elec_file = join(dir_names['doc_elec'], subj +
+                         '_elec_pos-adjusted_sess' + sess + '.csv')
+    names_elec_file = join(dir_names['doc_elec'], subj +
+                           '_elec_pos-names_sess' + sess + '.csv')
+    snap_file = join(dir_names['doc_elec'], subj + '_elec_pos-snap_sess' +
+                     sess + '.json')
+    gif_file = join(dir_names['doc_wiki'], subj + '_elec_pos-XX_sess' +
+                    sess + '.gif')
+    wiki_file = join(dir_names['doc_wiki'], subj + '_elec_pos-wiki_sess' +
+                     sess + '.txt')
+    xltek_chan_file = join(dir_names['doc_elec'], 'xltek_elec_names.csv')
+    report_file = splitext(xltek_chan_file)[0] + '_sess' + sess + '_report'
+    stamp_file = join(dir_names['doc_elec'], '.eloc_build_sess' + sess +
+                      '.json')
+
+    fs_dir = join(dir_names['mri_proc'], 'freesurfer')
+    pial = [join(fs_dir, 'surf', hemi + '.pial') for hemi in ('lh', 'rh')]
+    # the gifs show the default surface of Freesurfer.read_brain
+    smoothwm = [join(fs_dir, 'surf', hemi + '.smoothwm')
+                for hemi in ('lh', 'rh')]
+    aseg = join(fs_dir, 'mri', 'aparc+aseg.mgz')
+
+    if not exists(elec_file):
+        raise SkipSession('No electrode file ' + elec_file)
+    try:
+        anat = get_anatomy(fs_dir)  # shared by all the stages
+    except (FileNotFoundError, OSError) as err:
+        raise SkipSession(str(err))
+
+    # the channels are passed in memory between stages; the files are only
+    # read when the stage that creates them was up to date
+    tables = {}
+    store = None if store_dir is None else ElecStore(store_dir)
+
+    def _table(name, chan_file):
+        if name not in tables:
+            tables[name] = ChanTable.from_file(chan_file)
+        return tables[name]
+
+    def _snap():
+        chan = ChanTable.from_file(elec_file)
+        previous = read_previous_snap(subj, sess, dir_names)
+        diagnostics = []
+        with _heavy():
+            try:
+                chan = adjust_grid_strip_chan(chan, anat, subj, previous,
+                                              diagnostics)
+            except ValueError as err:
+                lg.warning(err)
+        chan.export(adj_elec_file)
+        tables['adjusted'] = chan
+        with open(snap_file, 'w') as f:
+            dump(diagnostics, f, indent=2)
+
+    def _gif():
+        with _heavy():
+            try:
+                plot_rotating_brains(_table('adjusted', adj_elec_file), anat,
+                                     gif_file, subj)
+            except FileNotFoundError as err:  # surfaces are not available
+                raise SkipSession(str(err))
+
+    def _regions():
+        chan = _table('adjusted', adj_elec_file)
+        make_table_of_regions(chan, anat, wiki_file, subj)
+
+    def _names():
+        chan = _table('adjusted', adj_elec_file).copy()
+        rename_chan(chan, subj, sess)
+        chan.export(names_elec_file)
+        tables['names'] = chan
+
+    def _store():
+        """Write the checkpoints to the store, also when the other stages
+        were up to date."""
+        adjusted = _table('adjusted', adj_elec_file)
+        if all(x is None for x in adjusted.return_attr('region')):
+            # regions was up to date, so the table was read from file
+            assign_regions(adjusted, anat)
+        names = _table('names', names_elec_file)
+        for row, region, approx in zip(names.chan,
+                                       adjusted.return_attr('region'),
+                                       adjusted.return_attr('approx')):
+            row.attr['region'] = region
+            row.attr['approx'] = approx
+
+        store.update(subj, sess, 'orig', ChanTable.from_file(elec_file))
+        store.update(subj, sess, 'adjusted', adjusted)
+        store.update(subj, sess, 'names', names)
+
+        sync_file = store.sync_file(subj, sess)
+        sync_file.parent.mkdir(parents=True, exist_ok=True)
+        sync_file.touch()
+
+    def _report():
+        check_chan_name(_table('names', names_elec_file), xltek_chan_file,
+                        sess)
+
+    pipeline = Pipeline(stamp_file)
+    previous_files = [x
+                      for files in previous_snap_files(subj, sess, dir_names)
+                      for x in files]
+    pipeline.add(Stage('snap', _snap,
+                       inputs=[elec_file] + pial + previous_files,
+                       outputs=[adj_elec_file, snap_file],
+                       version=_stage_version('snap')))
+    pipeline.add(Stage('gif', _gif, inputs=[adj_elec_file] + smoothwm,
+                       outputs=[gif_file.replace('XX', hemi)
+                                for hemi in ('lh', 'rh')],
+                       version=_stage_version('gif')))
+    pipeline.add(Stage('regions', _regions, inputs=[adj_elec_file, aseg],
+                       outputs=[wiki_file],
+                       version=_stage_version('regions')))
+    pipeline.add(Stage('names', _names,
+                       inputs=[adj_elec_file, RENAME_RULES],
+                       outputs=[names_elec_file],
+                       version=_stage_version('names')))
+    if store is not None:
+        # the store is an output, so the stage runs for a new store
+        pipeline.add(Stage('store', _store,
+                           inputs=[elec_file, adj_elec_file, names_elec_file,
+                                   aseg],
+                           outputs=[store.sync_file(subj, sess)],
+                           version=_stage_version('store')))
+    if exists(xltek_chan_file):
+        pipeline.add(Stage('report', _report,
+                           inputs=[names_elec_file, xltek_chan_file,
+                                   RENAME_RULES],
+                           outputs=[report_file + '.txt',
+                                    report_file + '.json',
+                                    report_file + '.csv'],
+                           version=_stage_version('report')))
+
+    steps.update(pipeline.run(force=force))
+
+
+def _stage_version(name):
+    return code_version(*[__package__ + '.' + x for x in STAGE_MODULES[name]])
+
+
+def read_previous_snap(subj, sess, dir_names):
+    """Read the snapping of the earlier sessions of the same subject.
+
+    Parameters
+    ----------
+    subj : str
+        subject code
+    sess : str
+        current session
+    dir_names : dict
+        directories of the subject (as returned by rcmg's make_struct)
+
+    Returns
+    -------
+    dict
+        from label to a tuple with the original and the snapped position (see
+        eloc.optimization_snap.previous_snap). Later sessions take precedence.
+
+    Notes
+    -----
+    Only the earlier sessions are used. run_batch runs the sessions of one
+    subject in order, so the earlier sessions are complete. If an earlier
+    session has not been snapped, all the contacts are snapped from scratch.
+    """
+    previous = {}
+    for orig_file, adj_file in previous_snap_files(subj, sess, dir_names):
+        if exists(orig_file) and exists(adj_file):
+            previous.update(previous_snap(ChanTable.from_file(orig_file),
+                                          ChanTable.from_file(adj_file)))
+    return previous
+
+
+def previous_snap_files(subj, sess, dir_names):
+    """Original and adjusted files of the sessions before sess.
+
+    Returns
+    -------
+    list of tuple
+        for each earlier session, the path to the original and to the
+        adjusted positions (they might not exist). These are inputs of the
+        snapping, so that it reruns when an earlier session changes.
+    """
+    files = []
+    for one_sess in sorted(get_sessions(subj)):
+        if one_sess >= sess:
+            break
+        files.append((join(dir_names['doc_elec'], subj +
+                           '_elec_pos-orig_sess' + one_sess + '.csv'),
+                      join(dir_names['doc_elec'], subj +
+                           '_elec_pos-adjusted_sess' + one_sess + '.csv')))
+    return files
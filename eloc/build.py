@@ -0,0 +1,188 @@
+"""Minimal make-like build system for the pipeline.
+
+Each stage declares its input and output files. A stage is run only if one of
+its outputs is missing, if the content of one of its inputs has changed or if
+its version has changed since the last time it was run. The version can be
+computed from the source code of the stage (see code_version). The hash of the
+inputs is stored in a json file (one per subject and session).
+"""
+from functools import lru_cache
+from hashlib import sha1
+from importlib import import_module
+from json import dump, load
+from logging import getLogger
+from os import replace
+from pathlib import Path
+from time import time
+
+from .surf_cache import file_hash
+from .trace import measure
+
+lg = getLogger(__name__)
+
+
+class Stage:
+    """One step of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        unique name of the stage
+    func : function
+        function without arguments, which reads the inputs and writes the
+        outputs
+    inputs : list of path to file
+        files the stage depends on
+    outputs : list of path to file
+        files the stage creates
+    version : str
+        change it when the code of the stage changes, so that it reruns (see
+        code_version)
+    """
+    def __init__(self, name, func, inputs, outputs, version='1'):
+        self.name = name
+        self.func = func
+        self.inputs = [Path(x) for x in inputs]
+        self.outputs = [Path(x) for x in outputs]
+        self.version = version
+
+
+def code_version(*module_names):
+    """Version of a stage, based on the source code of its modules.
+
+    Parameters
+    ----------
+    *module_names : str
+        modules with the code of the stage (f.e. 'eloc.regions')
+
+    Returns
+    -------
+    str
+        it changes when the source of one of the modules changes
+    """
+    h = sha1()
+    for name in module_names:
+        h.update(_source_hash(name).encode())
+    return h.hexdigest()[:12]
+
+
+@lru_cache(maxsize=None)
+def _source_hash(module_name):
+    return file_hash(import_module(module_name).__file__)
+
+
+class Pipeline:
+    """Run the stages that are not up to date.
+
+    Parameters
+    ----------
+    stamp_file : path to file
+        json file with the state of the previous run
+
+    Notes
+    -----
+    The order of the stages is based on their inputs and outputs: if a stage
+    uses the output of another stage, it runs after it. When a stage reruns
+    but its outputs do not change, the stages that depend on it are not run.
+    """
+    def __init__(self, stamp_file):
+        self.stamp_file = Path(stamp_file)
+        self.stages = []
+
+        try:
+            with self.stamp_file.open() as f:
+                self._stamps = load(f)
+        except (FileNotFoundError, ValueError):
+            self._stamps = {'stages': {}, 'hashes': {}}
+
+    def add(self, stage):
+        self.stages.append(stage)
+
+    def run(self, force=False):
+        """Run the stages.
+
+        Parameters
+        ----------
+        force : bool
+            run all the stages, even if they are up to date
+
+        Returns
+        -------
+        dict
+            for each stage, the duration (in s) or None if it was up to date
+        """
+        done = {}
+        try:
+            for stage in self._sorted_stages():
+                stamp = self._stamp(stage)
+                if not force and self._is_up_to_date(stage, stamp):
+                    lg.debug(stage.name + ' is up to date')
+                    done[stage.name] = None
+                    continue
+
+                lg.info('running ' + stage.name)
+                t0 = time()
+                with measure('stage ' + stage.name):
+                    stage.func()
+                done[stage.name] = time() - t0
+
+                # some inputs might not exist before the stage runs
+                self._stamps['stages'][stage.name] = self._stamp(stage)
+        finally:
+            self._save()
+
+        return done
+
+    def _sorted_stages(self):
+        produced_by = {out: stage for stage in self.stages
+                       for out in stage.outputs}
+
+        ordered = []
+        visiting = set()
+
+        def _visit(stage):
+            if stage in ordered:
+                return
+            if stage.name in visiting:
+                raise ValueError('Circular dependency in ' + stage.name)
+            visiting.add(stage.name)
+            for one_input in stage.inputs:
+                if one_input in produced_by:
+                    _visit(produced_by[one_input])
+            ordered.append(stage)
+
+        for stage in self.stages:
+            _visit(stage)
+        return ordered
+
+    def _stamp(self, stage):
+        return {'version': stage.version,
+                'inputs': {str(x): self._hash(x) for x in stage.inputs},
+                }
+
+    def _is_up_to_date(self, stage, stamp):
+        if not all(x.exists() for x in stage.outputs):
+            return False
+        return self._stamps['stages'].get(stage.name) == stamp
+
+    def _hash(self, file_name):
+        """Hash of the file, only recomputed if size or mtime change."""
+        try:
+            stat = file_name.stat()
+        except FileNotFoundError:
+            return None
+
+        fingerprint = [stat.st_size, stat.st_mtime]
+        cached = self._stamps['hashes'].get(str(file_name))
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+        h = file_hash(file_name)
+        self._stamps['hashes'][str(file_name)] = [fingerprint, h]
+        return h
+
+    def _save(self):
+        tmp_file = self.stamp_file.with_name(self.stamp_file.name + '.tmp')
+        with tmp_file.open('w') as f:
+            dump(self._stamps, f, indent=2)
+        replace(str(tmp_file), str(self.stamp_file))
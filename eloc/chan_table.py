@@ -0,0 +1,202 @@
+"""Channels as arrays, passed in memory from one stage to the next.
+
+ChanTable has the same interface as phypno.attr.chan.Channels for the parts
+used in eloc ('chan', 'n_chan', 'return_label', 'return_xyz', filtering by
+calling it with a function and 'export'), but the labels, the positions and
+the attributes are stored as columns. The stages modify the table in memory
+and the files are only written at the checkpoints, with full precision.
+"""
+from csv import reader, writer
+from logging import getLogger
+
+from numpy import arange, asarray, empty, float64, full
+
+lg = getLogger(__name__)
+
+
+class ChanTable:
+    """Labels, positions and attributes of the channels, as columns.
+
+    Parameters
+    ----------
+    labels : list of str
+        labels of the channels
+    xyz : numpy.ndarray
+        n_chan X 3 matrix with the positions of the channels
+    attr : dict, optional
+        from the name of the attribute to a column (one value per channel)
+
+    Notes
+    -----
+    Filtering returns a view: the rows of the filtered table are the rows of
+    the original table, so changing the label, the position or an attribute
+    of a channel in the filtered table changes it in the original table too
+    (like the instances of Chan in phypno).
+    """
+    def __init__(self, labels, xyz, attr=None):
+        self._labels = asarray(labels, dtype=object)
+        self._xyz = asarray(xyz, dtype=float64).reshape(-1, 3).copy()
+        self._attr = {}
+        for name, values in (attr or {}).items():
+            self._attr[name] = asarray(values, dtype=object)
+        self._base = self
+        self._idx = arange(len(self._labels))
+
+    @classmethod
+    def from_channels(cls, chan):
+        """Convert an instance of phypno.attr.chan.Channels."""
+        names = {name for one_chan in chan.chan for name in one_chan.attr}
+        attr = {name: [one_chan.attr.get(name) for one_chan in chan.chan]
+                for name in names}
+        return cls(chan.return_label(), _xyz_or_empty(chan), attr)
+
+    @classmethod
+    def from_file(cls, elec_file):
+        """Read a csv file with label and x, y, z in each row.
+
+        Parameters
+        ----------
+        elec_file : path to file
+            file with the channels (same format as phypno's Channels)
+
+        Returns
+        -------
+        instance of ChanTable
+            the channels in the file
+        """
+        labels = []
+        xyz = []
+        with open(str(elec_file), newline='') as f:
+            for row in reader(f):
+                if len(row) < 4:
+                    continue
+                try:
+                    pos = [float(x) for x in row[1:4]]
+                except ValueError:  # header
+                    continue
+                labels.append(row[0].strip())
+                xyz.append(pos)
+        return cls(labels, xyz)
+
+    @property
+    def n_chan(self):
+        return len(self._idx)
+
+    @property
+    def chan(self):
+        """List of channels (each one with 'label', 'xyz' and 'attr')."""
+        return [ChanRow(self._base, i) for i in self._idx]
+
+    def __call__(self, filter_func):
+        """Select the channels for which filter_func returns True (view)."""
+        subset = ChanTable.__new__(ChanTable)
+        subset._base = self._base
+        subset._idx = asarray([row.idx for row in self.chan
+                               if filter_func(row)], dtype=int)
+        return subset
+
+    def return_label(self):
+        return list(self._base._labels[self._idx])
+
+    def return_xyz(self):
+        return self._base._xyz[self._idx, :].copy()
+
+    def return_attr(self, name):
+        """Column of one attribute (None for the channels without it)."""
+        column = self._base._attr.get(name)
+        if column is None:
+            return full(self.n_chan, None, dtype=object)
+        return column[self._idx].copy()
+
+    def copy(self):
+        """Independent copy of these channels."""
+        return ChanTable(self.return_label(), self.return_xyz(),
+                         {name: self.return_attr(name)
+                          for name in self._base._attr})
+
+    def to_channels(self):
+        """Convert to an instance of phypno.attr.chan.Channels."""
+        from phypno.attr import Channels
+
+        chan = Channels(self.return_label(), self.return_xyz())
+        for one_chan, row in zip(chan.chan, self.chan):
+            one_chan.attr.update(row.attr.items())
+        return chan
+
+    def export(self, elec_file):
+        """Write label and x, y, z to a csv file, with full precision.
+
+        Parameters
+        ----------
+        elec_file : path to file
+            output file (it can be read by phypno's Channels)
+        """
+        with open(str(elec_file), 'w', newline='') as f:
+            csv_file = writer(f)
+            for label, xyz in zip(self.return_label(), self.return_xyz()):
+                csv_file.writerow([label] + [repr(float(x)) for x in xyz])
+
+
+class ChanRow:
+    """One channel of a ChanTable (like phypno.attr.chan.Chan)."""
+    def __init__(self, table, idx):
+        self.table = table
+        self.idx = idx
+
+    @property
+    def label(self):
+        return self.table._labels[self.idx]
+
+    @label.setter
+    def label(self, label):
+        self.table._labels[self.idx] = label
+
+    @property
+    def xyz(self):
+        return self.table._xyz[self.idx, :]
+
+    @xyz.setter
+    def xyz(self, xyz):
+        self.table._xyz[self.idx, :] = xyz
+
+    @property
+    def attr(self):
+        return ChanAttr(self.table, self.idx)
+
+
+class ChanAttr:
+    """Attributes of one channel, stored in the columns of the table."""
+    def __init__(self, table, idx):
+        self.table = table
+        self.idx = idx
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return self.table._attr[name][self.idx]
+
+    def __setitem__(self, name, value):
+        if name not in self.table._attr:
+            column = empty(len(self.table._labels), dtype=object)
+            column[:] = None
+            self.table._attr[name] = column
+        self.table._attr[name][self.idx] = value
+
+    def __contains__(self, name):
+        return (name in self.table._attr and
+                self.table._attr[name][self.idx] is not None)
+
+    def __iter__(self):
+        return (name for name in self.table._attr if name in self)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+
+def _xyz_or_empty(chan):
+    if chan.n_chan == 0:
+        return empty((0, 3))
+    return chan.return_xyz()
@@ -0,0 +1,140 @@
+"""Check the channel names of all the subjects and sessions at once.
+
+This only runs the renaming and the comparison with the recorded channels,
+without snapping or plotting. Each file is read only once.
+"""
+from csv import reader, writer
+from logging import getLogger
+from os.path import exists, join, splitext
+
+from .chan_table import ChanTable
+from .fix_chan_name import (ChanNameConsensus, rename_chan,
+                            reconcile_chan_name, write_report)
+
+lg = getLogger(__name__)
+
+SUMMARY_COLUMNS = ('matched', 'unknown', 'missing', 'case_mismatch')
+NO_XLTEK = 'no xltek file'
+
+
+def reconcile_cohort(jobs, summary_file=None):
+    """Rename the channels and compare them with the recorded channels.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        each tuple contains subject code, session and the dict of directories
+        (as returned by rcmg.interfaces.make_struct)
+    summary_file : path to file, optional
+        csv file with the number of channels in each group, for each subject
+        and session
+
+    Returns
+    -------
+    dict
+        the keys are (subject, session) and the values are the reports (see
+        eloc.fix_chan_name.reconcile_chan_name), or None if there is no xltek
+        file (the channels are renamed anyway)
+    """
+    by_xltek = {}
+    for subj, sess, dir_names in jobs:
+        xltek_chan_file = join(dir_names['doc_elec'], 'xltek_elec_names.csv')
+        by_xltek.setdefault(xltek_chan_file, []).append((subj, sess,
+                                                         dir_names))
+
+    reports = {}
+    for xltek_chan_file, xltek_jobs in by_xltek.items():
+        all_sess = {sess for _, sess, _ in xltek_jobs}
+        if exists(xltek_chan_file):
+            xltek_chan_name = read_consensus(xltek_chan_file, all_sess)
+        else:
+            lg.warning('No xltek names in ' + xltek_chan_file)
+            xltek_chan_name = None
+
+        for subj, sess, dir_names in xltek_jobs:
+            adj_elec_file = join(dir_names['doc_elec'], subj +
+                                 '_elec_pos-adjusted_sess' + sess + '.csv')
+            names_elec_file = join(dir_names['doc_elec'], subj +
+                                   '_elec_pos-names_sess' + sess + '.csv')
+            report_file = (splitext(xltek_chan_file)[0] + '_sess' + sess +
+                           '_report')
+
+            try:
+                chan = ChanTable.from_file(adj_elec_file)
+            except (FileNotFoundError, OSError) as err:
+                lg.warning(err)
+                continue
+
+            try:
+                rename_chan(chan, subj, sess)
+            except ValueError as err:
+                lg.warning(subj + ': ' + str(err))
+                continue
+            chan.export(names_elec_file)
+
+            if xltek_chan_name is None:
+                reports[subj, sess] = None
+                continue
+
+            report = reconcile_chan_name(chan.return_label(),
+                                         *xltek_chan_name[sess])
+            write_report(report, report_file)
+            reports[subj, sess] = report
+
+    print_summary(reports)
+    if summary_file is not None:
+        write_summary(reports, summary_file)
+
+    return reports
+
+
+def read_consensus(xltek_chan_file, all_sess):
+    """Read the xltek names once and compute the consensus for each session.
+
+    Parameters
+    ----------
+    xltek_chan_file : path to file
+        a cvs file, where each row contains the channel names
+    all_sess : iterable of str
+        sessions of interest
+
+    Returns
+    -------
+    dict
+        for each session, the list of the most common channel names and the
+        fraction of datasets that agree with each of them
+    """
+    consensus = {sess: ChanNameConsensus(sess) for sess in all_sess}
+    with open(xltek_chan_file, newline='', encoding='utf-8') as f:
+        for row in reader(f):
+            for one_consensus in consensus.values():
+                one_consensus.add_row(row)
+
+    return {sess: x.consensus() for sess, x in consensus.items()}
+
+
+def print_summary(reports):
+    """Print the number of mismatches for each subject and session."""
+    header = '{:<8}{:<6}' + '{:>15}' * len(SUMMARY_COLUMNS)
+    print(header.format('subj', 'sess', *SUMMARY_COLUMNS))
+    for (subj, sess), report in sorted(reports.items()):
+        if report is None:
+            print('{:<8}{:<6}'.format(subj, sess) + NO_XLTEK)
+        else:
+            print(header.format(subj, sess,
+                                *[len(report[x]) for x in SUMMARY_COLUMNS]))
+
+
+def write_summary(reports, summary_file):
+    """Write the number of channels in each group as csv (empty if there is
+    no xltek file, see the column 'status')."""
+    with open(summary_file, 'w', newline='', encoding='utf-8') as f:
+        csv_file = writer(f)
+        csv_file.writerow(('subj', 'sess', 'status') + SUMMARY_COLUMNS)
+        for (subj, sess), report in sorted(reports.items()):
+            if report is None:
+                csv_file.writerow([subj, sess, NO_XLTEK] +
+                                  [''] * len(SUMMARY_COLUMNS))
+            else:
+                csv_file.writerow([subj, sess, 'ok'] +
+                                  [len(report[x]) for x in SUMMARY_COLUMNS])
@@ -1,74 +1,198 @@
+from glob import glob
+from json import dump, load
+from logging import getLogger
+from os import makedirs
 from os.path import join, exists
-from subprocess import check_call
 from tempfile import mkdtemp
 
-from phypno.attr.chan import find_chan_in_region, assign_region_to_channels
+from numpy import zeros
 from phypno.viz.plot_3d import Viz3
 
-from .snap_grid_to_pial import is_on_pial
+from .chan_table import ChanTable
+from .regions import get_region_lookup
+from .render import render_to_file, SKIN_COLOR
+from .snap_grid_to_pial import get_pial_classifier
+from .surf_cache import file_hash
+from .tools import ToolRunner, run_tool
+from .trace import traced
 
+lg = getLogger(__name__)
 
 ROTATE_STEP = 5
 HEMI_TOL = 5  # tolerance for electrodes in one or the other hemisphere
 
+MORPH_MAPS = ('freesurfer-fsaverage-morph.fif',
+              'fsaverage-freesurfer-morph.fif')
+MORPH_STAMP = '.freesurfer-fsaverage-morph.json'
 
-def create_morph_maps(proc_dir):
-    if exists(join(proc_dir, 'freesurfer')):
-        cmd = []
-        cmd.append('export SUBJECTS_DIR=' + proc_dir)
-        cmd.append('mne_make_morph_maps --from freesurfer --to fsaverage --redo')
-        check_call('; '.join(cmd), shell=True)
+MAX_APPROX = 3  # in voxels
+EXCLUDE_REGIONS = ('White', 'WM', 'Unknown')
 
 
-def plot_rotating_brains(chan, anat, gif_file, subj):
+@traced
+def create_morph_maps(proc_dir, force=False):
+    """Create the morph maps between the subject and fsaverage, if needed.
+
+    Parameters
+    ----------
+    proc_dir : path to dir
+        directory with 'freesurfer' and 'fsaverage' (used as SUBJECTS_DIR)
+    force : bool
+        create the morph maps even if they are up to date
+
+    Returns
+    -------
+    bool
+        True if the morph maps were created, False if they were up to date
+        (or if there is no freesurfer directory).
+
+    Notes
+    -----
+    The morph maps only depend on the spherical registration of the two
+    subjects. The hashes of those files and of the morph maps are stored next
+    to the morph maps, so that they are only recomputed when they are stale.
+    Call this function once per subject, not once per session.
+    """
+    if not exists(join(proc_dir, 'freesurfer')):
+        return False
+
+    morph_dir = join(proc_dir, 'morph-maps')
+    stamp_file = join(morph_dir, MORPH_STAMP)
+
+    sources = {}
+    for subj in ('freesurfer', 'fsaverage'):
+        for hemi in ('lh', 'rh'):
+            surf_file = join(proc_dir, subj, 'surf', hemi + '.sphere.reg')
+            sources[surf_file] = _hash_or_none(surf_file)
+
+    if not force and exists(stamp_file):
+        with open(stamp_file) as f:
+            stamp = load(f)
+        outputs = {x: _hash_or_none(join(morph_dir, x)) for x in MORPH_MAPS}
+        if (stamp['sources'] == sources and stamp['outputs'] == outputs and
+                None not in outputs.values()):
+            lg.debug('morph maps are up to date in ' + morph_dir)
+            return False
+
+    makedirs(morph_dir, exist_ok=True)
+    run_tool(['mne_make_morph_maps', '--from', 'freesurfer', '--to',
+              'fsaverage', '--redo'], env={'SUBJECTS_DIR': proc_dir},
+             log_file=join(morph_dir, 'mne_make_morph_maps.log'))
+
+    stamp = {'sources': sources,
+             'outputs': {x: _hash_or_none(join(morph_dir, x))
+                         for x in MORPH_MAPS},
+             }
+    with open(stamp_file, 'w') as f:
+        dump(stamp, f, indent=2)
+
+    return True
+
+
+def _hash_or_none(file_name):
+    if exists(file_name):
+        return file_hash(file_name)
+
+
+@traced
+def plot_rotating_brains(chan, anat, gif_file, subj, offscreen=True):
     """Plot the two hemispheres including the electrodes.
 
     Parameters
     ----------
     chan : instance of phypno.attr.chan.Channels
         channels to plot
-    anat : instance of phypno.attr.anat.Freesurfer
-        anatomy to plot
+    anat : instance of eloc.anat_cache.SharedAnatomy
+        anatomy to plot (or phypno.attr.anat.Freesurfer)
     gif_file : str
         name of the gif image.
     subj : str
         subject code, used to define which channels are on the pial surface
+    offscreen : bool
+        render the frames off-screen (no GUI is necessary). If False, it uses
+        phypno's Viz3 and Imagemagick.
+
+    Notes
+    -----
+    The hemispheres are rendered one after the other: this runs in a batch
+    worker which counts as one memory-heavy step (see eloc.batch).
     """
     hemi_chan = {}
     hemi_chan['lh'] = chan(lambda x: x.xyz[0] < HEMI_TOL)
     hemi_chan['rh'] = chan(lambda x: x.xyz[0] > -HEMI_TOL)
 
-    for hemi, one_hemi_chan in hemi_chan.items():
+    on_pial = get_pial_classifier(subj)
+    def is_on_pial_for_subj(x): return on_pial(x.label)
+    def is_neuroport(x): return x.label.lower() == 'neuroport'
+    def is_not_on_pial_for_subj(x): return not on_pial(x.label)
+
+    brain = anat.read_brain()
+
+    if offscreen:
+        for hemi, one_hemi_chan in hemi_chan.items():
+            surf = getattr(brain, hemi)
+            chan_groups = [
+                (_return_xyz(one_hemi_chan(is_on_pial_for_subj)),
+                 (1, 0, 0, 1)),
+                (_return_xyz(one_hemi_chan(is_neuroport)), (0, 1, 0, 1)),
+                (_return_xyz(one_hemi_chan(is_not_on_pial_for_subj)),
+                 (0, 0, 1, 1)),
+                ]
+            render_to_file(surf.vert, surf.tri, chan_groups, _angles(hemi),
+                           gif_file.replace('XX', hemi))
+        return
+
+    with ToolRunner() as runner:
+        gifs = []
+        for hemi, one_hemi_chan in hemi_chan.items():
+            chan_groups = [
+                (one_hemi_chan(is_on_pial_for_subj), (1, 0, 0, 1)),
+                (one_hemi_chan(is_neuroport), (0, 1, 0, 1)),
+                (one_hemi_chan(is_not_on_pial_for_subj), (0, 0, 1, 1)),
+                ]
+            # the gif of one hemisphere is encoded while plotting the other
+            gifs.append(_plot_hemi(getattr(brain, hemi), chan_groups,
+                                   gif_file.replace('XX', hemi), runner))
+    for future in gifs:
+        future.result()
+
+
+def _plot_hemi(surf, chan_groups, gif_file, runner):
+    """Plot one hemisphere with Viz3 and start encoding its gif."""
+    fig = Viz3()
+
+    for one_chan, color in chan_groups:
+        if isinstance(one_chan, ChanTable):  # Viz3 needs phypno's Channels
+            one_chan = one_chan.to_channels()
+        fig.add_chan(one_chan, color=color)
+    # for some weird reasons, surf has to go after channels
+    fig.add_surf(surf, color=SKIN_COLOR)
 
-        surf = getattr(anat.read_brain(), hemi)
+    fig._plt.view.camera.elevation = 0
+    return _rotate_brain(fig, gif_file, runner)
 
-        fig = Viz3()
 
-        def is_on_pial_for_subj(x): return is_on_pial(subj, x)
-        fig.add_chan(one_hemi_chan(is_on_pial_for_subj),
-                     color=(1, 0, 0, 1))
-        fig.add_chan(one_hemi_chan(lambda x: x.label.lower() == 'neuroport'),
-                     color=(0, 1, 0, 1))
+def _return_xyz(chan):
+    """Positions of the channels, also when there are no channels."""
+    if chan.n_chan == 0:
+        return zeros((0, 3))
+    return chan.return_xyz()
 
-        def is_not_on_pial_for_subj(x): return not is_on_pial(subj, x)
-        fig.add_chan(one_hemi_chan(is_not_on_pial_for_subj),
-                     color=(0, 0, 1, 1))
-        # for some weird reasons, surf has to go after channels
-        SKIN_COLOR = (.94, .82, .81, .5)
-        fig.add_surf(surf, color=SKIN_COLOR)
 
-        fig._plt.view.camera.elevation = 0
-        _rotate_brain(fig, gif_file.replace('XX', hemi))
-        # fig._widget.hide()
+def _angles(hemi):
+    if hemi == 'rh':
+        return range(180, -180, -ROTATE_STEP)
+    if hemi == 'lh':
+        return range(-180, 180, ROTATE_STEP)
 
 
-def _rotate_brain(fig, gif_file):
+def _rotate_brain(fig, gif_file, runner=None):
     img_dir = mkdtemp()
 
     if 'rh' in gif_file:
-        angles = range(180, -180, -ROTATE_STEP)
+        angles = _angles('rh')
     if 'lh' in gif_file:
-        angles = range(-180, 180, ROTATE_STEP)
+        angles = _angles('lh')
     IMAGE = 'image%09d.jpg'
 
     for i, ang in enumerate(angles):
@@ -76,10 +200,10 @@ def _rotate_brain(fig, gif_file):
 
         fig.save(join(img_dir, IMAGE % i))
 
-    _make_gif(img_dir, gif_file)
+    return _make_gif(img_dir, gif_file, runner)
 
 
-def _make_gif(img_dir, gif_file):
+def _make_gif(img_dir, gif_file, runner=None):
     """Save the image as rotating gif.
     Parameters
     ----------
@@ -87,14 +211,20 @@ def _make_gif(img_dir, gif_file):
     directory with all the imags
     gif_file : path to file
     file where you want to save the gif
+    runner : instance of eloc.tools.ToolRunner, optional
+    if specified, the gif is encoded in the background (it returns a future)
     Notes
     -----
     It requires ''convert'' from Imagemagick
     """
-    check_call('convert ' + join(img_dir, 'image*.jpg') + ' ' + gif_file,
-               shell=True)
+    args = (['convert'] + sorted(glob(join(img_dir, 'image*.jpg'))) +
+            [gif_file])
+    if runner is None:
+        return run_tool(args)
+    return runner.submit(args)
 
 
+@traced
 def make_table_of_regions(chan, anat, wiki_table, subj):
     """Write location of the channels as wiki page.
 
@@ -102,19 +232,23 @@ def make_table_of_regions(chan, anat, wiki_table, subj):
     ----------
     chan : instance of phypno.attr.chan.Channels
         channels to plot
-    anat : instance of phypno.attr.anat.Freesurfer
-        anatomy to plot
+    anat : instance of eloc.anat_cache.SharedAnatomy
+        anatomy to plot (or phypno.attr.anat.Freesurfer)
     wiki_table : str
         path to write wiki table.
     subj : str
         subject code, used to define which channels are on the pial surface
     """
-    assign_region_to_channels(chan, anat, max_approx=3,
-                              exclude_regions=('White', 'WM', 'Unknown'))
+    assign_regions(chan, anat)
     neuroport = chan(lambda x: x.label.lower() == 'neuroport')
 
-    def is_not_on_pial_for_subj(x): return not is_on_pial(subj, x)
-    depth_chan = chan(is_not_on_pial_for_subj)
+    _, depth_chan = get_pial_classifier(subj).split(chan)
+
+    # group-by region, only for depth channels
+    chan_in_region = {}
+    for one_chan in depth_chan.chan:
+        chan_in_region.setdefault(one_chan.attr['region'],
+                                  []).append(one_chan.label)
 
     with open(wiki_table, 'w') as f:
 
@@ -122,12 +256,27 @@ def make_table_of_regions(chan, anat, wiki_table, subj):
             f.write('Neuroport in ' + neuroport.chan[0].attr['region'] + '\n')
 
         f.write('\n^ Regions ^ Electrodes ^\n')
-        for region in sorted(set(depth_chan.return_attr('region'))):
-            chan_in_region = find_chan_in_region(depth_chan, anat, region)
-            f.write('| {} | {} |\n'.format(region, ', '.join(chan_in_region)))
+        for region in sorted(chan_in_region):
+            f.write('| {} | {} |\n'.format(region,
+                                           ', '.join(chan_in_region[region])))
 
         f.write('\n^ Electrode ^ Distance ^ Regions ^ Quality (0-good, 4-bad) ^ \n')
         for one_chan in depth_chan.chan:
             f.write('| {0} | {1} | {2} |\n'.format(one_chan.label,
                                                    one_chan.attr['approx'],
                                                    one_chan.attr['region']))
+
+
+def assign_regions(chan, anat):
+    """Store the region of each channel in its attributes.
+
+    Parameters
+    ----------
+    chan : instance of phypno.attr.chan.Channels
+        channels (modified in place, attr 'region' and 'approx')
+    anat : instance of eloc.anat_cache.SharedAnatomy
+        anatomy of the subject
+    """
+    region_lookup = get_region_lookup(str(anat.dir))
+    region_lookup.assign_region_to_channels(chan, max_approx=MAX_APPROX,
+                                            exclude_regions=EXCLUDE_REGIONS)
@@ -0,0 +1,372 @@
+"""Electrode positions of the whole cohort, in one columnar store.
+
+Each column (subject, session, stage, label, position, class, region and
+approximation) is a .npy file, which is memory-mapped when it's read, so that
+group-level queries do not need to parse hundreds of csv files.
+
+An update only writes the rows of one subject, session and stage, as a small
+segment file with a unique name, so the workers do not wait for each other
+and do not copy the whole cohort. The segments are applied on top of the
+columns when the store is read. compact() merges the segments into a new
+version of the columns (in a new directory) and then points the file CURRENT
+to it. It keeps the previous version, and the readers start again if the
+version changes while they read, so they always see a complete version.
+"""
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from json import dump, load as load_json
+from logging import getLogger
+from os import getpid, replace
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from time import time_ns
+
+from numpy import (arange, argsort, asarray, bincount, char, concatenate,
+                   cumsum, empty, float64, isin, load, nan, save, savez,
+                   split, unique)
+
+from .chan_table import ChanTable
+from .snap_grid_to_pial import get_pial_classifier
+
+lg = getLogger(__name__)
+
+STAGES = ('orig', 'adjusted', 'names')
+STRING_COLUMNS = ('subj', 'sess', 'stage', 'label', 'region')
+COLUMNS = STRING_COLUMNS + ('xyz', 'pial', 'approx')
+INDEXED_COLUMNS = ('subj', 'sess', 'stage', 'region')
+
+SEGMENT_DIR = 'segments'
+SYNCED_DIR = 'synced'
+MANIFEST = 'segments.json'  # segments included in a version
+N_RETRY = 5  # times a reader starts again when the store is compacted
+
+
+class ElecStore:
+    """Columnar store of the electrode positions of all the subjects.
+
+    Parameters
+    ----------
+    store_dir : path to dir
+        directory of the store (it's created if it does not exist)
+
+    Notes
+    -----
+    The columns are:
+      - 'subj', 'sess', 'stage' ('orig', 'adjusted' or 'names'), 'label' and
+        'region' (empty if unknown) as strings
+      - 'xyz' as n_rows X 3 matrix
+      - 'pial' (True for grid and strips) as bool
+      - 'approx' (distance in voxels used to find the region, nan if unknown)
+
+    The store directory contains the versions of the columns (v*), the file
+    CURRENT with the name of the current version and the segments not yet
+    compacted (segments/<subj>/<sess>/<stage>/*.npz, the latest one of each
+    stage is used).
+    """
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self._state = None
+        self._columns = None
+        self._indexes = {}
+
+    @property
+    def columns(self):
+        """dict with the columns of the current version (memory-mapped) and
+        the segments written after it"""
+        state = (self._current(), tuple(self._segments()))
+        if self._columns is None or state != self._state:
+            self._columns = self._read()[0]
+            self._state = state
+            self._indexes = {}
+        return self._columns
+
+    def __len__(self):
+        return len(self.columns['label'])
+
+    def update(self, subj, sess, stage, chan):
+        """Replace the channels of one subject, session and stage.
+
+        Parameters
+        ----------
+        subj : str
+            subject code
+        sess : str
+            session: 'A', 'B', 'C', ...
+        stage : str
+            'orig', 'adjusted' or 'names'
+        chan : instance of ChanTable or phypno.attr.chan.Channels
+            channels (the attributes 'region' and 'approx' are stored, if
+            present)
+
+        Notes
+        -----
+        It only writes the rows of this subject, session and stage (see
+        compact), so it does not need the lock.
+        """
+        if stage not in STAGES:
+            raise ValueError('Unknown stage "' + stage + '"')
+        if not isinstance(chan, ChanTable):
+            chan = ChanTable.from_channels(chan)
+
+        seg_dir = self.store_dir.joinpath(SEGMENT_DIR, subj, sess, stage)
+        seg_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_file = mkstemp(dir=str(seg_dir), prefix='.tmp',
+                               suffix='.npz')
+        with open(fd, 'wb') as f:
+            savez(f, **_rows(subj, sess, stage, chan))
+        # names sort by time, so the latest segment is the last one
+        seg_name = '{:020d}-{}.npz'.format(time_ns(), getpid())
+        seg_file = seg_dir.joinpath(seg_name)
+        replace(tmp_file, str(seg_file))  # atomic
+
+        lg.debug('store: {} rows for {} sess{} {}'.format(chan.n_chan, subj,
+                                                          sess, stage))
+
+    def compact(self):
+        """Merge the segments into a new version of the columns.
+
+        Notes
+        -----
+        The previous version is kept, for the readers which have just read
+        CURRENT. The older versions and the merged segments are removed.
+        """
+        with self.lock():
+            old_version = self._current()
+            columns, seen = self._read()
+            if not seen:
+                return
+
+            version_dir = Path(mkdtemp(dir=str(self.store_dir), prefix='v'))
+            for name in COLUMNS:
+                save(str(version_dir.joinpath(name + '.npy')), columns[name])
+            with version_dir.joinpath(MANIFEST).open('w') as f:
+                dump(seen, f)
+            self._point_to(version_dir.name)
+
+            # the segments are in the new version, so the readers who miss
+            # them see that CURRENT has changed and start again
+            for seg_file in seen:
+                try:
+                    self.store_dir.joinpath(seg_file).unlink()
+                except FileNotFoundError:
+                    pass
+            for one_dir in self.store_dir.glob('v*'):
+                if one_dir.name not in (version_dir.name, old_version):
+                    rmtree(str(one_dir), ignore_errors=True)
+
+        lg.debug('store: compacted {} segments'.format(len(seen)))
+
+    def sync_file(self, subj, sess):
+        """File which marks that one session was written to this store (it
+        can be used as output of the stage that writes to the store)."""
+        return self.store_dir.joinpath(SYNCED_DIR, subj + '_sess' + sess)
+
+    def index(self, column):
+        """Rows for each value of one column.
+
+        Parameters
+        ----------
+        column : str
+            one of 'subj', 'sess', 'stage', 'region'
+
+        Returns
+        -------
+        dict
+            from each value to the array of indices of its rows
+        """
+        columns = self.columns
+        if column not in self._indexes:
+            values, inverse = unique(columns[column], return_inverse=True)
+            rows = argsort(inverse, kind='stable')
+            groups = split(rows, cumsum(bincount(inverse))[:-1])
+            self._indexes[column] = dict(zip(values, groups))
+        return self._indexes[column]
+
+    def select(self, pial=None, **criteria):
+        """Select the rows with the given values.
+
+        Parameters
+        ----------
+        pial : bool, optional
+            only channels on the pial surface (True) or only depth (False)
+        **criteria
+            column name ('subj', 'sess', 'stage', 'region') and value, or list
+            of values
+
+        Returns
+        -------
+        numpy.ndarray
+            indices of the selected rows
+        """
+        rows = arange(len(self))
+        for column, values in criteria.items():
+            if column not in INDEXED_COLUMNS:
+                raise ValueError('Cannot select on "' + column + '"')
+            if isinstance(values, str):
+                values = (values, )
+            index = self.index(column)
+            selected = [index[x] for x in values if x in index]
+            if not selected:
+                return rows[:0]
+            selected = unique(concatenate(selected))
+            rows = rows[isin(rows, selected, assume_unique=True)]
+
+        if pial is not None:
+            rows = rows[self.columns['pial'][rows] == pial]
+        return rows
+
+    def to_table(self, rows):
+        """Convert rows of the store into channels.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            indices of the rows (see select)
+
+        Returns
+        -------
+        instance of ChanTable
+            channels, with attributes 'subj', 'sess', 'stage', 'pial',
+            'region' and 'approx'
+        """
+        columns = self.columns
+        attr = {name: columns[name][rows]
+                for name in ('subj', 'sess', 'stage', 'pial', 'region',
+                             'approx')}
+        return ChanTable(columns['label'][rows], columns['xyz'][rows, :], attr)
+
+    def export(self, subj, sess, stage, elec_file):
+        """Write the channels of one subject, session and stage as csv.
+
+        Parameters
+        ----------
+        subj : str
+            subject code
+        sess : str
+            session: 'A', 'B', 'C', ...
+        stage : str
+            'orig', 'adjusted' or 'names'
+        elec_file : path to file
+            csv file, like *_elec_pos-adjusted_sessA.csv
+        """
+        rows = self.select(subj=subj, sess=sess, stage=stage)
+        self.to_table(rows).export(elec_file)
+
+    @contextmanager
+    def lock(self):
+        """Exclusive lock across processes, for compacting."""
+        with self.store_dir.joinpath('.lock').open('a') as f:
+            flock(f, LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(f, LOCK_UN)
+
+    def _current(self):
+        try:
+            return self.store_dir.joinpath('CURRENT').read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def _point_to(self, version):
+        fd, tmp_file = mkstemp(dir=str(self.store_dir), prefix='.tmp')
+        with open(fd, 'w') as f:
+            f.write(version)
+        replace(tmp_file, str(self.store_dir.joinpath('CURRENT')))  # atomic
+
+    def _segments(self):
+        """Segment files, relative to the store, sorted by time within each
+        subject, session and stage."""
+        seg_dir = self.store_dir.joinpath(SEGMENT_DIR)
+        return sorted(str(x.relative_to(self.store_dir))
+                      for x in seg_dir.glob('*/*/*/*.npz'))
+
+    def _read(self):
+        """Read the current version and apply the segments.
+
+        Returns
+        -------
+        dict
+            the columns
+        list of str
+            all the segment files (relative to the store) in the columns
+        """
+        for i in range(N_RETRY + 1):
+            version = self._current()
+            try:
+                columns, seen = self._read_version(version)
+            except FileNotFoundError:  # removed by compact
+                if i == N_RETRY:
+                    raise
+                continue
+            if version == self._current() or i == N_RETRY:
+                return columns, seen
+
+    def _read_version(self, version):
+        columns = self._load(version)
+        if version is None:
+            included = set()
+        else:
+            with self.store_dir.joinpath(version, MANIFEST).open() as f:
+                included = set(load_json(f))
+
+        seen = []
+        latest = {}
+        for seg_file in self._segments():
+            if seg_file in included:
+                continue
+            seen.append(seg_file)
+            latest[Path(seg_file).parent] = seg_file  # sorted by time
+
+        if latest:
+            segments = []
+            for seg_file in latest.values():
+                with load(str(self.store_dir.joinpath(seg_file))) as npz:
+                    segments.append({name: npz[name] for name in COLUMNS})
+            new = {name: concatenate([x[name] for x in segments])
+                   for name in COLUMNS}
+            keep = ~isin(_key(columns), _key(new))
+            columns = {name: concatenate((columns[name][keep], new[name]))
+                       for name in COLUMNS}
+
+        return columns, seen
+
+    def _load(self, version):
+        if version is None:
+            columns = {name: asarray([], dtype=str)
+                       for name in STRING_COLUMNS}
+            columns['xyz'] = empty((0, 3))
+            columns['pial'] = empty(0, dtype=bool)
+            columns['approx'] = empty(0)
+            return columns
+
+        version_dir = self.store_dir.joinpath(version)
+        return {name: load(str(version_dir.joinpath(name + '.npy')),
+                           mmap_mode='r')
+                for name in COLUMNS}
+
+
+def _key(columns):
+    """subject, session and stage of each row, as one string"""
+    return char.add(char.add(char.add(columns['subj'].astype(str), '/'),
+                             char.add(columns['sess'].astype(str), '/')),
+                    columns['stage'].astype(str))
+
+
+def _rows(subj, sess, stage, chan):
+    n_chan = chan.n_chan
+    region = chan.return_attr('region')
+    approx = asarray([nan if x is None else x
+                      for x in chan.return_attr('approx')], dtype=float64)
+    return {'subj': asarray([subj] * n_chan, dtype=str),
+            'sess': asarray([sess] * n_chan, dtype=str),
+            'stage': asarray([stage] * n_chan, dtype=str),
+            'label': asarray(chan.return_label(), dtype=str),
+            'region': asarray(['' if x is None else x for x in region],
+                              dtype=str),
+            'xyz': chan.return_xyz().reshape(-1, 3),
+            'pial': get_pial_classifier(subj).classify(chan).astype(bool),
+            'approx': approx,
+            }
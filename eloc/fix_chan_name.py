@@ -1,307 +1,166 @@
-from csv import reader
-from itertools import zip_longest
-from os.path import splitext
-from statistics import mode
+from collections import Counter
+from csv import DictReader, reader, writer
+from functools import lru_cache
+from json import dump
+from os import stat
+from os.path import dirname, join, splitext
+from re import search
 
-from phypno.attr import Channels
+from .chan_table import ChanTable
+from .trace import traced
 
+RENAME_RULES = join(dirname(__file__), 'chan_name_rules.csv')
 
-def fix_chan_name(subj_code, elec_file, fixed_elec_file):
+
+@traced
+def fix_chan_name(subj_code, elec_file, fixed_elec_file,
+                  rules_file=RENAME_RULES):
     """Match channel names between elec loc and datasets
 
     It happens that some names are typed differently between the EEG recordings
     and the localization of the electrodes. For our analysis, they have to be
     identical. This function creates a new eeg file with the correct names.
 
-    It's very subject-specific, I don't want to over-generalize.
+    It's very subject-specific, I don't want to over-generalize. The rules
+    for each subject are in chan_name_rules.csv.
 
     """
-    chan = Channels(elec_file)
-
-    oldname = []
-    newname = []
-
-    if subj_code == 'EM09':
-        oldname.extend(['fgr{}'.format(x + 1) for x in range(16)])
-        newname.extend(['FGR{}'.format(x + 1) for x in range(16)])
-        oldname.extend(['ROF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['OFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RDF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['DFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RPF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['PFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RPT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['PTD{}'.format(x + 1) for x in range(8)])
-
-    if subj_code == 'MG17':
-        oldname.extend(['FPS{}'.format(x + 1) for x in range(16)])
-        newname.extend(['FrP{}'.format(x + 1) for x in range(16)])
-        oldname.extend(['SFS{}'.format(x + 1) for x in range(16)])
-        newname.extend(['SbFr{}'.format(x + 1) for x in range(16)])
-        oldname.extend(['STS{}'.format(x + 1) for x in range(16)])
-        newname.extend(['SbTp{}'.format(x + 1) for x in range(16)])
-        # not all
-
-    if subj_code == 'MG21':
-        oldname.extend(['LTP{}'.format(x) for x in [5, 6]])
-        newname.extend(['LPT{}'.format(x) for x in [5, 6]])
-
-    if subj_code == 'MG23':
-        oldname.extend(['RSbFr{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RSF{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RPFr{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RFR{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LSbFr{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LSF{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LPFr{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LFR{}'.format(x + 1) for x in range(8)])
-
-    if subj_code == 'MG25':
-        oldname.extend(['RSbFr{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RSF{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RFr{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RFR{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LSbFr{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LSF{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LFr{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LFR{}'.format(x + 1) for x in range(8)])
-
-    if subj_code == 'MG33':
-        oldname.extend(['Gr{}'.format(x + 1) for x in range(64)])
-        newname.extend(['GR{}'.format(x + 1) for x in range(64)])
-        oldname.extend(['Ref{}'.format(x + 1) for x in range(4)])
-        newname.extend(['REF{}'.format(x + 1) for x in range(4)])
-        # not all
-
-    if subj_code == 'MG37':
-        oldname.extend(['Gr{}'.format(x + 1) for x in range(64)])
-        newname.extend(['PGR{}'.format(x + 1) for x in range(64)])
-        oldname.extend(['AnGr{}'.format(x + 1) for x in range(16)])
-        newname.extend(['AGR{}'.format(x + 1) for x in range(16)])
-        # not all
-
-    if subj_code == 'MG63':
-        oldname.extend(['GR{}'.format(x + 1) for x in range(64)])
-        newname.extend(['AGR{}'.format(x + 1) for x in range(64)])
-        oldname.extend(['gr{}'.format(x + 1) for x in range(32)])
-        newname.extend(['PGR{}'.format(x + 1) for x in range(32)])
-        # not all
-
-    if subj_code == 'MG59':
-        oldname.extend(['RPT{}'.format(x) for x in range(1, 65)])
-        newname.extend(['RTP{}'.format(x) for x in range(1, 65)])
-        # some are missing, one chan is written twice
-
-    if subj_code == 'MG61':
-        oldname.extend(['AGR{}'.format(x) for x in range(1, 65)])
-        newname.extend(['GR{}'.format(x) for x in range(1, 65)])
-
-    if subj_code == 'MG62':
-        oldname.extend(['LFO5'])
-        newname.extend(['LOF5'])
-
-    if subj_code == 'MG63':
-        oldname.extend(['GR{}'.format(x) for x in range(1, 65)])
-        newname.extend(['AGR{}'.format(x) for x in range(1, 65)])
-        oldname.extend(['gr{}'.format(x) for x in range(1, 65)])
-        newname.extend(['PGR{}'.format(x) for x in range(1, 65)])
-        oldname.extend(['RAT{}'.format(x) for x in range(1, 9)])
-        newname.extend(['ATD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['RMT{}'.format(x) for x in range(1, 9)])
-        newname.extend(['MTD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['RPF{}'.format(x) for x in range(1, 9)])
-        newname.extend(['PFD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['ROF{}'.format(x) for x in range(1, 9)])
-        newname.extend(['OFD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['AST{}'.format(x) for x in range(1, 9)])
-        newname.extend(['ATS{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['PST{}'.format(x) for x in range(1, 9)])
-        newname.extend(['PTS{}'.format(x) for x in range(1, 9)])
-        # no location for PTD
-
-    if subj_code == 'MG64':
-        # this is based on sess B only
-        oldname.extend(['GR{}'.format(x) for x in range(1, 65)])
-        newname.extend(['SGR{}'.format(x) for x in range(1, 65)])
-        oldname.extend(['FPgr{}'.format(x) for x in range(1, 17)])
-        newname.extend(['FPG{}'.format(x) for x in range(1, 17)])
-        oldname.extend(['tgr{}'.format(x) for x in range(1, 17)])
-        newname.extend(['IGR{}'.format(x) for x in range(1, 17)])
-        oldname.extend(['SFgr{}'.format(x) for x in range(1, 17)])
-        newname.extend(['SFG{}'.format(x) for x in range(1, 17)])
-        oldname.extend(['AIS{}'.format(x) for x in range(1, 9)])
-        newname.extend(['AIH{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['PIS{}'.format(x) for x in range(1, 9)])
-        newname.extend(['PIH{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['OFS{}'.format(x + 1) for x in range(8)])
-        newname.extend(['FPS{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['STS{}'.format(x + 1) for x in range(8)])
-        newname.extend(['ASTS{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RSF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['SFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['ROF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['OFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RDF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['DFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RPT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['PTD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RI{}'.format(x + 1) for x in range(8)])
-        newname.extend(['ID{}'.format(x + 1) for x in range(8)])
-
-    if subj_code == 'MG65':
-        newname.extend(['ASTS{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['ATS{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['PTS1'])
-        oldname.extend(['PSTS1'])
-        oldname.extend(['PST{}'.format(x) for x in range(2, 9)])
-        newname.extend(['PSTS{}'.format(x) for x in range(2, 9)])
-        oldname.extend(['LOF{}'.format(x) for x in range(1, 9)])
-        newname.extend(['OFD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['LAF{}'.format(x) for x in range(1, 9)])
-        newname.extend(['AFD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['LMF{}'.format(x) for x in range(1, 9)])
-        newname.extend(['MFD{}'.format(x) for x in range(1, 9)])
-        # some elec are missing locations
-
-    if subj_code == 'MG66':
-        oldname.extend(['sgr{}'.format(x) for x in range(1, 17)])
-        newname.extend(['FGR{}'.format(x) for x in range(1, 17)])
-        oldname.extend(['trg2'])
-        oldname.extend(['TGR2'])
-        oldname.extend(['tgr{}'.format(x) for x in range(1, 17)])
-        newname.extend(['TGR{}'.format(x) for x in range(1, 17)])
-        oldname.extend(['ATS{}'.format(x) for x in range(1, 9)])
-        newname.extend(['ASTS{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['PTS1'])
-        oldname.extend(['PSTS1'])
-        oldname.extend(['PST{}'.format(x) for x in range(2, 9)])
-        newname.extend(['PSTS{}'.format(x) for x in range(2, 9)])
-        oldname.extend(['LPF{}'.format(x) for x in range(1, 9)])
-        newname.extend(['PFD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['LOF{}'.format(x) for x in range(1, 9)])
-        newname.extend(['OFD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['LAT{}'.format(x) for x in range(1, 9)])
-        newname.extend(['ATD{}'.format(x) for x in range(1, 9)])
-        oldname.extend(['LPT{}'.format(x) for x in range(1, 9)])
-        newname.extend(['PTD{}'.format(x) for x in range(1, 9)])
-
-    if subj_code == 'MG67':
-        oldname = ['fgr{}'.format(x) for x in range(1, 17)]
-        newname = ['SFG{}'.format(x) for x in range(1, 17)]
-        oldname.extend(['RAT{}'.format(x) for x in range(1, 7)])
-        newname.extend(['ATD{}'.format(x) for x in range(1, 7)])
-        oldname.extend(['RPT{}'.format(x) for x in range(1, 7)])
-        newname.extend(['PTD{}'.format(x) for x in range(1, 7)])
-        oldname.extend(['AST{}'.format(x) for x in range(1, 7)])
-        newname.extend(['ASTS{}'.format(x) for x in range(1, 7)])
-        oldname.extend(['PST{}'.format(x) for x in range(1, 7)])
-        newname.extend(['PSTS{}'.format(x) for x in range(1, 7)])
-        oldname.extend(['ROF{}'.format(x) for x in range(1, 7)])
-        newname.extend(['OFD{}'.format(x) for x in range(1, 7)])
-        oldname.extend(['RPF{}'.format(x) for x in range(1, 7)])
-        newname.extend(['PFD{}'.format(x) for x in range(1, 7)])
-        oldname.extend(['RDF{}'.format(x) for x in range(1, 7)])
-        newname.extend(['DFD{}'.format(x) for x in range(1, 7)])
-        oldname.extend(['SS{}'.format(x) for x in range(1, 9)])
-        newname.extend(['SYDS{}'.format(x) for x in range(1, 9)])
-
-    if subj_code == 'MG68':
-        oldname = ['LM{}'.format(x) for x in range(1, 9)]
-        newname = ['LMF{}'.format(x) for x in range(1, 9)]
-        oldname.extend(['RM{}'.format(x) for x in range(1, 9)])
-        newname.extend(['RMF{}'.format(x) for x in range(1, 9)])
-        oldname.append('LPT4 ')  # space
-        newname.append('LPT4')
-
-    if subj_code == 'MG72':
-        oldname.extend(['stGR{}'.format(x) for x in range(1, 17)])
-        newname.extend(['FGR{}'.format(x) for x in range(1, 17)])
-        # not all
-
-    if subj_code == 'MG73':
-        oldname.append('LFM3')
-        newname.append('LMF3')
-        oldname.append('MRF3')
-        newname.append('RMF3')
-
-    if subj_code == 'MG74':
-        oldname.append('RPF2')
-        newname.append('ROF2')
-
-    if subj_code == 'MG82' and '_sessA.csv' in elec_file:
-        oldname.extend(['LINS{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LIF{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RINS{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RIF{}'.format(x + 1) for x in range(8)])
-
-    if subj_code == 'MG82' and '_sessB.csv' in elec_file:
-        oldname.extend(['LAT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LATD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LPT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LPTD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LOF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LOFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LMF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LMFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LPF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LPFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RAT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RATD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RPT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RPTD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['ROF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['ROFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RMF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RMFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RPF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RPFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LAC{}'.format(x + 1) for x in range(4)])
-        newname.extend(['LACS{}'.format(x + 1) for x in range(4)])
-        oldname.extend(['LIC{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LICS{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LMC{}'.format(x + 1) for x in range(8)])
-        newname.extend(['LMCS{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RAC{}'.format(x + 1) for x in range(4)])
-        newname.extend(['RACS{}'.format(x + 1) for x in range(4)])
-        oldname.extend(['RIC{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RICS{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['RMC{}'.format(x + 1) for x in range(8)])
-        newname.extend(['RMCS{}'.format(x + 1) for x in range(8)])
-
-    if subj_code == 'MG91':
-        oldname.extend(['LAT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['ATD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LMT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['MTD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LPT{}'.format(x + 1) for x in range(8)])
-        newname.extend(['PTD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LAO{}'.format(x + 1) for x in range(8)])
-        newname.extend(['AOD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LMO{}'.format(x + 1) for x in range(8)])
-        newname.extend(['MOD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LPO{}'.format(x + 1) for x in range(8)])
-        newname.extend(['POD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LAF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['AFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LMF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['MFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LPF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['PFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LOF{}'.format(x + 1) for x in range(8)])
-        newname.extend(['OFD{}'.format(x + 1) for x in range(8)])
-        oldname.extend(['LATS{}'.format(x + 1) for x in range(4)])
-        newname.extend(['ATS{}'.format(x + 1) for x in range(4)])
-        oldname.extend(['LPTS{}'.format(x + 1) for x in range(4)])
-        newname.extend(['PTS{}'.format(x + 1) for x in range(4)])
-
-    for one_oldname, one_newname in zip(oldname, newname):
-        for one_chan in chan.chan:
-            if one_chan.label == one_oldname:
-                one_chan.label = one_newname
+    chan = ChanTable.from_file(elec_file)
+
+    sess = search(r'_sess([^_]+)\.csv$', elec_file)
+    if sess is not None:
+        sess = sess.group(1)
+
+    rename_chan(chan, subj_code, sess, rules_file)
 
     chan.export(fixed_elec_file)
 
 
+def rename_chan(chan, subj_code, sess=None, rules_file=RENAME_RULES):
+    """Rename the channels, in place, in one pass.
+
+    Parameters
+    ----------
+    chan : instance of Channels
+        channels to rename
+    subj_code : str
+        subject code
+    sess : str, optional
+        session: 'A', 'B', 'C', ...
+    rules_file : path to file
+        csv file with the rules to rename the channels
+
+    Returns
+    -------
+    instance of Channels
+        the same channels, with the new names
+
+    Raises
+    ------
+    ValueError
+        if, after renaming, two channels have the same name (and they did not
+        before)
+    """
+    rules = read_rename_rules(rules_file)
+    new_names = rules.get((subj_code, sess), rules.get((subj_code, None), {}))
+
+    old_labels = [one_chan.label for one_chan in chan.chan]
+    new_labels = [new_names.get(label, label) for label in old_labels]
+
+    duplicates = _duplicates(new_labels) - _duplicates(old_labels)
+    if duplicates:
+        raise ValueError('After renaming, more channels are called ' +
+                         ', '.join(sorted(duplicates)))
+
+    for one_chan, label in zip(chan.chan, new_labels):
+        one_chan.label = label
+
+    return chan
+
+
+def _duplicates(labels):
+    seen = set()
+    duplicates = set()
+    for label in labels:
+        if label in seen:
+            duplicates.add(label)
+        seen.add(label)
+    return duplicates
+
+
+@lru_cache(maxsize=4)
+def read_rename_rules(rules_file=RENAME_RULES):
+    """Read the rules to rename channels and compile them into dicts.
+
+    Parameters
+    ----------
+    rules_file : path to file
+        csv file with columns subj, sess, old, new. Lines starting with # are
+        comments. Names can contain one range, like GR{1..64} or one list,
+        like LTP{5,6}.
+
+    Returns
+    -------
+    dict
+        the keys are (subject, session) and the values are dicts from old name
+        to new name. Rules that apply to all the sessions have session None
+        and they are also included in each session of the same subject.
+
+    Raises
+    ------
+    ValueError
+        if the rules are not consistent (f.e. one name becomes two names)
+
+    Notes
+    -----
+    All the channels are renamed at the same time, so the order of the rules
+    does not matter.
+    """
+    rules = {}
+    with open(str(rules_file), newline='', encoding='utf-8') as f:
+        lines = (line for line in f if not line.startswith('#'))
+        for row in DictReader(lines):
+            sess = row['sess'] if row['sess'] else None
+            one_subj = rules.setdefault((row['subj'], sess), {})
+
+            old_names = _expand_name(row['old'])
+            new_names = _expand_name(row['new'])
+            if len(old_names) != len(new_names):
+                raise ValueError('Different number of channels in ' +
+                                 row['old'] + ' and ' + row['new'])
+
+            for old, new in zip(old_names, new_names):
+                if one_subj.get(old, new) != new:
+                    raise ValueError('{} of {} is renamed to both {} and {}'
+                                     ''.format(old, row['subj'], one_subj[old],
+                                               new))
+                one_subj[old] = new
+
+    # rules for all the sessions are valid in each session
+    for (subj, sess), one_subj in rules.items():
+        if sess is not None:
+            for old, new in rules.get((subj, None), {}).items():
+                one_subj.setdefault(old, new)
+
+    return rules
+
+
+def _expand_name(name):
+    """Expand GR{1..64} and LTP{5,6} into a list of names."""
+    m = search('{([^}]*)}', name)
+    if m is None:
+        return [name]
+
+    values = m.group(1)
+    if '..' in values:
+        first, last = values.split('..')
+        values = [str(x) for x in range(int(first), int(last) + 1)]
+    else:
+        values = values.split(',')
+
+    return [name[:m.start()] + x + name[m.end():] for x in values]
+
+
 def get_mostcommon_chan_name(xltek_elec_name, sess=None):
     """Get the most common channels across xltek datasets.
 
@@ -309,6 +168,8 @@ def get_mostcommon_chan_name(xltek_elec_name, sess=None):
     ----------
     xltek_elec_name : path to file
         a cvs file, where each row contains the channel names
+    sess : str, optional
+        only use the datasets of this session
 
     Returns
     -------
@@ -321,23 +182,169 @@ def get_mostcommon_chan_name(xltek_elec_name, sess=None):
     one dataset is not correct. However, across all the datasets, the most
     common channel names are probably the right ones.
 
+    The file is read only once per process. If new datasets are appended to
+    the file, only the new rows are read.
+
+    """
+    return _read_consensus(xltek_elec_name, sess).consensus()[0]
+
+
+_consensus = {}
+
+
+def _read_consensus(xltek_elec_name, sess):
+    """Consensus of one file and session, updated with the new rows."""
+    key = (str(xltek_elec_name), sess)
+    if key not in _consensus:
+        _consensus[key] = ChanNameConsensus(sess)
+    consensus = _consensus[key]
+    consensus.read(xltek_elec_name)
+    return consensus
+
+
+class ChanNameConsensus:
+    """Most common channel name at each position, computed one row at a time.
+
+    Parameters
+    ----------
+    sess : str, optional
+        only use the datasets of this session
+
+    Notes
+    -----
+    It gives the same results as statistics.mode on each position. Datasets
+    with fewer channels count as None in the positions they don't have and
+    positions where None is the most common value are skipped.
     """
-    with open(xltek_elec_name, newline='', encoding='utf-8') as f:
-        csvinfo = reader(f)
-        all_chan = []
-        for row in csvinfo:
-            if sess is None or '_sess' + sess in row[0]:
-                all_chan.append([chan.strip() for chan in row[1:]])
+    def __init__(self, sess=None):
+        self.sess = sess
+        self.n_rows = 0
+        self.counts = []  # one Counter per position
+        self._file = None
+        self._stat = None  # inode, modification time and size, when read
+        self._offset = 0  # in bytes, after the last complete row
+        self._tail = None  # last row, if it does not end with a newline
+
+    def add_row(self, row):
+        """Add one row of the xltek file (dataset name, then channel names).
+        """
+        if self.sess is not None and '_sess' + self.sess not in row[0]:
+            return
+
+        names = [chan.strip() for chan in row[1:]]
+        for i in range(len(self.counts), len(names)):
+            counter = Counter()
+            if self.n_rows:
+                counter[None] = self.n_rows  # previous rows were shorter
+            self.counts.append(counter)
+
+        for i, counter in enumerate(self.counts):
+            counter[names[i] if i < len(names) else None] += 1
+        self.n_rows += 1
+
+    def remove_row(self, row):
+        """Remove one row that was added with add_row."""
+        if self.sess is not None and '_sess' + self.sess not in row[0]:
+            return
+
+        names = [chan.strip() for chan in row[1:]]
+        for i, counter in enumerate(self.counts):
+            name = names[i] if i < len(names) else None
+            counter[name] -= 1
+            if counter[name] == 0:
+                del counter[name]
+        self.n_rows -= 1
+        while self.counts and set(self.counts[-1]) <= {None}:
+            self.counts.pop()  # positions only in the removed row
+
+    def read(self, xltek_elec_name):
+        """Read the rows of the file that were not read yet.
+
+        Parameters
+        ----------
+        xltek_elec_name : path to file
+            a cvs file, where each row contains the channel names
+
+        Notes
+        -----
+        If the file was replaced (different inode) or modified without
+        appending to it (it did not grow), it's read from the start. The last
+        row is used also if it does not end with a newline, but it's read
+        again next time, in case the file was still being written.
+        """
+        xltek_elec_name = str(xltek_elec_name)
+        file_stat = stat(xltek_elec_name)
+        if self._file != xltek_elec_name or _is_rewritten(self._stat,
+                                                          file_stat):
+            self.__init__(self.sess)
+            self._file = xltek_elec_name
+        self._stat = file_stat
+
+        if self._tail is not None:
+            self.remove_row(self._tail)
+            self._tail = None
+
+        with open(xltek_elec_name, 'rb') as f:
+            f.seek(self._offset)
+            for line in f:
+                rows = list(reader([line.decode('utf-8')]))
+                if line.endswith(b'\n'):
+                    self._offset += len(line)
+                elif rows:
+                    self._tail = rows[0]
+                for row in rows:
+                    self.add_row(row)
+
+    def consensus(self):
+        """Most common channel names.
+
+        Returns
+        -------
+        list of str
+            list of channels based on the most common ones at each position.
+        list of float
+            for each channel, the fraction of datasets that agree with it.
+        """
+        mode_chan = []
+        agreement = []
+        for counter in self.counts:
+            mostcommon, n_common = counter.most_common(1)[0]
+            if mostcommon is not None:
+                mode_chan.append(mostcommon)
+                agreement.append(n_common / self.n_rows)
+
+        return mode_chan, agreement
+
+
+def _is_rewritten(old, new):
+    """Whether a file was changed in another way than by appending to it.
+    """
+    if old is None:
+        return False
+    return (new.st_ino != old.st_ino or new.st_size < old.st_size or
+            (new.st_mtime_ns != old.st_mtime_ns and
+             new.st_size == old.st_size))
+
 
-    mode_chan = []
-    for same_chan in zip_longest(*all_chan):
-        mostcommon = mode(same_chan)
-        if mostcommon is not None:
-            mode_chan.append(mostcommon)
+# everything stays upper-case
+NOGOOD = {'OSAT', 'PR'}  # I don't care about these channels
 
-    return mode_chan
+SCALP = {'FP1', 'FP2', 'F3', 'F4', 'F7', 'F8', 'T3', 'T4', 'T5',  'EVT',
+         'T6', 'O1', 'O2', 'F3', 'F4', 'C3', 'C4', 'P3', 'P4', 'FZ', 'CZ',
+         'OZ', 'PZ', 'C2', 'EKG', 'A1', 'A2', 'T1', 'T2', 'LOC', 'ROC',
+         'EMG1', 'EMG2',
+         'CII',
+         'FO1', 'FO2', 'FO3', 'FO4'}  # MG69: idk
 
+TRIGGER = {'TRIG', 'TRIG1', 'TRIG2', 'TGR2', 'TRIG/EMG', 'TRIG 1', 'TRIG 2'}
 
+REF = {'REF', 'REF1', 'REF2', 'REF3', 'REF4'}
+
+REPORT_GROUPS = ('matched', 'scalp', 'trigger', 'ref', 'unknown', 'missing',
+                 'case_mismatch')
+
+
+@traced
 def check_chan_name(chan, xltek_chan_file, sess):
     """Compare the channel names with the location names.
 
@@ -350,56 +357,141 @@ def check_chan_name(chan, xltek_chan_file, sess):
     sess : str
         session: 'A', 'B', 'C', ...
 
+    Returns
+    -------
+    dict
+        see reconcile_chan_name
+
     Notes
     -----
-    It writes the report to file.
+    It writes the report to file, as text, json and csv.
 
     """
-    report_file = splitext(xltek_chan_file)[0] + '_sess' + sess + '_report.txt'
+    report_file = splitext(xltek_chan_file)[0] + '_sess' + sess + '_report'
+
+    xltek_chan_name, agreement = _read_consensus(xltek_chan_file,
+                                                 sess).consensus()
+    report = reconcile_chan_name(chan.return_label(), xltek_chan_name,
+                                 agreement)
+    write_report(report, report_file)
 
-    pos_chan_name = chan.return_label()
-    xltek_chan_name = get_mostcommon_chan_name(xltek_chan_file, sess)
+    return report
 
-    # everything stays upper-case
-    nogood = ['OSAT', 'PR']  # I don't care about these channels
 
-    scalp = ['FP1', 'FP2', 'F3', 'F4', 'F7', 'F8', 'T3', 'T4', 'T5',  'EVT',
-             'T6', 'O1', 'O2', 'F3', 'F4', 'C3', 'C4', 'P3', 'P4', 'FZ', 'CZ',
-             'OZ', 'PZ', 'C2', 'EKG', 'A1', 'A2', 'T1', 'T2', 'LOC', 'ROC',
-             'EMG1', 'EMG2',
-             'CII',
-             'FO1', 'FO2', 'FO3', 'FO4']  # MG69: idk
+def _normalize(name):
+    """Upper-case and collapse whitespace."""
+    return ' '.join(name.upper().split())
 
-    trigger = ['TRIG', 'TRIG1', 'TRIG2', 'TGR2', 'TRIG/EMG', 'TRIG 1',
-               'TRIG 2']
 
-    ref = ['REF', 'REF1', 'REF2', 'REF3', 'REF4']
+def reconcile_chan_name(pos_chan_name, xltek_chan_name, agreement=None):
+    """Match the names of the recorded channels with the names of the
+    channels with a location.
+
+    Parameters
+    ----------
+    pos_chan_name : list of str
+        names of the channels with location
+    xltek_chan_name : list of str
+        names of the recorded channels
+    agreement : list of float, optional
+        for each recorded channel, the fraction of datasets with that name
+        (see ChanNameConsensus.consensus)
+
+    Returns
+    -------
+    dict
+        with keys:
+          - 'matched': recorded channels with a location (same name)
+          - 'scalp', 'trigger', 'ref': recorded channels of those types
+          - 'unknown': recorded channels without a location (rec but no pos)
+          - 'missing': channels with location, but not recorded (pos but no
+            rec)
+          - 'case_mismatch': unknown channels that match a missing channel,
+            if case and whitespace are ignored
+          - 'agreement': (only if agreement is given) recorded channels and
+            the fraction of datasets with that name, if not all the datasets
+            agree
 
-    n_scalp = 0
-    n_trigger = 0
-    n_ref = 0
-    n_ieeg = 0
-    unknown = []
+    Notes
+    -----
+    Channels with a location need to have exactly the same name as the
+    recorded channels. The other categories ignore case and whitespace. If a
+    name is duplicated, each recorded channel matches only one channel with
+    location.
+    """
+    available = Counter(pos_chan_name)
+
+    report = {x: [] for x in REPORT_GROUPS}
     for c in xltek_chan_name:
-        if not c.upper() in nogood:  # we just don't care
-            if c in pos_chan_name:
-                n_ieeg += 1
-                pos_chan_name.remove(c)
-            elif c.upper() in scalp:
-                n_scalp += 1
-            elif c.upper() in trigger:
-                n_trigger += 1
-            elif c.upper() in ref:
-                n_ref += 1
-            else:
-                unknown.append(c)
-
-    with open(report_file, 'w') as f:
+        norm = _normalize(c)
+        if norm in NOGOOD:  # we just don't care
+            continue
+
+        if available[c] > 0:
+            report['matched'].append(c)
+            available[c] -= 1
+        elif norm in SCALP:
+            report['scalp'].append(c)
+        elif norm in TRIGGER:
+            report['trigger'].append(c)
+        elif norm in REF:
+            report['ref'].append(c)
+        else:
+            report['unknown'].append(c)
+
+    # the first ones were matched, like list.remove
+    n_matched = Counter(report['matched'])
+    for c in pos_chan_name:
+        if n_matched[c] > 0:
+            n_matched[c] -= 1
+        else:
+            report['missing'].append(c)
+
+    missing = {_normalize(c) for c in report['missing']}
+    report['case_mismatch'] = [c for c in report['unknown']
+                               if _normalize(c) in missing]
+
+    if agreement is not None:
+        report['agreement'] = [[c, ratio] for c, ratio
+                               in zip(xltek_chan_name, agreement)
+                               if ratio < 1]
+
+    return report
+
+
+def write_report(report, report_file):
+    """Write the report as text (for people), json and csv (for scripts).
+
+    Parameters
+    ----------
+    report : dict
+        output of reconcile_chan_name
+    report_file : str
+        path of the report, without extension
+    """
+    with open(report_file + '.txt', 'w') as f:
         f.write('Scalp Channels   {0: 3}\n'
                 'Trigger Channels {1: 3}\n'
                 'Reference Channels {2: 3}\n'
                 'IEEG Channels    {3: 3}\n'
                 'rec but no pos {4}\n\n'
-                'pos but no rec {5}'.format(n_scalp, n_trigger, n_ref, n_ieeg,
-                                            ', '.join(unknown),
-                                            ', '.join(pos_chan_name)))
+                'pos but no rec {5}'.format(len(report['scalp']),
+                                            len(report['trigger']),
+                                            len(report['ref']),
+                                            len(report['matched']),
+                                            ', '.join(report['unknown']),
+                                            ', '.join(report['missing'])))
+        if report.get('agreement'):
+            f.write('\n\nnot in all datasets ' +
+                    ', '.join('{} ({:.0%})'.format(c, ratio)
+                              for c, ratio in report['agreement']))
+
+    with open(report_file + '.json', 'w') as f:
+        dump(report, f, indent=2)
+
+    with open(report_file + '.csv', 'w', newline='', encoding='utf-8') as f:
+        csv_file = writer(f)
+        csv_file.writerow(['group', 'chan'])
+        for group in REPORT_GROUPS:
+            for c in report[group]:
+                csv_file.writerow([group, c])
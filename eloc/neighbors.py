@@ -0,0 +1,197 @@
+"""Graph of neighboring electrodes, used by the deformation energy.
+
+The edges come from a KD-tree (k nearest neighbors or all the neighbors within
+a radius) and, for grids whose labels follow a known layout (f.e. GR1..GR64
+for a 8 X 8 grid), from the topology of the grid. Each edge is stored once,
+together with its rest length (the distance in the original positions).
+"""
+from logging import getLogger
+from re import compile as re_compile
+
+from numpy import (arange, asarray, concatenate, empty, full, median, sort,
+                   sqrt, unique)
+from scipy.spatial import cKDTree
+
+lg = getLogger(__name__)
+
+N_NEIGHBORS = 4
+GRID_SHAPES = {64: (8, 8),
+               32: (4, 8),
+               48: (6, 8),
+               }
+# grid edges longer than this times the median, or with a median longer than
+# this times the distance between nearest electrodes, are wrong
+MAX_EDGE_RATIO = 2
+
+LABEL_NUMBER = re_compile(r'^(.*?)(\d+)$')
+
+
+def knn_edges(coord, k=N_NEIGHBORS, radius=None):
+    """Edges between each electrode and its neighbors.
+
+    Parameters
+    ----------
+    coord : numpy.ndarray
+        n_chan X 3 matrix with the position of the electrodes
+    k : int
+        number of neighbors for each electrode (if radius is None)
+    radius : float, optional
+        if specified, all the electrodes closer than radius are neighbors
+
+    Returns
+    -------
+    numpy.ndarray
+        n_edges X 2 matrix with unique pairs of indices (sorted in each row)
+    """
+    coord = asarray(coord, dtype=float)
+    n_chan = coord.shape[0]
+    if n_chan < 2:
+        return empty((0, 2), dtype=int)
+
+    tree = cKDTree(coord)
+    if radius is not None:
+        edges = tree.query_pairs(radius, output_type='ndarray')
+
+    else:
+        k = min(k, n_chan - 1)
+        # the closest point is the electrode itself
+        _, knn_ind = tree.query(coord, k + 1)
+        edges = empty((n_chan * k, 2), dtype=int)
+        edges[:, 0] = knn_ind[:, 1:].ravel()
+        edges[:, 1] = arange(n_chan).repeat(k)
+
+    return _unique_edges(edges)
+
+
+def grid_edges(labels, coord, shapes=GRID_SHAPES):
+    """Edges between neighboring electrodes of grids, based on their labels.
+
+    Parameters
+    ----------
+    labels : list of str
+        labels of the electrodes
+    coord : numpy.ndarray
+        n_chan X 3 matrix with the position of the electrodes
+    shapes : dict
+        from the number of electrodes to the shape (rows, columns) of a grid
+
+    Returns
+    -------
+    numpy.ndarray
+        n_edges X 2 matrix with unique pairs of indices (sorted in each row)
+    numpy.ndarray of int
+        for each electrode, the index of its grid (-1 if it does not belong
+        to a grid with known topology)
+
+    Notes
+    -----
+    A grid is recognized when all the labels with the same prefix are numbered
+    from 1 to one of the sizes in shapes. The electrodes are connected to the
+    next electrode in the same row and in the same column, with the numbering
+    along the rows (f.e. 4 X 8) or, if that does not fit, along the columns
+    (8 X 4). The shape only fits if the edges match the positions: no edge is
+    much longer than the others and the edges are as long as the distance
+    between nearest electrodes (see MAX_EDGE_RATIO). If no shape fits, the
+    topology is ignored and the electrodes of the grid are connected to their
+    nearest neighbors (see neighbor_graph).
+    """
+    coord = asarray(coord, dtype=float)
+    arrays = {}
+    for i, label in enumerate(labels):
+        match = LABEL_NUMBER.match(label)
+        if match is not None:
+            arrays.setdefault(match.group(1), {})[int(match.group(2))] = i
+
+    all_edges = [empty((0, 2), dtype=int)]
+    grid = full(len(labels), -1)
+    for prefix, numbers in arrays.items():
+        n_elec = len(numbers)
+        if n_elec not in shapes or set(numbers) != set(range(1, n_elec + 1)):
+            continue
+
+        order = asarray([numbers[x + 1] for x in range(n_elec)])
+        n_rows, n_cols = shapes[n_elec]
+        for shape in dict.fromkeys([(n_rows, n_cols), (n_cols, n_rows)]):
+            edges = _grid_topology(order.reshape(shape))
+            if _fits(coord, order, edges):
+                all_edges.append(edges)
+                grid[order] = len(all_edges) - 1
+                break
+        else:
+            lg.info('labels of ' + prefix + ' do not match a ' +
+                    '{} X {} grid, using the nearest neighbors'.format(
+                        n_rows, n_cols))
+
+    return _unique_edges(concatenate(all_edges)), grid
+
+
+def neighbor_graph(coord, labels=None, k=N_NEIGHBORS, radius=None,
+                   shapes=GRID_SHAPES):
+    """Graph of the neighboring electrodes, with rest lengths.
+
+    Parameters
+    ----------
+    coord : numpy.ndarray
+        n_chan X 3 matrix with the (original) position of the electrodes
+    labels : list of str, optional
+        labels of the electrodes. If specified, the grids with known layout
+        use the edges of the grid (see grid_edges).
+    k : int
+        number of neighbors for each electrode (if radius is None)
+    radius : float, optional
+        if specified, all the electrodes closer than radius are neighbors
+    shapes : dict
+        from the number of electrodes to the shape (rows, columns) of a grid
+
+    Returns
+    -------
+    numpy.ndarray
+        n_edges X 2 matrix with unique pairs of indices (sorted in each row)
+    numpy.ndarray
+        rest length of each edge
+    """
+    coord = asarray(coord, dtype=float)
+
+    if labels is None:
+        edges = knn_edges(coord, k, radius)
+
+    else:
+        edges, grid = grid_edges(labels, coord, shapes)
+        # the nearest neighbors connect the other electrodes and the
+        # electrodes of different grids
+        knn = knn_edges(coord, k, radius)
+        same_grid = ((grid[knn[:, 0]] == grid[knn[:, 1]]) &
+                     (grid[knn[:, 0]] >= 0))
+        knn = knn[~same_grid, :]
+        edges = _unique_edges(concatenate((edges, knn)))
+
+    return edges, rest_length(coord, edges)
+
+
+def rest_length(coord, edges):
+    """Length of each edge."""
+    diff = coord[edges[:, 0], :] - coord[edges[:, 1], :]
+    return sqrt((diff ** 2).sum(axis=1))
+
+
+def _grid_topology(idx):
+    """Edges along the rows and the columns of a matrix of indices."""
+    return concatenate((
+        concatenate((idx[:, :-1].reshape(-1, 1),
+                     idx[:, 1:].reshape(-1, 1)), axis=1),
+        concatenate((idx[:-1, :].reshape(-1, 1),
+                     idx[1:, :].reshape(-1, 1)), axis=1)))
+
+
+def _fits(coord, idx, edges):
+    """Whether the edges of a grid match the positions of its electrodes."""
+    length = rest_length(coord, edges)
+    nearest = cKDTree(coord[idx, :]).query(coord[idx, :], 2)[0][:, 1]
+    return (length.max() <= MAX_EDGE_RATIO * median(length) and
+            median(length) <= MAX_EDGE_RATIO * median(nearest))
+
+
+def _unique_edges(edges):
+    edges = sort(asarray(edges, dtype=int).reshape(-1, 2), axis=1)
+    edges = edges[edges[:, 0] != edges[:, 1], :]  # duplicate positions
+    return unique(edges, axis=0)
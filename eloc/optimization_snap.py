@@ -0,0 +1,490 @@
+"""Snap electrodes onto a surface, in python.
+
+This is a port of matlab/src/optimization_snap.m, so that we don't need to
+start the MATLAB runtime and write/read csv files for every subject. The
+objective is the same (displacement plus deformation of the grid), but the
+gradients are computed analytically and the constraint is vectorized.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from re import compile as re_compile
+
+from numpy import (absolute, arange, array_equal, asarray, bincount, ones,
+                   sqrt, unique, where, zeros)
+from numpy.linalg import norm
+from scipy.optimize import minimize
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from .neighbors import N_NEIGHBORS, knn_edges, neighbor_graph, rest_length
+from .surf_index import SurfaceIndex, load_surface_index
+from .trace import add_events, measure, pop_events, traced
+
+lg = getLogger(__name__)
+
+MAX_ITER = 50
+TOL_FUN = 0.01
+COORD_TOL = 1e-3  # max difference in mm to consider a contact unchanged
+N_SNAP_WORKERS = 4  # max number of arrays snapped at the same time
+
+# early stopping: all electrodes within DIST_TOL mm of the surface and the
+# relative change in energy below ENERGY_TOL for N_PLATEAU iterations
+DIST_TOL = 0.05
+ENERGY_TOL = 1e-3
+N_PLATEAU = 3
+
+ARRAY_PREFIX = re_compile(r'^(.*?)\d*$')
+
+
+class _StopSnapping(Exception):
+    """The snapping has converged (raised by the callback of the optimizer).
+    """
+    pass
+
+
+@traced
+def snap_chan_to_surf(chan, surf_index, previous=None,
+                      n_workers=N_SNAP_WORKERS, diagnostics=None):
+    """Snap channels onto the surface, in place.
+
+    Parameters
+    ----------
+    chan : instance of phypno.attr.chan.Channels
+        channels to snap (usually only grid and strips)
+    surf_index : instance of SurfaceIndex or str
+        index of the (smooth) surface, or path to the surface file
+    previous : dict, optional
+        snapping of another session onto the same surface (see
+        previous_snap). Contacts with the same label and the same original
+        position are not snapped again.
+    n_workers : int
+        number of arrays (grids or strips) snapped in parallel. The arrays
+        are snapped in separate processes only if surf_index is a file, so
+        that each process reads the surface from the cache.
+    diagnostics : list, optional
+        list where to append the convergence of each array (see
+        optimization_snap), with the additional key 'labels'
+
+    Returns
+    -------
+    instance of phypno.attr.chan.Channels
+        the same channels, with the snapped coordinates.
+    """
+    labels = chan.return_label()
+    coord = chan.return_xyz()
+    fixed, x0 = reuse_snapped(labels, coord, previous)
+    if fixed.any():
+        lg.info('reusing {} of {} snapped contacts'.format(
+            fixed.sum(), len(fixed)))
+
+    arrays = [idx for idx in split_arrays(labels, coord)
+              if not fixed[idx].all()]
+    lg.info('snapping {} arrays ({})'.format(
+        len(arrays), ', '.join(str(len(idx)) for idx in arrays)))
+
+    args = [(coord[idx, :], surf_index, fixed[idx], x0[idx, :],
+             [labels[i] for i in idx]) for idx in arrays]
+    if isinstance(surf_index, SurfaceIndex) or n_workers < 2 or len(args) < 2:
+        results = [_snap_array(*one_args) for one_args in args]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers,
+                                                 len(args))) as pool:
+            results = []
+            for one_coord, one_diag, events in pool.map(_snap_array_worker,
+                                                        *zip(*args)):
+                add_events(events)
+                results.append((one_coord, one_diag))
+
+    coord_snapped = x0
+    for idx, (one_coord, one_diag) in zip(arrays, results):
+        coord_snapped[idx, :] = one_coord
+        one_diag['labels'] = [labels[i] for i in idx]
+        if not one_diag['converged']:
+            lg.warning('snapping of {} did not converge: {}'.format(
+                ', '.join(one_diag['labels']), one_diag['message']))
+        if diagnostics is not None:
+            diagnostics.append(one_diag)
+
+    for one_chan, xyz in zip(chan.chan, coord_snapped):
+        one_chan.xyz = xyz
+
+    return chan
+
+
+def _snap_array(coord, surf_index, fixed, x0, labels):
+    if not isinstance(surf_index, SurfaceIndex):
+        surf_index = load_surface_index(surf_index)
+    diagnostics = {}
+    coord = optimization_snap(coord, surf_index, fixed, x0, diagnostics,
+                              labels)
+    return coord, diagnostics
+
+
+def _snap_array_worker(coord, surf_index, fixed, x0, labels):
+    """Snap one array in a worker of the pool and return its events too."""
+    with measure('snap array', n_chan=len(labels)):
+        coord, diagnostics = _snap_array(coord, surf_index, fixed, x0, labels)
+    return coord, diagnostics, pop_events()
+
+
+def split_arrays(labels, coord, k=N_NEIGHBORS):
+    """Split the contacts into independent arrays (grids or strips).
+
+    Parameters
+    ----------
+    labels : list of str
+        labels of the contacts
+    coord : numpy.ndarray
+        n_chan X 3 matrix with the position of the contacts
+    k : int
+        number of neighbors of each contact
+
+    Returns
+    -------
+    list of numpy.ndarray
+        indices of the contacts in each array
+
+    Notes
+    -----
+    Contacts belong to the same array if they have the same label prefix
+    (f.e. 'SGR' for 'SGR12') and if they are connected in the graph of the k
+    nearest neighbors (computed within the prefix).
+    """
+    coord = asarray(coord, dtype=float)
+    prefix = asarray([ARRAY_PREFIX.match(x).group(1) for x in labels])
+
+    arrays = []
+    for one_prefix in unique(prefix):
+        idx = where(prefix == one_prefix)[0]
+        if len(idx) == 1:
+            arrays.append(idx)
+            continue
+
+        pairs = knn_edges(coord[idx, :], k)
+        graph = coo_matrix((ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                           shape=(len(idx), len(idx)))
+        _, components = connected_components(graph, directed=False)
+        for one_comp in unique(components):
+            arrays.append(idx[components == one_comp])
+
+    return arrays
+
+
+def previous_snap(orig_chan, snapped_chan):
+    """Collect the snapping of one session, to reuse it in another session.
+
+    Parameters
+    ----------
+    orig_chan : instance of phypno.attr.chan.Channels
+        channels with the original positions
+    snapped_chan : instance of phypno.attr.chan.Channels
+        the same channels, after snapping
+
+    Returns
+    -------
+    dict
+        from label to a tuple with the original and the snapped position
+    """
+    snapped = {x.label: x.xyz for x in snapped_chan.chan}
+    return {x.label: (x.xyz, snapped[x.label]) for x in orig_chan.chan
+            if x.label in snapped}
+
+
+def reuse_snapped(labels, coord, previous=None):
+    """Find the contacts which were already snapped in another session.
+
+    Parameters
+    ----------
+    labels : list of str
+        labels of the contacts
+    coord : numpy.ndarray
+        n_chan X 3 matrix with the original position of the contacts
+    previous : dict, optional
+        from label to a tuple with the original and the snapped position
+
+    Returns
+    -------
+    numpy.ndarray of bool
+        for each contact, if it's unchanged (same label and original position)
+    numpy.ndarray
+        n_chan X 3 matrix with the starting position: the previous solution
+        for the unchanged contacts and, for the others, the original position
+        moved like the closest unchanged contact.
+    """
+    coord = asarray(coord, dtype=float)
+    n_chan = coord.shape[0]
+    fixed = zeros(n_chan, dtype=bool)
+    x0 = coord.copy()
+    if not previous:
+        return fixed, x0
+
+    for i, label in enumerate(labels):
+        if label not in previous:
+            continue
+        orig, snapped = previous[label]
+        if (absolute(asarray(orig) - coord[i, :]) <= COORD_TOL).all():
+            fixed[i] = True
+            x0[i, :] = snapped
+
+    if fixed.any() and not fixed.all():
+        _, closest = cKDTree(coord[fixed, :]).query(coord[~fixed, :])
+        shift = x0[fixed, :] - coord[fixed, :]
+        x0[~fixed, :] += shift[closest, :]
+
+    return fixed, x0
+
+
+def optimization_snap(coord, surf_index, fixed=None, x0=None,
+                      diagnostics=None, labels=None):
+    """Move electrodes onto the surface, preserving the shape of the grid.
+
+    Parameters
+    ----------
+    coord : numpy.ndarray
+        n_chan X 3 matrix with the original position of the electrodes
+    surf_index : instance of SurfaceIndex or numpy.ndarray
+        index of the surface (or n_vert X 3 matrix with its vertices)
+    fixed : numpy.ndarray of bool, optional
+        electrodes which are kept at their position in x0
+    x0 : numpy.ndarray, optional
+        n_chan X 3 matrix with the starting position of the electrodes
+        (default: the original position)
+    diagnostics : dict, optional
+        dict where to store the convergence: 'converged' (bool), 'message',
+        'n_iter', 'energy', 'max_dist' (max distance from the surface) and
+        'trace' (energy, max_dist and step for each iteration)
+    labels : list of str, optional
+        labels of the electrodes, to use the topology of the grids for the
+        deformation energy (see eloc.neighbors.neighbor_graph)
+
+    Returns
+    -------
+    numpy.ndarray
+        n_chan X 3 matrix with the snapped position of the electrodes
+
+    Notes
+    -----
+    The fixed electrodes are not optimized, but they still contribute to the
+    deformation energy, so they anchor their neighbors.
+
+    The optimization stops early when all the electrodes are on the surface
+    (within DIST_TOL) and the energy does not change anymore (see ENERGY_TOL
+    and N_PLATEAU), instead of running until MAX_ITER.
+    """
+    coord0 = coord.astype(float)
+    coord0[coord0 == 0] = 0.01  # values shouldn't be zero (snap_to_surface.m)
+    n_chan = coord0.shape[0]
+    if diagnostics is None:
+        diagnostics = {}
+
+    if fixed is None:
+        fixed = zeros(n_chan, dtype=bool)
+    free = ~asarray(fixed, dtype=bool)
+    current = coord0.copy() if x0 is None else asarray(x0, dtype=float).copy()
+    if not free.any():
+        diagnostics.update({'converged': True, 'message': 'all fixed',
+                            'n_iter': 0, 'energy': None, 'max_dist': 0.,
+                            'trace': []})
+        return current
+
+    if not isinstance(surf_index, SurfaceIndex):
+        surf_index = SurfaceIndex(surf_index)
+
+    if n_chan < 2:
+        # no neighbors (f.e. neuroport): the closest point on the surface is
+        # the position with the smallest displacement
+        dist, closest, _ = surf_index.distance(current)
+        diagnostics.update({'converged': True, 'message': 'single contact',
+                            'n_iter': 0,
+                            'energy': float(((closest - coord0) ** 2).sum()),
+                            'max_dist': 0., 'trace': []})
+        return closest
+
+    pairs, rest = neighbor_graph(coord0, labels)
+
+    def _full(x):
+        current[free, :] = x.reshape(-1, 3)
+        return current
+
+    def efun(x):
+        energy, grad = energy_electrodesnap(_full(x), coord0, pairs, rest)
+        return energy, grad.reshape(-1, 3)[free, :].ravel()
+
+    last = {}
+
+    def _dist(x):
+        """the constraint and its jacobian are evaluated at the same x"""
+        if 'x' not in last or not array_equal(last['x'], x):
+            last['x'] = x.copy()
+            last['dist'] = dist_to_surface(x.reshape(-1, 3), surf_index)
+        return last['dist']
+
+    def cfun(x):
+        return _dist(x)[0]
+
+    def cjac(x):
+        return _dist(x)[1]
+
+    constraint = {'type': 'eq',
+                  'fun': cfun,
+                  'jac': cjac,
+                  }
+
+    monitor = SnapMonitor(lambda x: efun(x)[0], cfun,
+                          current[free, :].ravel())
+    try:
+        res = minimize(efun, current[free, :].ravel(), jac=True,
+                       method='SLSQP', constraints=(constraint, ),
+                       callback=monitor,
+                       options={'maxiter': MAX_ITER,
+                                'ftol': TOL_FUN,
+                                })
+        x, message = res.x, res.message
+        converged = bool(res.success)
+    except _StopSnapping:
+        x, message = monitor.x, 'early stop'
+        converged = True
+
+    max_dist = float(absolute(cfun(x)).max())
+    diagnostics.update({'converged': converged,
+                        'message': message,
+                        'n_iter': len(monitor.trace),
+                        'energy': float(efun(x)[0]),
+                        'max_dist': max_dist,
+                        'trace': monitor.trace,
+                        })
+    lg.debug('snapping: {} after {} iterations'.format(message,
+                                                       len(monitor.trace)))
+
+    return _full(x).copy()
+
+
+class SnapMonitor:
+    """Record each iteration of the optimizer and stop when it converged.
+
+    Parameters
+    ----------
+    efun : function
+        energy, as function of the free coordinates
+    cfun : function
+        distance from the surface, as function of the free coordinates
+    x0 : numpy.ndarray
+        starting free coordinates
+
+    Attributes
+    ----------
+    trace : list of dict
+        for each iteration, 'energy', 'max_dist' and 'step' (norm of the
+        change in the coordinates)
+    x : numpy.ndarray
+        coordinates at the last iteration
+    """
+    def __init__(self, efun, cfun, x0):
+        self.efun = efun
+        self.cfun = cfun
+        self.x = x0.copy()
+        self.trace = []
+
+    def __call__(self, xk):
+        energy = float(self.efun(xk))
+        max_dist = float(absolute(self.cfun(xk)).max())
+        self.trace.append({'energy': energy,
+                           'max_dist': max_dist,
+                           'step': float(norm(xk - self.x)),
+                           })
+        self.x = xk.copy()
+
+        if max_dist < DIST_TOL and len(self.trace) > N_PLATEAU:
+            energies = [x['energy'] for x in self.trace[-N_PLATEAU - 1:]]
+            change = (max(energies) - min(energies)) / max(abs(energy), 1e-12)
+            if change < ENERGY_TOL:
+                raise _StopSnapping
+
+
+def energy_electrodesnap(coord, coord_orig, pairs, rest=None):
+    """Energy of the snapped electrodes and its gradient.
+
+    Parameters
+    ----------
+    coord : numpy.ndarray
+        n_chan X 3 matrix with the current position of the electrodes
+    coord_orig : numpy.ndarray
+        n_chan X 3 matrix with the original position of the electrodes
+    pairs : numpy.ndarray
+        n_pairs X 2 matrix with the indices of neighboring electrodes
+    rest : numpy.ndarray, optional
+        distance between the pairs in the original positions (see
+        eloc.neighbors.neighbor_graph). It's computed if not specified.
+
+    Returns
+    -------
+    float
+        mean displacement plus mean squared deformation energy
+    numpy.ndarray
+        gradient of the energy, as vector of length n_chan * 3
+    """
+    n_chan = coord.shape[0]
+
+    shift = coord - coord_orig
+    energy = (shift ** 2).sum(axis=1).mean()
+    denergy = 2 * shift / n_chan
+
+    n_pairs = pairs.shape[0]
+    if n_pairs == 0:
+        return energy, denergy.ravel()
+    if rest is None:
+        rest = rest_length(coord_orig, pairs)
+
+    diff = coord[pairs[:, 0], :] - coord[pairs[:, 1], :]
+    dist = sqrt((diff ** 2).sum(axis=1))
+    energy += ((dist - rest) ** 4).mean()
+
+    d_dist = 4 * (dist - rest) ** 3 / n_pairs
+    safe_dist = dist.copy()
+    safe_dist[safe_dist == 0] = 1
+    d_pair = (d_dist / safe_dist)[:, None] * diff
+    for i in range(3):
+        denergy[:, i] += (bincount(pairs[:, 0], d_pair[:, i], n_chan) -
+                          bincount(pairs[:, 1], d_pair[:, i], n_chan))
+
+    return energy, denergy.ravel()
+
+
+def dist_to_surface(coord, surf_index):
+    """Distance between each electrode and the surface.
+
+    Parameters
+    ----------
+    coord : numpy.ndarray
+        n_chan X 3 matrix with the position of the electrodes
+    surf_index : instance of SurfaceIndex
+        index of the surface
+
+    Returns
+    -------
+    numpy.ndarray
+        vector of length n_chan with the signed distance to the surface
+    numpy.ndarray
+        n_chan X (n_chan * 3) jacobian of the distance
+
+    Notes
+    -----
+    The distance is signed (see SurfaceIndex.signed_distance), so that its
+    gradient is the normal of the surface, which is not zero on the surface
+    (the gradient of the unsigned distance is zero there, so the jacobian of
+    the constraint would be singular at the solution). If the index has no
+    triangles, it uses the unsigned distance to the vertices.
+    """
+    n_chan = coord.shape[0]
+    if surf_index.tri is None:
+        dist, _, grad = surf_index.distance(coord)
+    else:
+        dist, _, grad = surf_index.signed_distance(coord)
+
+    jac = zeros((n_chan, n_chan * 3))
+    rows = arange(n_chan)
+    for i in range(3):
+        jac[rows, rows * 3 + i] = grad[:, i]
+
+    return dist, jac
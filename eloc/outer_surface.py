@@ -0,0 +1,177 @@
+"""Smooth envelope of the pial surface, without external programs.
+
+This does the same steps as mris_fill, make_outer_surface.m and mris_smooth:
+the pial surface is filled in a volume, the volume is closed with a sphere
+(so that the sulci disappear), the surface is extracted with marching cubes
+and then smoothed by averaging the position of the neighboring vertices.
+"""
+from logging import getLogger
+
+from numpy import (asarray, ceil, concatenate, floor, linspace, meshgrid, ones,
+                   zeros)
+from scipy.ndimage import binary_fill_holes, distance_transform_edt
+from scipy.sparse import coo_matrix, diags, identity
+try:
+    from skimage.measure import marching_cubes
+except ImportError:
+    marching_cubes = None
+
+lg = getLogger(__name__)
+
+# same as mris_fill -r 1, make_outer_surface 15, mris_smooth -n 60
+FILL_RESOLUTION = 1
+OUTER_RADIUS = 15
+SMOOTH_ITER = 60
+
+
+def outer_smooth_surface(vert, tri, resolution=FILL_RESOLUTION,
+                         radius=OUTER_RADIUS, n_iter=SMOOTH_ITER):
+    """Compute the smooth outer surface of the pial surface.
+
+    Parameters
+    ----------
+    vert : numpy.ndarray
+        n_vert X 3 matrix with the vertices of the pial surface
+    tri : numpy.ndarray
+        n_tri X 3 matrix with the triangles of the pial surface
+    resolution : float
+        size of the voxels, in mm
+    radius : float
+        radius of the sphere used to close the volume, in mm
+    n_iter : int
+        number of smoothing iterations
+
+    Returns
+    -------
+    numpy.ndarray
+        vertices of the outer surface
+    numpy.ndarray
+        triangles of the outer surface
+    """
+    if marching_cubes is None:
+        raise ImportError('scikit-image is necessary to compute the outer '
+                          'surface in python')
+
+    filled, origin = fill_surface(vert, tri, resolution,
+                                  padding=radius + 2 * resolution)
+    closed = close_volume(filled, radius / resolution)
+
+    outer_vert, outer_tri, _, _ = marching_cubes(closed.astype('float32'),
+                                                 level=0.5)
+    outer_vert = outer_vert * resolution + origin
+    lg.debug('outer surface with {} vertices'.format(outer_vert.shape[0]))
+
+    return smooth_surface(outer_vert, outer_tri, n_iter), outer_tri
+
+
+def fill_surface(vert, tri, resolution=FILL_RESOLUTION, padding=0):
+    """Fill a closed surface in a volume (like mris_fill).
+
+    Parameters
+    ----------
+    vert : numpy.ndarray
+        n_vert X 3 matrix with the vertices of the surface
+    tri : numpy.ndarray
+        n_tri X 3 matrix with the triangles of the surface
+    resolution : float
+        size of the voxels, in mm
+    padding : float
+        empty space around the surface, in mm
+
+    Returns
+    -------
+    numpy.ndarray of bool
+        3d volume, True inside the surface
+    numpy.ndarray
+        position (in mm) of the first voxel
+    """
+    origin = floor(vert.min(axis=0) - padding)
+    shape = ceil((vert.max(axis=0) + padding - origin) / resolution) + 1
+
+    # sample the triangles densely enough that the surface has no holes
+    tri_vert = vert[tri, :]
+    edges = concatenate((tri_vert[:, 1, :] - tri_vert[:, 0, :],
+                         tri_vert[:, 2, :] - tri_vert[:, 0, :]), axis=0)
+    max_edge = ((edges ** 2).sum(axis=1) ** .5).max()
+    n_step = int(ceil(2 * max_edge / resolution)) + 1
+
+    u, v = meshgrid(linspace(0, 1, n_step), linspace(0, 1, n_step))
+    inside = (u + v) <= 1
+    u = u[inside]
+    v = v[inside]
+
+    shell = zeros(shape.astype(int), dtype=bool)
+    for i in range(u.shape[0]):  # one sample of all the triangles at a time
+        points = (tri_vert[:, 0, :] +
+                  u[i] * (tri_vert[:, 1, :] - tri_vert[:, 0, :]) +
+                  v[i] * (tri_vert[:, 2, :] - tri_vert[:, 0, :]))
+        idx = ((points - origin) / resolution).round().astype(int)
+        shell[idx[:, 0], idx[:, 1], idx[:, 2]] = True
+
+    return binary_fill_holes(shell), origin
+
+
+def close_volume(volume, radius):
+    """Morphological closing with a sphere (like imclose in MATLAB).
+
+    Parameters
+    ----------
+    volume : numpy.ndarray of bool
+        3d volume to close
+    radius : float
+        radius of the sphere, in voxels
+
+    Returns
+    -------
+    numpy.ndarray of bool
+        closed volume
+
+    Notes
+    -----
+    With the distance transform, the cost does not depend on the radius of
+    the sphere. The volume needs to be padded by at least the radius.
+    """
+    dilated = distance_transform_edt(~volume) <= radius
+    return distance_transform_edt(dilated) > radius
+
+
+def smooth_surface(vert, tri, n_iter=SMOOTH_ITER):
+    """Smooth the surface by averaging each vertex with its neighbors.
+
+    Parameters
+    ----------
+    vert : numpy.ndarray
+        n_vert X 3 matrix with the vertices of the surface
+    tri : numpy.ndarray
+        n_tri X 3 matrix with the triangles of the surface
+    n_iter : int
+        number of iterations
+
+    Returns
+    -------
+    numpy.ndarray
+        n_vert X 3 matrix with the smoothed vertices
+
+    Notes
+    -----
+    Like in mris_smooth, each vertex becomes the average of itself and its
+    neighbors, so the averaging operator is computed only once.
+    """
+    n_vert = vert.shape[0]
+    rows = concatenate((tri[:, 0], tri[:, 1], tri[:, 2],
+                        tri[:, 1], tri[:, 2], tri[:, 0]))
+    cols = concatenate((tri[:, 1], tri[:, 2], tri[:, 0],
+                        tri[:, 0], tri[:, 1], tri[:, 2]))
+    adj = coo_matrix((ones(rows.shape[0]), (rows, cols)),
+                     shape=(n_vert, n_vert)).tocsr()
+    adj.data[:] = 1  # edges are shared by two triangles
+    adj = adj + identity(n_vert, format='csr')
+
+    n_neighbors = asarray(adj.sum(axis=1)).ravel()
+    average = diags(1 / n_neighbors) @ adj
+
+    smoothed = vert.copy()
+    for _ in range(n_iter):
+        smoothed = average @ smoothed
+
+    return smoothed
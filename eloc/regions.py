@@ -0,0 +1,206 @@
+"""Assign a brain region to each channel, for all the channels at once.
+
+The parcellation (aparc+aseg) is read through the shared anatomy (see
+eloc.anat_cache), so that the volume is read only once and it's shared across
+stages and processes.
+"""
+from functools import lru_cache
+from logging import getLogger
+from os import environ
+from pathlib import Path
+
+from numpy import (arange, asarray, c_, clip, dot, full, lexsort, meshgrid,
+                   minimum, ones, r_, unique, where, zeros)
+from numpy.linalg import inv
+
+from .anat_cache import get_anatomy
+
+lg = getLogger(__name__)
+
+PARCELLATION = 'aparc+aseg.mgz'
+NOT_FOUND = '--not found--'
+
+
+def read_lut(lut_file=None):
+    """Read the FreeSurfer color look-up table.
+
+    Parameters
+    ----------
+    lut_file : path to file, optional
+        look-up table (default: FreeSurferColorLUT.txt in FREESURFER_HOME)
+
+    Returns
+    -------
+    dict
+        from index to name of the region
+    """
+    if lut_file is None:
+        lut_file = Path(environ['FREESURFER_HOME'],
+                        'FreeSurferColorLUT.txt')
+
+    lut = {}
+    with open(str(lut_file)) as f:
+        for line in f:
+            values = line.split()
+            if values and values[0].isdigit():
+                lut[int(values[0])] = values[1]
+    return lut
+
+
+class RegionLookup:
+    """Find the region of many positions at once.
+
+    Parameters
+    ----------
+    volume : numpy.ndarray
+        3d volume with the index of the region of each voxel
+    vox2ras : numpy.ndarray
+        4 X 4 affine matrix from voxel to surface RAS (tkr) coordinates
+    lut : dict
+        from index to name of the region
+    """
+    def __init__(self, volume, vox2ras, lut):
+        self.volume = volume
+        self.ras2vox = inv(vox2ras)
+        self.lut = lut
+
+        n_idx = max(lut) + 1
+        self._names = asarray([lut.get(i, '') for i in range(n_idx)],
+                              dtype=object)
+
+    def find_regions(self, xyz, max_approx=3, exclude_regions=()):
+        """Find the region of each position.
+
+        Parameters
+        ----------
+        xyz : numpy.ndarray
+            n_pos X 3 matrix with the positions (surface RAS coordinates)
+        max_approx : int
+            max distance (in voxels) from each position to look for a region
+        exclude_regions : tuple of str
+            regions containing one of these strings are ignored
+
+        Returns
+        -------
+        numpy.ndarray of object
+            name of the region for each position ('--not found--' if there is
+            no region within max_approx)
+        numpy.ndarray of int
+            the approximation used for each position (max_approx if not
+            found)
+
+        Notes
+        -----
+        Same as phypno's Freesurfer.find_brain_region: for each position, it
+        looks at cubes of increasing size (1, 3, 5... voxels). In the first
+        cube with a region, it takes the region with the most voxels. If there
+        are ties, it takes the region found first, with the order of the
+        default meshgrid (y changes slowest, then x, then z).
+        """
+        xyz = asarray(xyz, dtype=float)
+        n_pos = xyz.shape[0]
+        pos = dot(c_[xyz, ones(n_pos)], self.ras2vox.T)[:, :3]
+        pos = pos.round().astype(int)
+
+        valid = ones(len(self._names), dtype=bool)
+        for i, name in enumerate(self._names):
+            if name == '' or any(x in name for x in exclude_regions):
+                valid[i] = False
+
+        region = full(n_pos, NOT_FOUND, dtype=object)
+        approx = full(n_pos, max_approx)
+        todo = arange(n_pos)
+
+        for one_approx in range(max_approx + 1):
+            if len(todo) == 0:
+                break
+
+            step = arange(-one_approx, one_approx + 1)
+            # same order as phypno (default meshgrid: y changes slowest, then
+            # x, then z)
+            offsets = asarray(meshgrid(step, step, step)).reshape(3, -1).T
+
+            vox = pos[todo, None, :] + offsets[None, :, :]
+            for i in range(3):
+                vox[:, :, i] = clip(vox[:, :, i], 0,
+                                    self.volume.shape[i] - 1)
+            labels = asarray(self.volume[vox[:, :, 0], vox[:, :, 1],
+                                         vox[:, :, 2]])
+
+            in_lut = labels < len(valid)
+            rows, cols = (in_lut & valid[where(in_lut, labels, 0)]).nonzero()
+            if len(rows) == 0:
+                continue
+            pairs, inverse, counts = unique(c_[rows, labels[rows, cols]],
+                                            axis=0, return_inverse=True,
+                                            return_counts=True)
+            first = full(len(pairs), len(offsets))
+            minimum.at(first, inverse.ravel(), cols)
+
+            # per row, the most common label (the first one found on ties)
+            order = lexsort((first, -counts, pairs[:, 0]))
+            pairs = pairs[order]
+            first = r_[True, pairs[1:, 0] != pairs[:-1, 0]]
+
+            found = todo[pairs[first, 0]]
+            region[found] = self._names[pairs[first, 1]]
+            approx[found] = one_approx
+
+            done = zeros(len(todo), dtype=bool)
+            done[pairs[first, 0]] = True
+            todo = todo[~done]
+
+        return region, approx
+
+    def assign_region_to_channels(self, chan, max_approx=3,
+                                  exclude_regions=()):
+        """Store region and approximation in the attributes of the channels.
+
+        Parameters
+        ----------
+        chan : instance of phypno.attr.chan.Channels
+            channels (modified in place, attr 'region' and 'approx')
+        max_approx : int
+            max distance (in voxels) from each position to look for a region
+        exclude_regions : tuple of str
+            regions containing one of these strings are ignored
+
+        Returns
+        -------
+        dict
+            from region to list of channel labels, in the order of channels
+        """
+        if chan.n_chan == 0:
+            return {}
+
+        region, approx = self.find_regions(chan.return_xyz(), max_approx,
+                                           exclude_regions)
+
+        chan_in_region = {}
+        for one_chan, one_region, one_approx in zip(chan.chan, region,
+                                                    approx):
+            one_chan.attr['region'] = one_region
+            one_chan.attr['approx'] = int(one_approx)
+            chan_in_region.setdefault(one_region, []).append(one_chan.label)
+
+        return chan_in_region
+
+
+@lru_cache(maxsize=4)
+def get_region_lookup(freesurfer_dir, parcellation=PARCELLATION):
+    """Load the parcellation of one subject only once.
+
+    Parameters
+    ----------
+    freesurfer_dir : str
+        freesurfer directory of the subject
+    parcellation : str
+        name of the volume in the mri directory
+
+    Returns
+    -------
+    instance of RegionLookup
+        lookup of the regions of the subject
+    """
+    volume, vox2ras = get_anatomy(freesurfer_dir).read_volume(parcellation)
+    return RegionLookup(volume, vox2ras, read_lut())
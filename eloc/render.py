@@ -0,0 +1,122 @@
+"""Render the rotating brains off-screen, without a GUI.
+
+The frames are rendered directly into numpy arrays (with an off-screen OpenGL
+backend, f.e. EGL or OSMesa on the compute nodes) and they are passed to the
+encoder in memory, so there are no temporary images on disk.
+"""
+from logging import getLogger
+from os import environ
+from pathlib import Path
+
+from PIL import Image
+from vispy import app, scene
+
+lg = getLogger(__name__)
+
+GL_BACKEND = environ.get('ELOC_GL_BACKEND', 'egl')
+FRAME_SIZE = (600, 600)
+FRAME_DURATION = 100  # in ms
+MARKER_SIZE = 8
+SKIN_COLOR = (.94, .82, .81, .5)
+BACKGROUND = 'white'
+
+_backend_ready = False
+
+
+def _use_backend():
+    """Select the off-screen backend (only once per process)."""
+    global _backend_ready
+    if not _backend_ready:
+        app.use_app(GL_BACKEND)
+        _backend_ready = True
+
+
+def render_rotation(vert, tri, chan_groups, angles, size=FRAME_SIZE):
+    """Render the surface with the channels, from different angles.
+
+    Parameters
+    ----------
+    vert : numpy.ndarray
+        n_vert X 3 matrix with the vertices of the surface
+    tri : numpy.ndarray
+        n_tri X 3 matrix with the triangles of the surface
+    chan_groups : list of tuple
+        each tuple contains a n_chan X 3 matrix with the position of the
+        channels and their color (RGBA)
+    angles : iterable of float
+        azimuth of the camera for each frame, in degrees
+    size : tuple of int
+        size of each frame, in pixels
+
+    Yields
+    ------
+    numpy.ndarray
+        height X width X 3 matrix with one frame (uint8)
+    """
+    _use_backend()
+
+    canvas = scene.SceneCanvas(show=False, size=size, bgcolor=BACKGROUND)
+    view = canvas.central_widget.add_view()
+
+    for xyz, color in chan_groups:
+        if len(xyz) == 0:
+            continue
+        markers = scene.visuals.Markers(parent=view.scene)
+        markers.set_data(xyz, face_color=color, edge_color=None,
+                         size=MARKER_SIZE)
+
+    # the surface has to go after the channels, because it's transparent
+    scene.visuals.Mesh(vertices=vert, faces=tri, color=SKIN_COLOR,
+                       shading='smooth', parent=view.scene)
+
+    view.camera = scene.TurntableCamera(elevation=0, fov=0)
+    view.camera.set_range()
+
+    try:
+        for ang in angles:
+            view.camera.azimuth = ang
+            yield canvas.render()[:, :, :3]
+    finally:
+        canvas.close()
+
+
+def write_animation(frames, out_file, duration=FRAME_DURATION):
+    """Encode the frames as animation, in memory.
+
+    Parameters
+    ----------
+    frames : iterable of numpy.ndarray
+        frames, as height X width X 3 matrices
+    out_file : path to file
+        output file. The format depends on the extension: '.gif', '.png' or
+        '.apng' (animated png) and '.mp4' (it requires imageio-ffmpeg).
+    duration : int
+        duration of each frame, in ms
+    """
+    out_file = Path(out_file)
+    suffix = out_file.suffix.lower()
+
+    if suffix == '.mp4':
+        from imageio import get_writer
+
+        with get_writer(str(out_file), fps=1000 / duration) as writer:
+            for frame in frames:
+                writer.append_data(frame)
+
+    elif suffix in ('.gif', '.png', '.apng'):
+        images = [Image.fromarray(frame) for frame in frames]
+        if suffix == '.gif':
+            images = [x.quantize() for x in images]
+        img_format = 'GIF' if suffix == '.gif' else 'PNG'
+        images[0].save(str(out_file), format=img_format, save_all=True,
+                       append_images=images[1:], duration=duration, loop=0)
+
+    else:
+        raise ValueError('Unknown animation format "' + suffix + '"')
+
+
+def render_to_file(vert, tri, chan_groups, angles, out_file):
+    """Render one rotating brain and write it to file."""
+    frames = render_rotation(vert, tri, chan_groups, angles)
+    write_animation(frames, out_file)
+    lg.debug('rendered ' + str(out_file))
@@ -1,16 +1,155 @@
+from functools import lru_cache
 from logging import getLogger
-from re import match
+from os import environ
+from re import compile as re_compile
 from pathlib import Path
-from subprocess import check_call
-from tempfile import mkdtemp
 
-from phypno.attr import Channels
+from numpy import array
+
+from .optimization_snap import snap_chan_to_surf
+from .outer_surface import (outer_smooth_surface, FILL_RESOLUTION,
+                            OUTER_RADIUS, SMOOTH_ITER)
+from .surf_cache import SurfaceCache
+from .surf_io import read_surf, write_surf
+from .tools import mcr_env, run_tool
+from .trace import traced
 
 lg = getLogger(__name__)
 
 
-MCRROOT = '/opt/MATLAB/MATLAB_Compiler_Runtime/v83'
-MATLAB_BIN = '/home/gio/projects/eloc/scripts/matlab/bin'
+# MATLAB Compiler Runtime and compiled make_outer_surface
+MCRROOT = environ.get('ELOC_MCR_ROOT',
+                      '/opt/MATLAB/MATLAB_Compiler_Runtime/v83')
+MATLAB_BIN = environ.get('ELOC_MATLAB_BIN',
+                         '/home/gio/projects/eloc/scripts/matlab/bin')
+
+
+# rules for channels on the pial surface: (pattern, exception, whether to
+# apply them to the upper-case label)
+PIAL_RULES = (('.*G[0-9]{1,2}$', '.*CING[0-9]$', False),
+              ('.*GR[0-9]{1,2}$', None, True),
+              ('.*RG[0-9]{1,2}$', None, True),  # typo for gr
+              ('.*S[0-9]$', '.*INS[0-9]$', True),
+              ('REF[0-9]$', None, True),
+              ('.*micro$', None, True),
+              )
+PIAL_LABELS = ('neuroport', 'Neuroport')
+
+# subject-specific rules
+SUBJ_PIAL_PATTERNS = {'MG33': ('.*TT[0-9]{1}$',
+                               '.*SbT[0-9]{1}$',
+                               '.*PO[0-9]{1}$',
+                               ),
+                      'MG63': ('.*AST[0-9]{1}$',
+                               '.*PST[0-9]{1}$',
+                               ),
+                      }
+SUBJ_NOT_PIAL_PATTERNS = {'MG91': ('.*L[AP]TS[0-9]{1}$',
+                                   ),
+                          }
+
+
+class PialClassifier:
+    """Classify channels as on the pial surface (grid and strips) or not.
+
+    Parameters
+    ----------
+    subj : str
+        subject code, used for the subject-specific rules
+
+    Notes
+    -----
+    The rules are compiled once per subject and the result is cached for each
+    label, so the regular expressions run only once for each label.
+    """
+    def __init__(self, subj):
+        self.subj = subj
+
+        rules = list(PIAL_RULES)
+        rules.extend((x, None, False)
+                     for x in SUBJ_PIAL_PATTERNS.get(subj, ()))
+        self._rules = [(re_compile(pattern),
+                        None if exception is None else re_compile(exception),
+                        upper) for pattern, exception, upper in rules]
+        self._exclude = [re_compile(x)
+                         for x in SUBJ_NOT_PIAL_PATTERNS.get(subj, ())]
+
+        self._cache = {}
+
+    def __call__(self, label):
+        """Check if one label is on the pial surface.
+
+        Parameters
+        ----------
+        label : str
+            label of one channel
+
+        Returns
+        -------
+        bool
+            if the channel should be on the pial surface
+        """
+        try:
+            return self._cache[label]
+        except KeyError:
+            pass
+
+        upper_label = label.upper()
+        on_pial = label in PIAL_LABELS
+        for pattern, exception, upper in self._rules:
+            if on_pial:
+                break
+            one_label = upper_label if upper else label
+            on_pial = (pattern.match(one_label) is not None and
+                       (exception is None or
+                        exception.match(one_label) is None))
+
+        if on_pial:
+            on_pial = not any(x.match(label) for x in self._exclude)
+
+        self._cache[label] = on_pial
+        return on_pial
+
+    def classify(self, chan):
+        """Classify all the channels in one pass.
+
+        Parameters
+        ----------
+        chan : instance of phypno.attr.chan.Channels
+            channels to classify
+
+        Returns
+        -------
+        numpy.ndarray of bool
+            for each channel, if it should be on the pial surface
+        """
+        return array([self(one_chan.label) for one_chan in chan.chan],
+                     dtype=bool)
+
+    def split(self, chan):
+        """Split the channels into channels on the pial surface and the rest.
+
+        Parameters
+        ----------
+        chan : instance of phypno.attr.chan.Channels
+            channels to split
+
+        Returns
+        -------
+        instance of phypno.attr.chan.Channels
+            channels on the pial surface (grid and strips)
+        instance of phypno.attr.chan.Channels
+            the other channels (depth)
+        """
+        self.classify(chan)  # fill the cache
+        return (chan(lambda x: self._cache[x.label]),
+                chan(lambda x: not self._cache[x.label]))
+
+
+@lru_cache(maxsize=None)
+def get_pial_classifier(subj):
+    """Return the classifier for one subject (only created once)."""
+    return PialClassifier(subj)
 
 
 def is_on_pial(subj, chan):
@@ -27,47 +166,34 @@ def is_on_pial(subj, chan):
     -------
     bool
         if the channel should be on the pial surface
+
+    Notes
+    -----
+    To classify many channels, use get_pial_classifier(subj).split(chan)
     """
-    label = chan.label
-    G1 = match('.*G[0-9]{1,2}$', label)
-    CING1 = match('.*CING[0-9]$', label)
-    GR1 = match('.*GR[0-9]{1,2}$', label.upper())
-    RG1 = match('.*RG[0-9]{1,2}$', label.upper())  # typo for gr
-    S1 = match('.*S[0-9]$', label.upper()) and not match('.*INS[0-9]$', label.upper())
-    ref = match('REF[0-9]$', label.upper())
-    neuroport = label in ('neuroport', 'Neuroport')
-    microgrid = match('.*micro$', label.upper())
-
-    extra = False
-    if subj == 'MG33':
-        extra = extra or match('.*TT[0-9]{1}$', label)
-        extra = extra or match('.*SbT[0-9]{1}$', label)
-        extra = extra or match('.*PO[0-9]{1}$', label)
-    if subj == 'MG63':
-        extra = extra or match('.*AST[0-9]{1}$', label)
-        extra = extra or match('.*PST[0-9]{1}$', label)
-
-    is_on_pial = ((G1 and not CING1) or GR1 or RG1 or S1 or ref or
-                  neuroport or microgrid or extra)
-
-    is_not_on_pial = True
-    if subj == 'MG91':
-        is_not_on_pial = not match('.*L[AP]TS[0-9]{1}$', label)
-
-    return is_on_pial and is_not_on_pial
-
-
-def adjust_grid_strip_chan(chan, freesurfer, subj):
+    return get_pial_classifier(subj)(chan.label)
+
+
+@traced
+def adjust_grid_strip_chan(chan, freesurfer, subj, previous=None,
+                           diagnostics=None):
     """Adjust only grid and strip channels.
 
     Parameters
     ----------
     chan : instance of phypno.attr.chan.Channels
         channels to snap, with or without grid
-    freesurfer : instance of phypno.attr.anat.Freesurfer
-        freesurfer information
+    freesurfer : instance of eloc.anat_cache.SharedAnatomy
+        freesurfer information (or phypno.attr.anat.Freesurfer)
     subj : str
         subject code, used to define which channels are on the pial surface
+    previous : dict, optional
+        snapping of another session of the same subject (see
+        eloc.optimization_snap.previous_snap), to reuse for the unchanged
+        contacts
+    diagnostics : list, optional
+        list where to append the convergence of the snapping of each array
+        (see eloc.optimization_snap.snap_chan_to_surf)
 
     Returns
     -------
@@ -85,11 +211,7 @@ def adjust_grid_strip_chan(chan, freesurfer, subj):
     EM08 has 4 channels called G. They are not grid.
 
     """
-    def is_on_pial_for_subj(x): return is_on_pial(subj, x)
-    grid_strip_chan = chan(is_on_pial_for_subj)
-
-    def is_not_on_pial_for_subj(x): return not is_on_pial(subj, x)
-    depth_chan = chan(is_not_on_pial_for_subj)
+    grid_strip_chan, depth_chan = get_pial_classifier(subj).split(chan)
 
     lg.info('grid/strip chan: ' + ','.join(grid_strip_chan.return_label()))
     lg.info('depth chan: ' + ','.join(depth_chan.return_label()))
@@ -109,35 +231,83 @@ def adjust_grid_strip_chan(chan, freesurfer, subj):
             raise ValueError('Not enough electrodes on either side.')
 
         pial_surf = getattr(freesurfer.read_brain('pial'), hemi)
-        return _snap_to_surf(grid_strip_chan, pial_surf)
+        return _snap_to_surf(grid_strip_chan, pial_surf, previous,
+                             diagnostics)
 
     else:
         return chan
 
 
-def _snap_to_surf(chan, surf):
+def _snap_to_surf(chan, surf, previous=None, diagnostics=None):
 
-    data_path = Path(mkdtemp())
-    lg.debug('temporary path: ' + str(data_path))
+    smooth = make_outer_smooth_surface(surf.surf_file)
 
-    pial = surf.surf_file
-    filled = data_path.joinpath('pial.filled.mgz')
-    outer = data_path.joinpath('pial_outer')
-    smooth = data_path.joinpath('pial_outer_smooth')
+    # snap electrodes
+    return snap_chan_to_surf(chan, str(smooth), previous,
+                             diagnostics=diagnostics)
 
-    chan_path = data_path.joinpath('chan.csv')
-    chan_snapped_path = data_path.joinpath('chan_snapped.csv')
-    chan.export(str(chan_path))
 
-    # create smooth surface
-    check_call(['mris_fill', '-c', '-r', '1', str(pial), str(filled)])
-    check_call(['./run_make_outer_surface.sh', str(MCRROOT), str(filled), '15',
-                str(outer)], cwd=MATLAB_BIN)
-    check_call(['mris_smooth', '-nw', '-n', '60',  str(outer), str(smooth)])
+@traced
+def make_outer_smooth_surface(pial, cache=None, method='python',
+                              mcr_root=MCRROOT, matlab_bin=MATLAB_BIN):
+    """Create the smooth envelope of the pial surface (or get it from cache).
 
-    # snap electrodes
-    check_call(['./run_snap_elec.sh', str(MCRROOT), str(smooth),
-                str(chan_path)], cwd=MATLAB_BIN)
-    chan = Channels(str(chan_snapped_path))
+    Parameters
+    ----------
+    pial : path to file
+        pial surface (?h.pial)
+    cache : instance of SurfaceCache, optional
+        cache for the surfaces. If not specified, it uses the default cache.
+    method : str
+        'python' computes the surface in python (see eloc.outer_surface),
+        'freesurfer' runs mris_fill, make_outer_surface and mris_smooth (their
+        logs are written in the cache, next to the surface).
+    mcr_root : path to dir
+        MATLAB Compiler Runtime, for method 'freesurfer' (default: the
+        environment variable ELOC_MCR_ROOT, or MCRROOT)
+    matlab_bin : path to dir
+        directory with the compiled make_outer_surface, for method
+        'freesurfer' (default: the environment variable ELOC_MATLAB_BIN, or
+        MATLAB_BIN)
+
+    Returns
+    -------
+    path to file
+        the smooth outer surface (like ?h.pial_outer_smooth)
+    """
+    if cache is None:
+        cache = SurfaceCache()
+
+    key = cache.key(pial, fill_resolution=FILL_RESOLUTION,
+                    outer_radius=OUTER_RADIUS, smooth_iter=SMOOTH_ITER,
+                    method=method)
+
+    def _create(data_path):
+        smooth = data_path.joinpath('pial_outer_smooth')
+
+        if method == 'python':
+            vert, tri = read_surf(pial)
+            smooth_vert, smooth_tri = outer_smooth_surface(vert, tri)
+            write_surf(smooth, smooth_vert, smooth_tri)
+
+        elif method == 'freesurfer':
+            filled = data_path.joinpath('pial.filled.mgz')
+            outer = data_path.joinpath('pial_outer')
+
+            run_tool(['mris_fill', '-c', '-r', FILL_RESOLUTION, pial, filled],
+                     log_file=cache.log_file(key, 'mris_fill'))
+            # the compiled matlab function, with the environment of the MCR
+            # (instead of run_make_outer_surface.sh)
+            run_tool([Path(matlab_bin, 'make_outer_surface'), filled,
+                      OUTER_RADIUS, outer], env=mcr_env(mcr_root),
+                     cwd=matlab_bin,
+                     log_file=cache.log_file(key, 'make_outer_surface'))
+            run_tool(['mris_smooth', '-nw', '-n', SMOOTH_ITER, outer, smooth],
+                     log_file=cache.log_file(key, 'mris_smooth'))
+
+        else:
+            raise ValueError('Unknown method "' + method + '"')
+
+        return smooth
 
-    return chan
+    return cache.get_or_create(key, _create)
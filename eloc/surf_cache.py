@@ -0,0 +1,266 @@
+"""Persistent cache for the surfaces that only depend on the pial surface.
+
+The key of each entry is the hash of the content of the pial file plus the
+parameters used to compute the surface, so a cached surface is never stale.
+When the cache grows beyond the maximum size, the entries that were used least
+recently are removed. Entries are created in a temporary directory inside the
+cache and then renamed, and the cache is protected by file locks, so that
+different processes can use the same cache at the same time.
+"""
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+from hashlib import sha1
+from logging import getLogger
+from os import environ, fstat, replace, stat, utime
+from pathlib import Path
+from shutil import copyfileobj
+from tempfile import mkstemp, TemporaryDirectory
+
+lg = getLogger(__name__)
+
+CACHE_DIR = Path(environ.get('ELOC_CACHE_DIR',
+                             str(Path.home().joinpath('.cache', 'eloc'))))
+MAX_CACHE_SIZE = 2 * 1024 ** 3  # in bytes
+HASH_BLOCK = 1024 ** 2
+
+_hashes = {}  # path -> (size, mtime, inode) and hash, within one process
+
+
+def file_hash(file_name):
+    """Compute the hash of the content of a file.
+
+    Parameters
+    ----------
+    file_name : path to file
+        file to hash
+
+    Returns
+    -------
+    str
+        sha1 hexdigest of the content of the file
+    """
+    h = sha1()
+    with open(str(file_name), 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _cached_file_hash(file_name):
+    """Hash of the content of a file, computed again only if the file has
+    changed (size, modification time or inode)."""
+    file_stat = stat(str(file_name))
+    fingerprint = (file_stat.st_size, file_stat.st_mtime_ns,
+                   file_stat.st_ino)
+    cached = _hashes.get(str(file_name))
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    h = file_hash(file_name)
+    _hashes[str(file_name)] = (fingerprint, h)
+    return h
+
+
+class SurfaceCache:
+    """Content-addressed cache on disk, with LRU eviction.
+
+    Parameters
+    ----------
+    cache_dir : path to dir, optional
+        directory of the cache (it can be shared across processes)
+    max_size : int, optional
+        maximum size of the cache, in bytes
+
+    Notes
+    -----
+    The time of last use of each entry is stored as the modification time of
+    the file, so it's shared across processes without extra bookkeeping.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_size=MAX_CACHE_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, input_file, **params):
+        """Key of the entry, based on the input file and the parameters.
+
+        Parameters
+        ----------
+        input_file : path to file
+            file the entry depends on (f.e. ?h.pial)
+        params
+            parameters used to compute the entry
+
+        Returns
+        -------
+        str
+            key of the entry
+
+        Notes
+        -----
+        The content of the input file is hashed only the first time and when
+        its size, modification time or inode change.
+        """
+        h = sha1(_cached_file_hash(input_file).encode())
+        for name in sorted(params):
+            h.update('{}={};'.format(name, params[name]).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return the path to the cached entry (or None if it's not cached)"""
+        entry = self.cache_dir.joinpath(key)
+        try:
+            utime(str(entry))  # mark as recently used
+        except FileNotFoundError:
+            return None
+        lg.debug('cache hit: ' + key)
+        return entry
+
+    def put(self, key, src_file, move=False):
+        """Copy (or move) a file into the cache.
+
+        Parameters
+        ----------
+        key : str
+            key of the entry
+        src_file : path to file
+            file to store in the cache
+        move : bool
+            move the file instead of copying it (it should be on the same
+            file system as the cache, see get_or_create)
+
+        Returns
+        -------
+        path to file
+            path to the cached entry
+        """
+        entry = self.cache_dir.joinpath(key)
+
+        if move:
+            replace(str(src_file), str(entry))  # atomic
+        else:
+            fd, tmp_file = mkstemp(dir=str(self.cache_dir), prefix='.tmp')
+            with open(fd, 'wb') as f_out, open(str(src_file), 'rb') as f_in:
+                copyfileobj(f_in, f_out, HASH_BLOCK)
+            replace(tmp_file, str(entry))  # atomic
+        lg.debug('cache store: ' + key)
+
+        self.evict(keep=key)
+        return entry
+
+    @contextmanager
+    def lock(self, key=None):
+        """Exclusive lock across processes (for one entry or for the cache).
+
+        Notes
+        -----
+        evict removes the lock files which are not in use, so if the lock
+        file was removed while waiting, it locks the new file.
+        """
+        lock_file = self.cache_dir.joinpath('.' + (key or 'cache') + '.lock')
+        while True:
+            f = lock_file.open('a')
+            flock(f, LOCK_EX)
+            if _is_same_file(f, lock_file):
+                break
+            f.close()
+        try:
+            yield
+        finally:
+            flock(f, LOCK_UN)
+            f.close()
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache is small
+        enough, and the lock files which are not in use.
+
+        Parameters
+        ----------
+        keep : str, optional
+            key of an entry which is never removed (f.e. the one just stored)
+        """
+        with self.lock():
+            entries = []
+            for one_file in self.cache_dir.iterdir():
+                if one_file.name.startswith('.'):  # locks and temporary files
+                    continue
+                if one_file.name == keep:
+                    continue
+                try:
+                    file_stat = one_file.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((file_stat.st_mtime, file_stat.st_size,
+                                one_file))
+
+            total = sum(x[1] for x in entries)
+            if keep is not None:
+                total += _size_or_zero(self.cache_dir.joinpath(keep))
+            for _, size, one_file in sorted(entries, key=lambda x: x[0]):
+                if total <= self.max_size:
+                    break
+                lg.debug('cache evict: ' + one_file.name)
+                try:
+                    one_file.unlink()
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+            for lock_file in self.cache_dir.glob('.*.lock'):
+                if lock_file.name == '.cache.lock':  # held here
+                    continue
+                with lock_file.open('a') as f:
+                    try:
+                        flock(f, LOCK_EX | LOCK_NB)
+                    except BlockingIOError:  # an entry is being created
+                        continue
+                    lock_file.unlink()
+
+    def log_file(self, key, name):
+        """File for the log of a tool which creates an entry (it's next to
+        the entry, so it's kept also when the tool fails)."""
+        return self.cache_dir.joinpath(key + '.' + name + '.log')
+
+    def get_or_create(self, key, create):
+        """Return the cached entry, or create it only once across processes.
+
+        Parameters
+        ----------
+        key : str
+            key of the entry
+        create : function
+            function which takes a temporary directory (pathlib.Path) and
+            returns the path to the file to store in the cache. The file is
+            moved into the cache and the directory is then removed.
+
+        Returns
+        -------
+        path to file
+            path to the cached entry
+        """
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+
+        with self.lock(key):
+            entry = self.get(key)  # another process might have created it
+            if entry is None:
+                with TemporaryDirectory(dir=str(self.cache_dir),
+                                        prefix='.tmp') as tmp_dir:
+                    entry = self.put(key, create(Path(tmp_dir)), move=True)
+        return entry
+
+
+def _is_same_file(f, file_name):
+    """Whether the open file is still the file with this name."""
+    try:
+        return fstat(f.fileno()).st_ino == stat(str(file_name)).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _size_or_zero(file_name):
+    try:
+        return file_name.stat().st_size
+    except FileNotFoundError:
+        return 0
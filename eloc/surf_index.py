@@ -0,0 +1,289 @@
+"""Spatial index to compute the distance between points and a surface.
+
+The index is built once per surface (f.e. ?h.pial_outer_smooth) and then it
+can be queried in batch, by the snapping code or to find the closest vertex to
+each channel.
+"""
+from functools import lru_cache
+from logging import getLogger
+
+from numpy import (add, arange, asarray, cross, einsum, errstate, full, inf,
+                   isnan, minimum, sqrt, zeros)
+from scipy.spatial import cKDTree
+
+from .surf_io import load_surf_mmap
+
+lg = getLogger(__name__)
+
+
+class SurfaceIndex:
+    """KD-tree over the vertices and over the triangles of a surface.
+
+    Parameters
+    ----------
+    vert : numpy.ndarray
+        n_vert X 3 matrix with the vertices of the surface
+    tri : numpy.ndarray, optional
+        n_tri X 3 matrix with the indices of the vertices of each triangle. If
+        not specified, only the distance to the vertices can be computed.
+
+    Attributes
+    ----------
+    vert : numpy.ndarray
+        vertices of the surface
+    tri : numpy.ndarray or None
+        triangles of the surface
+    tri_normal : numpy.ndarray or None
+        unit normal of each triangle (with the orientation of the triangles)
+    vert_normal : numpy.ndarray or None
+        unit normal of each vertex (area-weighted mean of its triangles)
+    """
+    def __init__(self, vert, tri=None):
+        self.vert = asarray(vert, dtype=float)
+        self.tri = None if tri is None else asarray(tri, dtype=int)
+
+        self._vert_tree = cKDTree(self.vert)
+        self.tri_normal = None
+        self.vert_normal = None
+
+        if self.tri is not None:
+            tri_vert = self.vert[self.tri, :]
+            normal = cross(tri_vert[:, 1, :] - tri_vert[:, 0, :],
+                           tri_vert[:, 2, :] - tri_vert[:, 0, :])
+            vert_normal = zeros(self.vert.shape)
+            for i in range(3):
+                add.at(vert_normal, self.tri[:, i], normal)
+            self.tri_normal = _unit(normal)
+            self.vert_normal = _unit(vert_normal)
+
+            centroid = tri_vert.mean(axis=1)
+            radius = sqrt(((tri_vert - centroid[:, None, :]) ** 2).sum(axis=2))
+            self._tri_tree = cKDTree(centroid)
+            self._tri_radius = radius.max()
+
+    @classmethod
+    def from_surf(cls, surf):
+        """Create the index from a phypno.attr.anat.Surf"""
+        return cls(surf.vert, surf.tri)
+
+    def nearest_vertex(self, points):
+        """Find the closest vertex to each point.
+
+        Parameters
+        ----------
+        points : numpy.ndarray
+            n_points X 3 matrix with the points of interest
+
+        Returns
+        -------
+        numpy.ndarray
+            vector of length n_points with the distance to the closest vertex
+        numpy.ndarray
+            vector of length n_points with the index of the closest vertex
+        """
+        return self._vert_tree.query(asarray(points, dtype=float))
+
+    def distance(self, points, exact=True):
+        """Compute the distance between each point and the surface.
+
+        Parameters
+        ----------
+        points : numpy.ndarray
+            n_points X 3 matrix with the points of interest
+        exact : bool
+            if True, compute the distance to the closest triangle, otherwise
+            to the closest vertex.
+
+        Returns
+        -------
+        numpy.ndarray
+            vector of length n_points with the distance to the surface
+        numpy.ndarray
+            n_points X 3 matrix with the closest point on the surface
+        numpy.ndarray
+            n_points X 3 matrix with the gradient of the distance with respect
+            to the position of each point
+        """
+        points = asarray(points, dtype=float)
+        dist, idx = self.nearest_vertex(points)
+        closest = self.vert[idx, :]
+
+        if exact and self.tri is not None:
+            dist, closest, _ = self._distance_to_tri(points, dist, closest)
+
+        safe_dist = dist.copy()
+        safe_dist[safe_dist == 0] = 1
+        grad = (points - closest) / safe_dist[:, None]
+
+        return dist, closest, grad
+
+    def signed_distance(self, points):
+        """Compute the signed distance between each point and the surface.
+
+        Parameters
+        ----------
+        points : numpy.ndarray
+            n_points X 3 matrix with the points of interest
+
+        Returns
+        -------
+        numpy.ndarray
+            vector of length n_points with the distance to the surface,
+            positive on the side of the normals (outside, for FreeSurfer
+            surfaces)
+        numpy.ndarray
+            n_points X 3 matrix with the closest point on the surface
+        numpy.ndarray
+            n_points X 3 matrix with the gradient of the distance: the normal
+            of the closest triangle (or vertex). Unlike the gradient of the
+            unsigned distance, it's not zero on the surface, so it can be used
+            in an equality constraint.
+
+        Raises
+        ------
+        ValueError
+            if the index has no triangles
+        """
+        if self.tri is None:
+            raise ValueError('The signed distance needs the triangles')
+
+        points = asarray(points, dtype=float)
+        dist, idx = self.nearest_vertex(points)
+        closest = self.vert[idx, :]
+        normal = self.vert_normal[idx, :]
+
+        dist, closest, best_tri = self._distance_to_tri(points, dist, closest)
+        on_tri = best_tri >= 0
+        normal[on_tri] = self.tri_normal[best_tri[on_tri], :]
+
+        dist = einsum('ij,ij->i', points - closest, normal)
+        return dist, closest, normal
+
+    def _distance_to_tri(self, points, dist_vert, closest_vert):
+        """Only triangles whose centroid is closer than the closest vertex
+        plus the largest triangle radius can contain the closest point, so
+        the result is exact."""
+        candidates = self._tri_tree.query_ball_point(
+            points, dist_vert + self._tri_radius)
+
+        n_cand = [len(x) for x in candidates]
+        pnt_idx = arange(len(points)).repeat(n_cand)
+        tri_idx = asarray([x for one in candidates for x in one], dtype=int)
+
+        dist = dist_vert.copy()
+        closest = closest_vert.copy()
+        best_tri = full(len(points), -1)
+        if len(tri_idx) == 0:
+            return dist, closest, best_tri
+
+        tri_vert = self.vert[self.tri[tri_idx, :], :]
+        cand_closest = closest_point_on_triangle(points[pnt_idx, :],
+                                                 tri_vert[:, 0, :],
+                                                 tri_vert[:, 1, :],
+                                                 tri_vert[:, 2, :])
+        cand_dist = sqrt(((points[pnt_idx, :] - cand_closest) ** 2
+                          ).sum(axis=1))
+        cand_dist[isnan(cand_dist)] = inf  # degenerate triangles
+
+        best = full(len(points), inf)
+        minimum.at(best, pnt_idx, cand_dist)
+        is_best = cand_dist == best[pnt_idx]
+        better = is_best & (cand_dist < dist[pnt_idx])
+
+        dist[pnt_idx[better]] = cand_dist[better]
+        closest[pnt_idx[better], :] = cand_closest[better, :]
+        best_tri[pnt_idx[better]] = tri_idx[better]
+
+        return dist, closest, best_tri
+
+
+def closest_point_on_triangle(p, a, b, c):
+    """Closest point on each triangle (vectorized).
+
+    Parameters
+    ----------
+    p : numpy.ndarray
+        n X 3 matrix with the points
+    a, b, c : numpy.ndarray
+        n X 3 matrices with the vertices of the triangles
+
+    Returns
+    -------
+    numpy.ndarray
+        n X 3 matrix with the closest point on each triangle
+
+    Notes
+    -----
+    From Ericson, Real-Time Collision Detection (2005), section 5.1.5. The
+    regions are assigned from the last to the first, so that the first region
+    that matches takes precedence, like in the original algorithm.
+    """
+    def dot(x, y): return einsum('ij,ij->i', x, y)
+
+    ab = b - a
+    ac = c - a
+    ap = p - a
+    bp = p - b
+    cp = p - c
+
+    d1 = dot(ab, ap)
+    d2 = dot(ac, ap)
+    d3 = dot(ab, bp)
+    d4 = dot(ac, bp)
+    d5 = dot(ab, cp)
+    d6 = dot(ac, cp)
+
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    with errstate(divide='ignore', invalid='ignore'):
+        denom = 1 / (va + vb + vc)
+        out = a + ab * (vb * denom)[:, None] + ac * (vc * denom)[:, None]
+
+        region = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)  # edge BC
+        w = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+        out[region] = (b + (c - b) * w[:, None])[region]
+
+        region = (vb <= 0) & (d2 >= 0) & (d6 <= 0)  # edge AC
+        w = d2 / (d2 - d6)
+        out[region] = (a + ac * w[:, None])[region]
+
+        region = (d6 >= 0) & (d5 <= d6)  # vertex C
+        out[region] = c[region]
+
+        region = (vc <= 0) & (d1 >= 0) & (d3 <= 0)  # edge AB
+        v = d1 / (d1 - d3)
+        out[region] = (a + ab * v[:, None])[region]
+
+        region = (d3 >= 0) & (d4 <= d3)  # vertex B
+        out[region] = b[region]
+
+        region = (d1 <= 0) & (d2 <= 0)  # vertex A
+        out[region] = a[region]
+
+    return out
+
+
+def _unit(x):
+    norm = sqrt((x ** 2).sum(axis=1))
+    norm[norm == 0] = 1
+    return x / norm[:, None]
+
+
+@lru_cache(maxsize=4)
+def load_surface_index(surf_file):
+    """Read a surface from file and build its index only once.
+
+    Parameters
+    ----------
+    surf_file : str
+        path to the freesurfer surface (f.e. lh.pial_outer_smooth)
+
+    Returns
+    -------
+    instance of SurfaceIndex
+        index of the surface
+    """
+    lg.debug('building surface index for ' + str(surf_file))
+    return SurfaceIndex(*load_surf_mmap(surf_file))
@@ -0,0 +1,159 @@
+"""Read and write FreeSurfer surfaces, with numpy only.
+
+The whole file is read at once and decoded with numpy.frombuffer (big-endian),
+including the 3-byte integers of the quad files. The surfaces can be stored
+as .npy files in the cache, which are then memory-mapped, so that later loads
+do not parse the file and the arrays are shared across processes.
+"""
+from logging import getLogger
+
+from numpy import (asarray, dtype, empty, float64, frombuffer, int32, load,
+                   save, uint8, where)
+
+from .surf_cache import SurfaceCache
+
+lg = getLogger(__name__)
+
+TRIANGLE_MAGIC = 16777214  # 0xFFFFFE
+QUAD_MAGIC = 16777215  # 0xFFFFFF, vertices as int16 / 100
+NEW_QUAD_MAGIC = 16777213  # 0xFFFFFD, vertices as float32
+
+BE_INT32 = dtype('>i4')
+BE_FLOAT32 = dtype('>f4')
+BE_INT16 = dtype('>i2')
+
+
+def read_surf(surf_file):
+    """Read a FreeSurfer surface (triangle or quad file).
+
+    Parameters
+    ----------
+    surf_file : path to file
+        freesurfer surface (f.e. lh.pial)
+
+    Returns
+    -------
+    numpy.ndarray
+        n_vert X 3 matrix with the vertices (float64)
+    numpy.ndarray
+        n_tri X 3 matrix with the triangles (int32). Each quad is split into
+        two triangles, in the same way as FreeSurfer and nibabel.
+    """
+    with open(str(surf_file), 'rb') as f:
+        data = f.read()
+
+    magic = _int3(data[:3])[0]
+
+    if magic == TRIANGLE_MAGIC:
+        # two lines of text (creator and date), then the number of vertices
+        # and faces
+        pos = data.index(b'\n', 3) + 1
+        pos = data.index(b'\n', pos) + 1
+        n_vert, n_tri = (int(x) for x in frombuffer(data, BE_INT32, 2, pos))
+        pos += 8
+        vert = frombuffer(data, BE_FLOAT32, n_vert * 3, pos)
+        pos += n_vert * 3 * 4
+        tri = frombuffer(data, BE_INT32, n_tri * 3, pos).reshape(-1, 3)
+
+    elif magic in (QUAD_MAGIC, NEW_QUAD_MAGIC):
+        n_vert, n_quad = (int(x) for x in _int3(data[3:9]))
+        pos = 9
+        if magic == QUAD_MAGIC:
+            vert = frombuffer(data, BE_INT16, n_vert * 3, pos) / 100
+            pos += n_vert * 3 * 2
+        else:
+            vert = frombuffer(data, BE_FLOAT32, n_vert * 3, pos)
+            pos += n_vert * 3 * 4
+        quad = _int3(data[pos:pos + n_quad * 4 * 3]).reshape(-1, 4)
+        tri = _quad_to_tri(quad)
+
+    else:
+        raise ValueError('Unknown surface format in ' + str(surf_file))
+
+    return (vert.reshape(-1, 3).astype(float64),
+            asarray(tri, dtype=int32))
+
+
+def write_surf(surf_file, vert, tri, create_stamp='created by eloc'):
+    """Write a FreeSurfer triangle surface.
+
+    Parameters
+    ----------
+    surf_file : path to file
+        output file
+    vert : numpy.ndarray
+        n_vert X 3 matrix with the vertices
+    tri : numpy.ndarray
+        n_tri X 3 matrix with the triangles
+    create_stamp : str
+        text stored in the header
+    """
+    vert = asarray(vert)
+    tri = asarray(tri)
+    with open(str(surf_file), 'wb') as f:
+        f.write(TRIANGLE_MAGIC.to_bytes(3, 'big'))
+        f.write((create_stamp + '\n\n').encode())
+        f.write(asarray((len(vert), len(tri)), dtype=BE_INT32).tobytes())
+        f.write(vert.astype(BE_FLOAT32).tobytes())
+        f.write(tri.astype(BE_INT32).tobytes())
+
+
+def load_surf_mmap(surf_file, cache=None):
+    """Read a freesurfer surface as memory-mapped arrays.
+
+    Parameters
+    ----------
+    surf_file : path to file
+        freesurfer surface
+    cache : instance of SurfaceCache, optional
+        where to store the .npy copies
+
+    Returns
+    -------
+    numpy.memmap
+        n_vert X 3 matrix with the vertices (float64)
+    numpy.memmap
+        n_tri X 3 matrix with the triangles (int32)
+    """
+    if cache is None:
+        cache = SurfaceCache()
+
+    geometry = []
+
+    def _read():
+        if not geometry:
+            geometry.extend(read_surf(surf_file))
+        return geometry
+
+    def _create_vert(tmp_dir):
+        return _save_npy(_read()[0], tmp_dir)
+
+    def _create_tri(tmp_dir):
+        return _save_npy(_read()[1], tmp_dir)
+
+    vert = cache.get_or_create(cache.key(surf_file, kind='vert'),
+                               _create_vert)
+    tri = cache.get_or_create(cache.key(surf_file, kind='tri'), _create_tri)
+
+    return load(str(vert), mmap_mode='r'), load(str(tri), mmap_mode='r')
+
+
+def _save_npy(data, tmp_dir):
+    npy_file = tmp_dir.joinpath('data.npy')
+    save(str(npy_file), data)
+    return npy_file
+
+
+def _int3(data):
+    """Decode big-endian 3-byte integers."""
+    b = frombuffer(data, uint8).reshape(-1, 3).astype(int32)
+    return (b[:, 0] << 16) | (b[:, 1] << 8) | b[:, 2]
+
+
+def _quad_to_tri(quad):
+    """Split each quad into two triangles, depending on the first vertex."""
+    even = (quad[:, 0] % 2 == 0)[:, None]
+    tri = empty((quad.shape[0] * 2, 3), dtype=int32)
+    tri[0::2] = where(even, quad[:, [0, 1, 3]], quad[:, [0, 1, 2]])
+    tri[1::2] = where(even, quad[:, [2, 3, 1]], quad[:, [0, 2, 3]])
+    return tri
@@ -0,0 +1,145 @@
+"""Run the external tools (FreeSurfer, MNE, MATLAB runtime, Imagemagick).
+
+The commands are lists of arguments (never a shell string) and the
+environment is explicit (f.e. SUBJECTS_DIR or LD_LIBRARY_PATH for the MATLAB
+runtime). Each call has a timeout and its output is captured and written to a
+log file. Independent commands can run at the same time with ToolRunner, which
+limits how many tools run at once.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from os import environ, pathsep
+from pathlib import Path
+from subprocess import PIPE, STDOUT, TimeoutExpired, run
+
+from .trace import measure
+
+lg = getLogger(__name__)
+
+TIMEOUT = 2 * 60 * 60  # in s
+N_TOOLS = 2  # max number of tools running at the same time
+LOG_TAIL = 2000  # characters of the log in the error message
+
+
+class ToolError(Exception):
+    """An external tool failed or timed out."""
+    pass
+
+
+def run_tool(args, env=None, cwd=None, timeout=TIMEOUT, log_file=None):
+    """Run one external tool.
+
+    Parameters
+    ----------
+    args : list of str
+        the command and its arguments
+    env : dict, optional
+        variables added to the environment (f.e. SUBJECTS_DIR)
+    cwd : path to dir, optional
+        working directory
+    timeout : float
+        max duration, in s
+    log_file : path to file, optional
+        file where to write the output (stdout and stderr) of the tool
+
+    Returns
+    -------
+    str
+        output of the tool
+
+    Raises
+    ------
+    ToolError
+        if the tool returns an error or if it takes longer than timeout
+    """
+    args = [str(x) for x in args]
+    full_env = dict(environ)
+    if env is not None:
+        full_env.update({k: str(v) for k, v in env.items()})
+
+    lg.debug('running ' + ' '.join(args))
+    with measure('tool', cmd=Path(args[0]).name):
+        try:
+            result = run(args, stdout=PIPE, stderr=STDOUT, env=full_env,
+                         cwd=None if cwd is None else str(cwd),
+                         timeout=timeout, universal_newlines=True)
+            output, error = result.stdout, None
+            if result.returncode != 0:
+                error = 'returned {}'.format(result.returncode)
+        except TimeoutExpired as err:
+            output = err.output or ''
+            if isinstance(output, bytes):
+                output = output.decode(errors='replace')
+            error = 'timed out after {} s'.format(timeout)
+
+    if log_file is not None:
+        with open(str(log_file), 'w') as f:
+            f.write(' '.join(args) + '\n\n' + output)
+
+    if error is not None:
+        raise ToolError(Path(args[0]).name + ' ' + error + ':\n' +
+                        output[-LOG_TAIL:])
+
+    return output
+
+
+def mcr_env(mcr_root):
+    """Environment for the applications compiled with the MATLAB runtime.
+
+    Parameters
+    ----------
+    mcr_root : path to dir
+        directory of the MATLAB Compiler Runtime (f.e. .../v83)
+
+    Returns
+    -------
+    dict
+        LD_LIBRARY_PATH, as set by the run_*.sh scripts (it starts with the
+        working directory of the application, see run_tool)
+    """
+    mcr_root = Path(mcr_root)
+    lib_dirs = ['.',
+                mcr_root.joinpath('runtime', 'glnxa64'),
+                mcr_root.joinpath('bin', 'glnxa64'),
+                mcr_root.joinpath('sys', 'os', 'glnxa64'),
+                ]
+    if environ.get('LD_LIBRARY_PATH'):
+        lib_dirs.append(environ['LD_LIBRARY_PATH'])
+    return {'LD_LIBRARY_PATH': pathsep.join(str(x) for x in lib_dirs)}
+
+
+class ToolRunner:
+    """Run independent tools at the same time.
+
+    Parameters
+    ----------
+    n_tools : int
+        max number of tools running at the same time
+
+    Notes
+    -----
+    Use it as context manager: it waits for all the tools when it exits.
+
+    >>> with ToolRunner() as runner:
+    ...     lh = runner.submit(['mris_smooth', ...])
+    ...     rh = runner.submit(['mris_smooth', ...])
+    >>> lh.result()  # raises ToolError if the tool failed
+    """
+    def __init__(self, n_tools=N_TOOLS):
+        self._pool = ThreadPoolExecutor(max_workers=n_tools)
+
+    def submit(self, args, **kwargs):
+        """Run a tool (same arguments as run_tool).
+
+        Returns
+        -------
+        concurrent.futures.Future
+            its result is the output of the tool
+        """
+        return self._pool.submit(run_tool, args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._pool.shutdown(wait=True)
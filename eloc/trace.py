@@ -0,0 +1,172 @@
+"""Measure time and resources of each step of the pipeline.
+
+Each measure is an event with the wall time, the CPU time (of the process and
+of its child processes), the peak memory so far and the bytes read and
+written. The subject and session are added to all the events (see
+set_context). The events are collected in each process and they can be written
+as json lines or in the Chrome trace format (open it in chrome://tracing or in
+Perfetto).
+
+The events of a process pool are not collected automatically: the function
+that runs in the pool should return pop_events() and the caller should pass
+them to add_events (see eloc.optimization_snap).
+"""
+from contextlib import contextmanager
+from functools import wraps
+from json import dump, dumps
+from logging import getLogger
+from os import getpid
+from pathlib import Path
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from threading import get_ident
+from time import perf_counter, time
+
+lg = getLogger(__name__)
+
+PROC_IO = Path('/proc/self/io')
+IO_KEYS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+_events = []
+_context = {}
+
+
+def set_context(**kwargs):
+    """Tags added to all the following events (f.e. subj and sess)."""
+    _context.clear()
+    _context.update(kwargs)
+
+
+def pop_events():
+    """Return the events collected so far in this process and forget them."""
+    events = list(_events)
+    del _events[:]
+    return events
+
+
+def add_events(events):
+    """Add the events collected in another process (f.e. a worker of a
+    pool), with the tags of this process."""
+    for event in events:
+        for key, value in _context.items():
+            event.setdefault(key, value)
+        _events.append(event)
+
+
+@contextmanager
+def measure(name, **kwargs):
+    """Measure the resources used by a block of code.
+
+    Parameters
+    ----------
+    name : str
+        name of the step
+    kwargs
+        additional information to store in the event
+
+    Notes
+    -----
+    'peak_rss_so_far' is the maximum resident set size reached by the process
+    since it started (and 'peak_rss_children_so_far' by its terminated child
+    processes), in kB, from getrusage. It's not the peak of this step: a step
+    that uses less memory than an earlier step in the same process reports
+    the peak of the earlier step. The bytes read and written are from
+    /proc/self/io: 'rchar' and 'wchar' include the page cache, 'read_bytes'
+    and 'write_bytes' only count the storage.
+    """
+    start = _usage()
+    t0 = time()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        end = _usage()
+        event = dict(_context)
+        event.update(kwargs)
+        event.update({
+            'name': name,
+            'status': status,
+            'start': t0,
+            'pid': getpid(),
+            'tid': get_ident(),
+            'wall': end['wall'] - start['wall'],
+            'cpu': end['cpu'] - start['cpu'],
+            'cpu_children': end['cpu_children'] - start['cpu_children'],
+            'peak_rss_so_far': end['peak_rss_so_far'],
+            'peak_rss_children_so_far': end['peak_rss_children_so_far'],
+            })
+        event.update({k: end[k] - start[k] for k in IO_KEYS})
+        _events.append(event)
+        lg.debug(dumps(event))
+
+
+def traced(func):
+    """Decorator to measure each call of a function."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with measure(func.__module__ + '.' + func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def write_trace(events, trace_file):
+    """Write the events to file.
+
+    Parameters
+    ----------
+    events : list of dict
+        events (see measure)
+    trace_file : path to file
+        if the extension is '.jsonl', one json event per line, otherwise in
+        the Chrome trace format
+    """
+    trace_file = Path(trace_file)
+    if trace_file.suffix == '.jsonl':
+        with trace_file.open('w') as f:
+            for event in events:
+                f.write(dumps(event) + '\n')
+        return
+
+    trace_events = []
+    for event in events:
+        args = {k: v for k, v in event.items()
+                if k not in ('name', 'start', 'wall', 'pid', 'tid')}
+        name = event['name']
+        if 'subj' in event:
+            name = '{} sess{} {}'.format(event['subj'], event.get('sess', ''),
+                                         name)
+        trace_events.append({'name': name,
+                             'cat': 'eloc',
+                             'ph': 'X',
+                             'ts': event['start'] * 1e6,
+                             'dur': event['wall'] * 1e6,
+                             'pid': event['pid'],
+                             'tid': event['tid'],
+                             'args': args,
+                             })
+
+    with trace_file.open('w') as f:
+        dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _usage():
+    usage = getrusage(RUSAGE_SELF)
+    children = getrusage(RUSAGE_CHILDREN)
+    values = {'wall': perf_counter(),
+              'cpu': usage.ru_utime + usage.ru_stime,
+              'cpu_children': children.ru_utime + children.ru_stime,
+              'peak_rss_so_far': usage.ru_maxrss,
+              'peak_rss_children_so_far': children.ru_maxrss,
+              }
+    values.update({k: 0 for k in IO_KEYS})
+    try:
+        with PROC_IO.open() as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in IO_KEYS:
+                    values[key] = int(value)
+    except OSError:  # not linux or not allowed
+        pass
+    return values
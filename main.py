@@ -1,19 +1,15 @@
 # %gui qt4
 
+from argparse import ArgumentParser
 from logging import getLogger, DEBUG
 from os import listdir
-from os.path import join
 from sys import path
 path.append('/home/gio/projects/rcmg/scripts')
 path.append('/home/gio/projects/eloc/scripts')
 
-from phypno.attr import Channels, Freesurfer
-
 from rcmg.interfaces import make_struct
-from eloc.snap_grid_to_pial import adjust_grid_strip_chan
-from eloc.elec_info import (create_morph_maps, plot_rotating_brains,
-                            make_table_of_regions)
-from eloc.fix_chan_name import fix_chan_name, check_chan_name
+from eloc.batch import get_sessions, run_batch, N_HEAVY
+from eloc.cohort import reconcile_cohort
 
 lg = getLogger('eloc')
 lg.setLevel(DEBUG)
@@ -21,56 +17,61 @@ lg.setLevel(DEBUG)
 recdir = '/home/gio/recordings'
 
 
-for subj in sorted(listdir(recdir), reverse=False):
-
-    lg.info('\n' + subj)
-    dir_names = make_struct(subj, redo=False)
-
-    if subj in ('MG43', 'MG64', 'MG70', 'MG82'):
-        all_sess = ('A', 'B')
+def main():
+    """Localize the electrodes of the subjects in the command line."""
+    parser = ArgumentParser(description='Localize electrodes for all subjects')
+    parser.add_argument('--subj', nargs='+',
+                        help='subjects to run (default: all in ' + recdir +
+                        ')')
+    parser.add_argument('--sess', nargs='+',
+                        help='sessions to run (default: all for each '
+                        'subject)')
+    parser.add_argument('-j', '--n_workers', type=int,
+                        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--n_heavy', type=int, default=N_HEAVY,
+                        help='max number of memory-heavy steps at the same '
+                        'time')
+    parser.add_argument('--force', action='store_true',
+                        help='run all the steps, even if they are up to date')
+    parser.add_argument('--summary', default='eloc_summary.json',
+                        help='json file with the outcome of each job')
+    parser.add_argument('--store',
+                        help='directory of the store with the positions of '
+                        'all the subjects')
+    parser.add_argument('--trace',
+                        help='file with time and resources of each step '
+                        '(.json in Chrome trace format, .jsonl as json '
+                        'lines)')
+    parser.add_argument('--names_only', action='store_true',
+                        help='only rename and check the channel names of all '
+                        'the subjects')
+    parser.add_argument('--names_summary', default='eloc_names.csv',
+                        help='csv file with the number of mismatched names '
+                        'of each session (with --names_only)')
+    args = parser.parse_args()
+
+    if args.subj is None:
+        all_subj = sorted(listdir(recdir))
     else:
-        all_sess = ('A', )
-
-    for sess in all_sess:
+        all_subj = args.subj
 
-        elec_file = join(dir_names['doc_elec'], subj + '_elec_pos-orig_sess' +
-                         sess + '.csv')
-        adj_elec_file = join(dir_names['doc_elec'], subj +
-                             '_elec_pos-adjusted_sess' + sess + '.csv')
-        names_elec_file = join(dir_names['doc_elec'], subj +
-                               '_elec_pos-names_sess' + sess + '.csv')
+    jobs = []
+    for subj in all_subj:
 
-        create_morph_maps(join(dir_names['mri_proc']))
+        lg.info('\n' + subj)
+        dir_names = make_struct(subj, redo=False)
 
-        try:
-            chan = Channels(elec_file)
-            anat = Freesurfer(join(dir_names['mri_proc'], 'freesurfer'))
-        except (FileNotFoundError, OSError) as err:
-            lg.warn(err)
-            continue
+        for sess in get_sessions(subj):
+            if args.sess is None or sess in args.sess:
+                jobs.append((subj, sess, dir_names))
 
-        try:
-            chan = adjust_grid_strip_chan(chan, anat, subj)
-        except ValueError as err:
-            lg.warn(err)
-        chan.export(adj_elec_file)
-
-        gif_file = join(dir_names['doc_wiki'], subj + '_elec_pos-XX_sess' +
-                        sess + '.gif')
-        try:
-            plot_rotating_brains(chan, anat, gif_file, subj)
-        except FileNotFoundError:
-            continue
-
-        wiki_file = join(dir_names['doc_wiki'], subj + '_elec_pos-wiki_sess' +
-                         sess + '.txt')
-        make_table_of_regions(chan, anat, wiki_file, subj)
+    if args.names_only:
+        reconcile_cohort(jobs, summary_file=args.names_summary)
+    else:
+        run_batch(jobs, n_workers=args.n_workers, n_heavy=args.n_heavy,
+                  summary_file=args.summary, force=args.force,
+                  trace_file=args.trace, store_dir=args.store)
 
-        fix_chan_name(subj, adj_elec_file, names_elec_file)
-        chan = Channels(names_elec_file)
 
-        xltek_chan_file = join(dir_names['doc_elec'], 'xltek_elec_names.csv')
-        try:
-            check_chan_name(chan, xltek_chan_file, sess)
-        except FileNotFoundError:
-            continue
+if __name__ == '__main__':
+    main()
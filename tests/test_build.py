@@ -0,0 +1,53 @@
+from eloc.build import Pipeline, Stage
+
+
+def _pipeline(tmp_path, version='1'):
+    """'count' counts the lines of the input and 'report' writes the count"""
+    in_file = tmp_path.joinpath('in.txt')
+    count_file = tmp_path.joinpath('count.txt')
+    report_file = tmp_path.joinpath('report.txt')
+
+    def _count():
+        n_lines = len(in_file.read_text().splitlines())
+        count_file.write_text(str(n_lines))
+
+    def _report():
+        report_file.write_text('lines: ' + count_file.read_text())
+
+    pipeline = Pipeline(tmp_path.joinpath('stamp.json'))
+    # in the wrong order, it's sorted by inputs and outputs
+    pipeline.add(Stage('report', _report, inputs=[count_file],
+                       outputs=[report_file]))
+    pipeline.add(Stage('count', _count, inputs=[in_file],
+                       outputs=[count_file], version=version))
+    return pipeline
+
+
+def _ran(done):
+    return sorted(name for name, duration in done.items()
+                  if duration is not None)
+
+
+def test_pipeline_stamps(tmp_path):
+    in_file = tmp_path.joinpath('in.txt')
+    in_file.write_text('a\nb\n')
+    assert _ran(_pipeline(tmp_path).run()) == ['count', 'report']
+    assert tmp_path.joinpath('report.txt').read_text() == 'lines: 2'
+
+    assert _ran(_pipeline(tmp_path).run()) == []  # up to date
+
+    # the input changes, but not the output of count
+    in_file.write_text('aa\nbb\n')
+    assert _ran(_pipeline(tmp_path).run()) == ['count']
+
+    in_file.write_text('a\nb\nc\n')
+    assert _ran(_pipeline(tmp_path).run()) == ['count', 'report']
+    assert tmp_path.joinpath('report.txt').read_text() == 'lines: 3'
+
+    assert _ran(_pipeline(tmp_path, version='2').run()) == ['count']
+
+    tmp_path.joinpath('report.txt').unlink()
+    assert _ran(_pipeline(tmp_path, version='2').run()) == ['report']
+
+    assert _ran(_pipeline(tmp_path, version='2').run(force=True)) == [
+        'count', 'report']
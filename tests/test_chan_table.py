@@ -0,0 +1,24 @@
+from numpy.testing import assert_array_equal
+
+from eloc.chan_table import ChanTable
+
+
+def test_export(tmp_path):
+    """the positions are written with full precision"""
+    xyz = [[1 / 3, -2.5, 1e-7], [10, 20.125, -30]]
+    chan = ChanTable(['GR1', 'LTP 2'], xyz)
+    elec_file = tmp_path.joinpath('elec.csv')
+    chan.export(elec_file)
+
+    chan_read = ChanTable.from_file(elec_file)
+    assert chan_read.return_label() == ['GR1', 'LTP 2']
+    assert_array_equal(chan_read.return_xyz(), xyz)
+
+
+def test_export_view(tmp_path):
+    chan = ChanTable(['GR1', 'GR2', 'D1'], [[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+    elec_file = tmp_path.joinpath('elec.csv')
+    chan(lambda x: x.label.startswith('GR')).export(elec_file)
+
+    assert elec_file.read_text().splitlines() == ['GR1,1.0,2.0,3.0',
+                                                  'GR2,4.0,5.0,6.0']
@@ -0,0 +1,34 @@
+from numpy.testing import assert_array_equal
+
+from eloc.chan_table import ChanTable
+from eloc.elec_store import ElecStore
+
+
+def _chan(labels, offset=0):
+    return ChanTable(labels, [[i + offset, 0, 0] for i in range(len(labels))],
+                     {'region': ['ctx-lh-insula'] * len(labels)})
+
+
+def test_compact(tmp_path):
+    store = ElecStore(tmp_path)
+    store.update('XX01', 'A', 'adjusted', _chan(['GR1', 'GR2', 'D1']))
+    store.update('XX01', 'B', 'adjusted', _chan(['GR1']))
+    store.update('XX01', 'A', 'adjusted', _chan(['GR1', 'GR2'], offset=10))
+    store.compact()
+
+    assert list(tmp_path.joinpath('segments').glob('*/*/*/*.npz')) == []
+    assert len(list(tmp_path.glob('v*'))) == 1
+
+    store = ElecStore(tmp_path)  # read from disk
+    assert len(store) == 3
+    rows = store.select(sess='A')
+    assert list(store.columns['label'][rows]) == ['GR1', 'GR2']  # latest
+    assert_array_equal(store.columns['xyz'][rows, 0], [10, 11])
+    assert list(store.columns['pial'][rows]) == [True, True]
+
+    # a later update is applied on top of the compacted version
+    store.update('XX01', 'B', 'adjusted', _chan(['GR1', 'GR2', 'GR3']))
+    assert len(store) == 5
+    store.compact()
+    assert len(ElecStore(tmp_path)) == 5
+    assert len(list(tmp_path.glob('v*'))) == 2  # the previous one is kept
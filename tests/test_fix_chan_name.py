@@ -0,0 +1,66 @@
+from os import stat, utime
+
+from eloc.fix_chan_name import (ChanNameConsensus, get_mostcommon_chan_name,
+                                read_rename_rules, reconcile_chan_name)
+
+
+def test_read_rename_rules(tmp_path):
+    rules_file = tmp_path.joinpath('rules.csv')
+    rules_file.write_text('# comment\n'
+                          'subj,sess,old,new\n'
+                          'XX01,,fgr{1..3},FGR{1..3}\n'
+                          'XX01,B,"LTP{5,6}","LPT{5,6}"\n')
+    rules = read_rename_rules(rules_file)
+
+    all_sess = {'fgr1': 'FGR1', 'fgr2': 'FGR2', 'fgr3': 'FGR3'}
+    assert rules[('XX01', None)] == all_sess
+    assert rules[('XX01', 'B')] == dict(all_sess, LTP5='LPT5', LTP6='LPT6')
+
+
+def test_consensus_incremental_read(tmp_path):
+    """only the new rows are read, also after an incomplete row"""
+    xltek_file = tmp_path.joinpath('xltek_elec_names.csv')
+    xltek_file.write_text('d1_sessA,A1,A2\nd2_sessB,B1,B2\nd3_sessA,A1')
+    consensus = ChanNameConsensus('A')
+    consensus.read(xltek_file)
+    assert consensus.n_rows == 2
+    assert consensus.consensus() == (['A1', 'A2'], [1., 0.5])
+
+    with xltek_file.open('a') as f:
+        f.write(',C2\nd4_sessA,A1,C2\n')
+    consensus.read(xltek_file)
+    assert consensus.n_rows == 3
+    assert consensus.consensus() == (['A1', 'C2'], [1., 2 / 3])
+
+
+def test_mostcommon_chan_name_rewritten(tmp_path):
+    """a file rewritten with the same size is read again"""
+    xltek_file = tmp_path.joinpath('xltek_elec_names.csv')
+    xltek_file.write_text('d1_sessA,A1,A2\nd2_sessA,A1,B2\nd3_sessA,A1,A2\n')
+    assert get_mostcommon_chan_name(xltek_file, 'A') == ['A1', 'A2']
+
+    mtime_ns = stat(str(xltek_file)).st_mtime_ns
+    xltek_file.write_text('d1_sessA,C1,A2\nd2_sessA,C1,B2\nd3_sessA,C1,A2\n')
+    utime(str(xltek_file), ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+    assert get_mostcommon_chan_name(xltek_file, 'A') == ['C1', 'A2']
+
+
+def test_reconcile_chan_name_agreement():
+    report = reconcile_chan_name(['GR1', 'GR2'], ['GR1', 'GR2'], [1., 0.75])
+    assert report['agreement'] == [['GR2', 0.75]]
+
+
+def test_reconcile_chan_name():
+    pos_chan_name = ['GR1', 'GR2', 'GR2', 'LTP1', 'D1']
+    xltek_chan_name = ['GR1', 'GR2', 'GR2', 'ltp1', 'Fp1', 'TRIG', 'REF1',
+                       'OSAT', 'X1']
+    report = reconcile_chan_name(pos_chan_name, xltek_chan_name)
+
+    assert report['matched'] == ['GR1', 'GR2', 'GR2']
+    assert report['scalp'] == ['Fp1']
+    assert report['trigger'] == ['TRIG']
+    assert report['ref'] == ['REF1']
+    assert report['unknown'] == ['ltp1', 'X1']
+    assert report['missing'] == ['LTP1', 'D1']
+    assert report['case_mismatch'] == ['ltp1']
+    assert 'agreement' not in report
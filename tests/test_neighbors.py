@@ -0,0 +1,45 @@
+from numpy import arange, c_, meshgrid, r_, zeros
+from numpy.random import default_rng
+
+from eloc.neighbors import grid_edges, knn_edges, neighbor_graph
+
+
+def _grid(n_rows=4, n_cols=8, spacing=10):
+    x, y = meshgrid(arange(n_cols) * spacing, arange(n_rows) * spacing)
+    return c_[x.ravel(), y.ravel(), zeros(n_rows * n_cols)]
+
+
+def _labels(prefix, n_elec):
+    return [prefix + str(i + 1) for i in range(n_elec)]
+
+
+def test_grid_edges_numbered_along_columns():
+    coord = _grid()[arange(32).reshape(4, 8).T.ravel()]
+    edges, grid = grid_edges(_labels('GR', 32), coord)
+
+    assert len(edges) == 4 * 7 + 3 * 8
+    assert (grid >= 0).all()
+
+
+def test_grid_edges_wrong_layout():
+    """if the labels do not match the positions, use the nearest neighbors"""
+    coord = _grid()[default_rng(0).permutation(32)]
+    labels = _labels('GR', 32)
+    edges, grid = grid_edges(labels, coord)
+
+    assert len(edges) == 0
+    assert (grid == -1).all()
+    assert (neighbor_graph(coord, labels)[0] == knn_edges(coord)).all()
+
+
+def test_neighbor_graph_between_grids():
+    """two grids next to each other are connected by the nearest neighbors"""
+    coord = r_[_grid(), _grid() + [0, 40, 0]]
+    labels = _labels('GA', 32) + _labels('GB', 32)
+    edges, rest = neighbor_graph(coord, labels)
+    _, grid = grid_edges(labels, coord)
+
+    across = grid[edges[:, 0]] != grid[edges[:, 1]]
+    assert across.any()
+    assert (rest[across] < 20).all()
+    assert len(edges) == 2 * (4 * 7 + 3 * 8) + across.sum()
@@ -0,0 +1,165 @@
+from numpy import (absolute, arange, c_, cos, cross, full, meshgrid, pi, r_,
+                   sin, sqrt, zeros)
+from numpy.testing import assert_allclose
+from pytest import raises
+from scipy.spatial import ConvexHull
+
+from eloc.chan_table import ChanTable
+from eloc.optimization_snap import (COORD_TOL, DIST_TOL, N_PLATEAU,
+                                    SnapMonitor, _StopSnapping,
+                                    optimization_snap, previous_snap,
+                                    reuse_snapped, snap_chan_to_surf)
+from eloc.surf_index import SurfaceIndex
+
+RADIUS = 70
+
+
+def _sphere(n_vert=5000, radius=RADIUS):
+    """Vertices evenly spread on a sphere (Fibonacci lattice)."""
+    i = arange(n_vert) + 0.5
+    z = 1 - 2 * i / n_vert
+    phi = pi * (1 + sqrt(5)) * i
+    r = sqrt(1 - z ** 2)
+    return radius * c_[r * cos(phi), r * sin(phi), z]
+
+
+def _sphere_surf(n_vert=5000, radius=RADIUS):
+    """Triangulated sphere, with the triangles oriented outwards."""
+    vert = _sphere(n_vert, radius)
+    tri = ConvexHull(vert).simplices.copy()
+    tri_vert = vert[tri]
+    normal = cross(tri_vert[:, 1] - tri_vert[:, 0],
+                   tri_vert[:, 2] - tri_vert[:, 0])
+    inward = (normal * tri_vert.mean(axis=1)).sum(axis=1) < 0
+    tri[inward] = tri[inward][:, ::-1]
+    return vert, tri
+
+
+def _flat_grid(n=8, spacing=10, height=RADIUS + 10):
+    x, y = meshgrid(arange(n) * spacing, arange(n) * spacing)
+    x = x.ravel() - x.mean()
+    y = y.ravel() - y.mean()
+    labels = ['GR{}'.format(i + 1) for i in range(n * n)]
+    return labels, c_[x, y, full(n * n, height)]
+
+
+def _grid_spacing(coord, n=8):
+    coord = coord.reshape(n, n, 3)
+    return r_[sqrt(((coord[:, 1:] - coord[:, :-1]) ** 2).sum(axis=2)).ravel(),
+              sqrt(((coord[1:, :] - coord[:-1, :]) ** 2).sum(axis=2)).ravel()]
+
+
+def test_optimization_snap_grid():
+    """the grid is on the surface and it keeps its shape (better than the
+    projection onto the surface)"""
+    surf_index = SurfaceIndex(*_sphere_surf())
+    labels, coord = _flat_grid()
+    diagnostics = {}
+    snapped = optimization_snap(coord, surf_index, diagnostics=diagnostics,
+                                labels=labels)
+
+    assert diagnostics['converged']
+    assert diagnostics['max_dist'] < DIST_TOL
+    assert_allclose(sqrt((snapped ** 2).sum(axis=1)), RADIUS, atol=0.1)
+
+    _, projected, _ = surf_index.distance(coord)
+    error = absolute(_grid_spacing(snapped) - 10)
+    assert error.max() < 2
+    assert error.max() < absolute(_grid_spacing(projected) - 10).max()
+
+
+def test_optimization_snap_early_stop():
+    surf_index = SurfaceIndex(*_sphere_surf())
+    labels, coord = _flat_grid()
+    diagnostics = {}
+    optimization_snap(coord, surf_index, diagnostics=diagnostics,
+                      labels=labels)
+
+    assert diagnostics['message'] == 'early stop'
+    trace = diagnostics['trace']
+    assert diagnostics['n_iter'] == len(trace) > N_PLATEAU
+    assert all(set(x) == {'energy', 'max_dist', 'step'} for x in trace)
+    assert trace[-1]['max_dist'] < DIST_TOL
+    assert trace[-1]['step'] < trace[0]['step']
+
+
+def test_snap_monitor():
+    """it stops only when the contacts are on the surface and the energy
+    does not change anymore"""
+    state = {'energy': 10., 'dist': 1.}
+    monitor = SnapMonitor(lambda x: state['energy'],
+                          lambda x: r_[state['dist']], zeros(3))
+    for _ in range(N_PLATEAU + 2):  # constant energy, far from the surface
+        monitor(zeros(3))
+
+    state['dist'] = 0.
+    for _ in range(N_PLATEAU):  # on the surface, energy still decreasing
+        state['energy'] -= 1
+        monitor(zeros(3))
+    for _ in range(N_PLATEAU - 1):
+        monitor(zeros(3))
+    with raises(_StopSnapping):
+        monitor(zeros(3) + 1)
+
+    assert len(monitor.trace) == 3 * N_PLATEAU + 2
+    assert_allclose(monitor.trace[-1]['step'], sqrt(3))
+    assert_allclose(monitor.x, 1)
+
+
+def test_optimization_snap_one_contact():
+    surf_index = SurfaceIndex(_sphere())
+    diagnostics = {}
+    coord = optimization_snap(c_[[0.], [0.], [RADIUS + 5.]], surf_index,
+                              diagnostics=diagnostics)
+
+    assert coord.shape == (1, 3)
+    assert diagnostics['converged']
+    assert_allclose(sqrt((coord ** 2).sum()), RADIUS, atol=1)
+
+
+def test_snap_chan_to_surf_one_contact_array():
+    """a lone contact (f.e. neuroport) is an array on its own"""
+    surf_index = SurfaceIndex(*_sphere_surf())
+    chan = ChanTable(['GR1', 'GR2', 'GR3', 'neuroport'],
+                     [[-5, 0, RADIUS + 3], [0, 0, RADIUS + 3],
+                      [5, 0, RADIUS + 3], [0, 40, RADIUS]])
+    diagnostics = []
+    snap_chan_to_surf(chan, surf_index, diagnostics=diagnostics)
+
+    assert len(diagnostics) == 2
+    assert all(x['converged'] for x in diagnostics)
+    dist = sqrt((chan.return_xyz() ** 2).sum(axis=1))
+    assert_allclose(dist, RADIUS, atol=1)
+
+
+def test_snap_chan_to_surf_reuse_previous():
+    """the contacts of the previous session are not snapped again"""
+    surf_index = SurfaceIndex(*_sphere_surf())
+    labels, coord = _flat_grid(n=4)
+    orig = ChanTable(labels, coord)
+    snapped = snap_chan_to_surf(orig.copy(), surf_index)
+    previous = previous_snap(orig, snapped)
+
+    diagnostics = []
+    chan = snap_chan_to_surf(ChanTable(labels, coord), surf_index, previous,
+                             diagnostics=diagnostics)
+    assert diagnostics == []
+    assert_allclose(chan.return_xyz(), snapped.return_xyz())
+
+
+def test_reuse_snapped_reject():
+    """contacts with another label or which moved are snapped again"""
+    labels, coord = _flat_grid(n=2)
+    shift = [0, 0, -10]
+    previous = {label: (xyz, xyz + shift) for label, xyz in zip(labels,
+                                                                coord)}
+    previous['GR5'] = previous.pop('GR1')  # label mismatch
+
+    moved = coord.copy()
+    moved[1, 0] += 2 * COORD_TOL
+    moved[2, 0] += COORD_TOL / 2
+    fixed, x0 = reuse_snapped(labels, moved, previous)
+
+    assert list(fixed) == [False, False, True, True]
+    # moved like the closest fixed contact
+    assert_allclose(x0, moved + shift, atol=COORD_TOL)
@@ -0,0 +1,40 @@
+from collections import Counter
+
+from numpy import asarray, eye, meshgrid, zeros
+from numpy.random import default_rng
+
+from eloc.regions import NOT_FOUND, RegionLookup
+
+LUT = {0: 'Unknown', 1: 'A', 2: 'B', 3: 'C', 4: 'Left-Cerebral-White-Matter'}
+EXCLUDE = ('White', 'Unknown')
+
+
+def _phypno_region(volume, pos, max_approx):
+    """Same loops as phypno's find_brain_region (ties go to the region found
+    first)."""
+    for approx in range(max_approx + 1):
+        step = range(-approx, approx + 1)
+        regions = []
+        for x, y, z in asarray(meshgrid(step, step, step)).reshape(3, -1).T:
+            name = LUT[volume[pos[0] + x, pos[1] + y, pos[2] + z]]
+            if not any(one in name for one in EXCLUDE):
+                regions.append(name)
+        if regions:
+            return Counter(regions).most_common(1)[0][0], approx
+    return NOT_FOUND, max_approx
+
+
+def test_find_regions_like_phypno():
+    rng = default_rng(0)
+    volume = zeros((20, 20, 20), dtype=int)
+    mask = rng.random(volume.shape) < 0.05  # sparse labels, many ties
+    volume[mask] = rng.integers(1, 5, mask.sum())
+
+    pos = rng.integers(4, 16, (300, 3))
+    lookup = RegionLookup(volume, eye(4), LUT)
+    region, approx = lookup.find_regions(pos, max_approx=2,
+                                         exclude_regions=EXCLUDE)
+
+    expected = [_phypno_region(volume, one_pos, 2) for one_pos in pos]
+    assert list(region) == [x[0] for x in expected]
+    assert list(approx) == [x[1] for x in expected]
@@ -0,0 +1,29 @@
+from eloc.surf_cache import SurfaceCache
+
+
+def _create(tmp_dir):
+    one_file = tmp_dir.joinpath('data.bin')
+    one_file.write_bytes(b'x' * 100)
+    return one_file
+
+
+def test_get_or_create_larger_than_cache(tmp_path):
+    """the entry just created is kept, even if the cache is too small"""
+    cache = SurfaceCache(tmp_path, max_size=50)
+    first = cache.get_or_create('first', _create)
+    second = cache.get_or_create('second', _create)
+
+    assert second.exists()
+    assert not first.exists()  # least recently used
+
+
+def test_evict_lock_files(tmp_path):
+    cache = SurfaceCache(tmp_path)
+    cache.get_or_create('entry', _create)
+    with cache.lock('busy'):
+        cache.evict()
+        assert tmp_path.joinpath('.busy.lock').exists()
+
+    cache.evict()
+    assert not tmp_path.joinpath('.entry.lock').exists()
+    assert not tmp_path.joinpath('.busy.lock').exists()
@@ -0,0 +1,30 @@
+from numpy import asarray, sqrt, tile
+from numpy.testing import assert_allclose
+
+from eloc.surf_index import SurfaceIndex, closest_point_on_triangle
+
+
+def test_closest_point_on_triangle():
+    """inside the triangle, on an edge and on a vertex"""
+    p = asarray([[0.25, 0.25, 1], [0.5, -1, 0], [2, 2, 0], [-1, -1, -1]])
+    a, b, c = (tile(x, (4, 1)) for x in ([0, 0, 0], [1, 0, 0], [0, 1, 0]))
+
+    closest = closest_point_on_triangle(p, a, b, c)
+    assert_allclose(closest, [[0.25, 0.25, 0], [0.5, 0, 0], [0.5, 0.5, 0],
+                              [0, 0, 0]], atol=1e-12)
+
+
+def test_distance():
+    """the exact distance is to the triangles, not to the vertices"""
+    vert = asarray([[0, 0, 0], [10, 0, 0], [0, 10, 0]], dtype=float)
+    surf_index = SurfaceIndex(vert, asarray([[0, 1, 2]]))
+    points = asarray([[2, 2, 3], [20, 0, 0]], dtype=float)
+
+    dist, closest, grad = surf_index.distance(points)
+    assert_allclose(dist, [3, 10])
+    assert_allclose(closest, [[2, 2, 0], [10, 0, 0]])
+    assert_allclose(grad, [[0, 0, 1], [1, 0, 0]])
+
+    dist, closest, _ = surf_index.distance(points, exact=False)
+    assert_allclose(dist, [sqrt(17), 10])
+    assert_allclose(closest, [[0, 0, 0], [10, 0, 0]])
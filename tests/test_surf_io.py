@@ -0,0 +1,37 @@
+from numpy import asarray, float64, int32
+from numpy.testing import assert_allclose, assert_array_equal
+
+from eloc.surf_io import QUAD_MAGIC, read_surf, write_surf
+
+
+def test_surf_round_trip(tmp_path):
+    vert = asarray([[0, 0, 0], [1.5, 0, 0], [0, 2.25, 0], [0, 0, -3]])
+    tri = asarray([[0, 1, 2], [0, 2, 3], [0, 3, 1]])
+    surf_file = tmp_path.joinpath('lh.test')
+    write_surf(surf_file, vert, tri)
+
+    vert_read, tri_read = read_surf(surf_file)
+    assert vert_read.dtype == float64
+    assert tri_read.dtype == int32
+    assert_allclose(vert_read, vert)
+    assert_array_equal(tri_read, tri)
+
+
+def test_surf_quad(tmp_path):
+    """each quad is split into two triangles, like in FreeSurfer"""
+    vert = asarray([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                    [0, 0, 1], [1, 0, 1]])
+    quad = asarray([[0, 1, 2, 3], [1, 5, 4, 0]])
+    surf_file = tmp_path.joinpath('lh.quad')
+    with surf_file.open('wb') as f:
+        f.write(QUAD_MAGIC.to_bytes(3, 'big'))
+        f.write(len(vert).to_bytes(3, 'big'))
+        f.write(len(quad).to_bytes(3, 'big'))
+        f.write((vert * 100).astype('>i2').tobytes())
+        for x in quad.ravel():
+            f.write(int(x).to_bytes(3, 'big'))
+
+    vert_read, tri = read_surf(surf_file)
+    assert_allclose(vert_read, vert)
+    assert_array_equal(tri, [[0, 1, 3], [2, 3, 1],  # even first vertex
+                             [1, 5, 4], [1, 4, 0]])  # odd first vertex